@@ -0,0 +1,391 @@
+#!/usr/bin/python3
+
+import  os
+import  copy
+import  stat
+import  time
+import  shutil
+import  sqlite3
+import  tarfile
+import  fnmatch
+import  threading
+import  itertools
+from    concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class SnapshotArchiver(object):
+    """@brief Responsible for packing a backup folder into an archive folder that holds a small
+              number of compressed tar files (chunks) and an index of the chunk that holds each
+              path. A backup folder may hold millions of files, each a directory entry and inode
+              that slows every program that reads the dest path. The chunks are compressed in
+              parallel and each chunk is streamed to disk so the memory used does not depend on
+              the size of the backup. A single file is extracted by decompressing only the chunk
+              that holds it.
+
+              Backups in the same full backup set share unchanged files through hard links. The
+              contents of each inode are stored once per set: a file whose inode is already held by
+              this archive or an earlier archive of the set is stored in the index as a link to it."""
+
+    COMPRESSION_GZIP                = "gz"
+    COMPRESSION_XZ                  = "xz"
+    COMPRESSION_LIST                = (COMPRESSION_GZIP, COMPRESSION_XZ)
+    INDEX_FILE                      = "index.sqlite"
+    CHUNK_FILE_FORMAT               = "{:06d}.tar.{}"
+    TMP_SUFFIX                      = ".tmp"
+    DEFAULT_THREAD_COUNT            = 4
+    #The uncompressed size of the files in each chunk
+    CHUNK_BYTES                     = 64*1048576
+    #The maximum number of paths in each chunk so that the list of paths held in memory is bounded
+    CHUNK_PATHS                     = 10000
+    #The chunk number of a path whose contents are held by a linked archive
+    LINKED_CHUNK                    = -1
+    TYPE_DIR                        = "d"
+    TYPE_FILE                       = "f"
+    TYPE_LINK                       = "l"
+    TYPE_OTHER                      = "o"
+
+    def __init__(self, uo, threadCount=DEFAULT_THREAD_COUNT, compression=COMPRESSION_GZIP):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param threadCount The number of chunks to compress at the same time.
+           @param compression One of the COMPRESSION_* constants."""
+        if compression not in SnapshotArchiver.COMPRESSION_LIST:
+            raise ValueError("{} is not a supported archive compression ({}).".format(compression, ",".join(SnapshotArchiver.COMPRESSION_LIST)))
+
+        self._uo            = uo
+        self._threadCount   = threadCount
+        self._compression   = compression
+
+    @staticmethod
+    def _GetType(entryStat):
+        """@return The TYPE_* constant for a path."""
+        if stat.S_ISDIR(entryStat.st_mode):
+            return SnapshotArchiver.TYPE_DIR
+        if stat.S_ISREG(entryStat.st_mode):
+            return SnapshotArchiver.TYPE_FILE
+        if stat.S_ISLNK(entryStat.st_mode):
+            return SnapshotArchiver.TYPE_LINK
+        return SnapshotArchiver.TYPE_OTHER
+
+    @staticmethod
+    def _GetInodeKey(entryStat):
+        """@return The key that identifies the contents of a file. An inode is only shared by hard
+                   links to the same file. The size and modification time guard against an inode
+                   number being reused once every link to it has been removed."""
+        return (entryStat.st_dev, entryStat.st_ino, entryStat.st_size, entryStat.st_mtime_ns)
+
+    @staticmethod
+    def _FindInode(connection, inodeKey):
+        """@brief Find a file with the contents of an inode in an archive index.
+           @param connection The sqlite3 connection to the index.
+           @param inodeKey The key returned by _GetInodeKey().
+           @return The path (bytes) of the file in the archive or None if not found."""
+        row = connection.execute("SELECT path FROM inodes WHERE dev=? AND ino=? AND size=? AND mtime_ns=?", inodeKey).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    @staticmethod
+    def _OpenLinkIndexes(linkArchivePathList):
+        """@brief Open the indexes of the earlier archives of the full backup set.
+           @param linkArchivePathList The archive folders.
+           @return A list of (archive name, sqlite3 connection) tuples."""
+        linkIndexList = []
+        for linkArchivePath in linkArchivePathList:
+            indexFile = os.path.join(linkArchivePath, SnapshotArchiver.INDEX_FILE)
+            connection = sqlite3.connect("file:{}?mode=ro".format(indexFile), uri=True)
+            linkIndexList.append( (os.path.basename(linkArchivePath), connection) )
+        return linkIndexList
+
+    @staticmethod
+    def _FindLinked(linkIndexList, entryStat):
+        """@brief Find a regular file in the earlier archives of the full backup set.
+           @param linkIndexList The list returned by _OpenLinkIndexes().
+           @param entryStat The os.stat_result of the file.
+           @return A tuple of the archive name and path (bytes) or None if not found."""
+        inodeKey = SnapshotArchiver._GetInodeKey(entryStat)
+        for archiveName, connection in linkIndexList:
+            path = SnapshotArchiver._FindInode(connection, inodeKey)
+            if path is not None:
+                return (archiveName, path)
+        return None
+
+    def _getEntries(self, backupPath):
+        """@brief Read the backup folder.
+           @param backupPath The backup folder.
+           @return A generator of (relPath, os.stat_result) tuples. A folder is returned before the paths in it."""
+        dirList = [""]
+        while dirList:
+            dirPath = dirList.pop()
+            with os.scandir(os.path.join(backupPath, dirPath)) as entryIter:
+                for entry in entryIter:
+                    relPath = os.path.join(dirPath, entry.name) if dirPath else entry.name
+                    entryStat = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(entryStat.st_mode):
+                        dirList.append(relPath)
+                    yield (relPath, entryStat)
+
+    def getStoreBytes(self, backupPath, linkArchivePathList=None):
+        """@brief Find the most disk space that packing a backup may use.
+           @param backupPath The backup folder.
+           @param linkArchivePathList The archive folders of the earlier backups in the same full backup set.
+           @return The size in bytes (before compression) of the files not held by the earlier archives."""
+        storeBytes = 0
+        linkIndexList = self._OpenLinkIndexes(linkArchivePathList or [])
+        try:
+            for _, entryStat in self._getEntries(backupPath):
+                if stat.S_ISREG(entryStat.st_mode) and self._FindLinked(linkIndexList, entryStat) is None:
+                    storeBytes = storeBytes + entryStat.st_size
+        finally:
+            for _, connection in linkIndexList:
+                connection.close()
+        return storeBytes
+
+    def _writeChunk(self, backupPath, chunkFile, chunkList):
+        """@brief Write a compressed tar file. Called in a worker thread.
+           @param backupPath The backup folder.
+           @param chunkFile The tar file to write.
+           @param chunkList The (relPath, os.stat_result) tuples of the paths to add.
+           @return The number of bytes written."""
+        with tarfile.open(chunkFile, "w:{}".format(self._compression), format=tarfile.PAX_FORMAT) as tar:
+            for relPath, _ in chunkList:
+                tar.add(os.path.join(backupPath, relPath), arcname=relPath, recursive=False)
+        return os.path.getsize(chunkFile)
+
+    def pack(self, backupPath, archivePath, linkArchivePathList=None):
+        """@brief Pack a backup folder into an archive folder. The archive is written to a temporary
+                  folder that is renamed when complete. The backup folder is not changed.
+           @param backupPath The backup folder.
+           @param archivePath The archive folder to create.
+           @param linkArchivePathList The archive folders of the earlier backups in the same full
+                                      backup set. Files held by these are not stored again.
+           @return A tuple of the number of paths, the number of chunks and the size of the archive in bytes."""
+        startTime = time.time()
+        archiveName = os.path.basename(archivePath)
+        tmpPath = "{}{}".format(archivePath, SnapshotArchiver.TMP_SUFFIX)
+        #Remove the remains of an archive that was not completed
+        if os.path.isdir(tmpPath):
+            shutil.rmtree(tmpPath)
+        os.makedirs(tmpPath)
+
+        linkIndexList = self._OpenLinkIndexes(linkArchivePathList or [])
+        connection = sqlite3.connect( os.path.join(tmpPath, SnapshotArchiver.INDEX_FILE) )
+        try:
+            connection.execute("CREATE TABLE paths (path BLOB, chunk INTEGER, type TEXT, size INTEGER, mtime_ns INTEGER, mode INTEGER, uid INTEGER, gid INTEGER, link_archive TEXT, link_path BLOB)")
+            connection.execute("CREATE TABLE inodes (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, path BLOB)")
+            connection.execute("CREATE INDEX inodes_key ON inodes (ino, dev)")
+            pathCount = 0
+            linkedCount = 0
+            chunkCount = 0
+            archiveBytes = 0
+            chunkList = []
+            chunkBytes = 0
+            with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+                #Limit the chunks waiting to be compressed so that memory use is bounded
+                futureSet = set()
+                for relPath, entryStat in itertools.chain(self._getEntries(backupPath), [(None, None)]):
+                    if relPath is not None:
+                        pathCount = pathCount + 1
+                        linked = None
+                        if stat.S_ISREG(entryStat.st_mode):
+                            inodeKey = self._GetInodeKey(entryStat)
+                            linkPath = self._FindInode(connection, inodeKey)
+                            if linkPath is not None:
+                                linked = (archiveName, linkPath)
+                            else:
+                                linked = self._FindLinked(linkIndexList, entryStat)
+
+                        if linked:
+                            connection.execute("INSERT INTO paths VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (os.fsencode(relPath), SnapshotArchiver.LINKED_CHUNK, self._GetType(entryStat), entryStat.st_size, entryStat.st_mtime_ns, entryStat.st_mode, entryStat.st_uid, entryStat.st_gid, linked[0], linked[1]))
+                            linkedCount = linkedCount + 1
+                            continue
+
+                        connection.execute("INSERT INTO paths VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)", (os.fsencode(relPath), chunkCount, self._GetType(entryStat), entryStat.st_size, entryStat.st_mtime_ns, entryStat.st_mode, entryStat.st_uid, entryStat.st_gid))
+                        if stat.S_ISREG(entryStat.st_mode):
+                            connection.execute("INSERT INTO inodes VALUES (?, ?, ?, ?, ?)", self._GetInodeKey(entryStat) + (os.fsencode(relPath),))
+                            chunkBytes = chunkBytes + entryStat.st_size
+                        chunkList.append( (relPath, entryStat) )
+
+                        if chunkBytes < SnapshotArchiver.CHUNK_BYTES and len(chunkList) < SnapshotArchiver.CHUNK_PATHS:
+                            continue
+
+                    if not chunkList:
+                        continue
+
+                    if len(futureSet) >= self._threadCount*2:
+                        doneSet, futureSet = wait(futureSet, return_when=FIRST_COMPLETED)
+                        for future in doneSet:
+                            archiveBytes = archiveBytes + future.result()
+
+                    chunkFile = os.path.join(tmpPath, SnapshotArchiver.CHUNK_FILE_FORMAT.format(chunkCount, self._compression))
+                    futureSet.add( executor.submit(self._writeChunk, backupPath, chunkFile, chunkList) )
+                    chunkCount = chunkCount + 1
+                    chunkList = []
+                    chunkBytes = 0
+
+                for future in futureSet:
+                    archiveBytes = archiveBytes + future.result()
+
+            connection.execute("CREATE INDEX paths_path ON paths (path)")
+            connection.commit()
+        finally:
+            connection.close()
+            for _, linkConnection in linkIndexList:
+                linkConnection.close()
+
+        os.rename(tmpPath, archivePath)
+        self._uo.info("Packed {} paths ({} linked to files already archived) from {} into {} chunks ({:.3f} GB) in {:.1f} seconds.".format(pathCount, linkedCount, os.path.basename(backupPath), chunkCount, archiveBytes/(2**30), time.time()-startTime))
+        return (pathCount, chunkCount, archiveBytes)
+
+class ArchiveReader(object):
+    """@brief Responsible for extracting paths from an archive folder created by SnapshotArchiver.
+              Files linked to an earlier archive of the same full backup set are extracted from
+              that archive, which must be in the same folder."""
+
+    def __init__(self, uo, archivePath, threadCount=SnapshotArchiver.DEFAULT_THREAD_COUNT):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param archivePath The archive folder.
+           @param threadCount The number of chunks to extract at the same time."""
+        self._uo            = uo
+        self._archivePath   = archivePath
+        self._threadCount   = threadCount
+        self._lock          = threading.Lock()
+        self._restoredCount = 0
+        self._isRoot        = os.geteuid() == 0
+
+    @staticmethod
+    def _GetChunkFile(archivePath, chunkID):
+        """@return The tar file of a chunk."""
+        for compression in SnapshotArchiver.COMPRESSION_LIST:
+            chunkFile = os.path.join(archivePath, SnapshotArchiver.CHUNK_FILE_FORMAT.format(chunkID, compression))
+            if os.path.isfile(chunkFile):
+                return chunkFile
+        raise OSError("Chunk {} was not found in {}".format(chunkID, archivePath))
+
+    @staticmethod
+    def _IsIncluded(relPath, patternList):
+        """@brief Determine if a path is restored. A path is restored if it, or a folder that holds
+                  it, matches one of the patterns.
+           @param relPath The path relative to the backup folder.
+           @param patternList The glob patterns. If empty every path is restored.
+           @return True if the path is restored."""
+        if not patternList:
+            return True
+
+        while relPath:
+            for pattern in patternList:
+                if fnmatch.fnmatchcase(relPath, pattern):
+                    return True
+            relPath = os.path.dirname(relPath)
+        return False
+
+    def _getPaths(self, patternList):
+        """@brief Read the index.
+           @param patternList The glob patterns of the paths to restore.
+           @return A tuple of the extract dict and the list of the (relPath, mtime_ns, mode, uid, gid)
+                   tuples of the folders to restore. Each key of the extract dict is an (archive path, chunk number)
+                   tuple and each value is a dict that maps the name of a tar member to the list of
+                   paths to restore it to."""
+        extractDict = {}
+        dirList = []
+        #Each key is the name of a linked archive and each value a list of (link path, relPath) tuples
+        linkDict = {}
+        connection = sqlite3.connect( os.path.join(self._archivePath, SnapshotArchiver.INDEX_FILE) )
+        try:
+            for path, chunkID, pathType, mtimeNs, mode, uid, gid, linkArchive, linkPath in connection.execute("SELECT path, chunk, type, mtime_ns, mode, uid, gid, link_archive, link_path FROM paths"):
+                relPath = os.fsdecode(path)
+                if not self._IsIncluded(relPath, patternList):
+                    continue
+                #Folders are created before the chunks are extracted
+                if pathType == SnapshotArchiver.TYPE_DIR:
+                    dirList.append( (relPath, mtimeNs, mode, uid, gid) )
+                elif chunkID == SnapshotArchiver.LINKED_CHUNK:
+                    linkDict.setdefault(linkArchive, []).append( (linkPath, relPath) )
+                else:
+                    extractDict.setdefault( (self._archivePath, chunkID), {} ).setdefault(relPath, []).append(relPath)
+        finally:
+            connection.close()
+
+        for linkArchive, linkList in linkDict.items():
+            linkArchivePath = os.path.join(os.path.dirname(self._archivePath), linkArchive)
+            linkConnection = sqlite3.connect("file:{}?mode=ro".format(os.path.join(linkArchivePath, SnapshotArchiver.INDEX_FILE)), uri=True)
+            try:
+                for linkPath, relPath in linkList:
+                    row = linkConnection.execute("SELECT chunk FROM paths WHERE path=? AND chunk>=0", (linkPath,)).fetchone()
+                    if row is None:
+                        raise OSError("{} was not found in {}".format(os.fsdecode(linkPath), linkArchivePath))
+                    extractDict.setdefault( (linkArchivePath, row[0]), {} ).setdefault(os.fsdecode(linkPath), []).append(relPath)
+            finally:
+                linkConnection.close()
+
+        dirList.sort()
+        return (extractDict, dirList)
+
+    def _extractChunk(self, archivePath, chunkID, memberDict, restorePath):
+        """@brief Extract paths from a chunk. Called in a worker thread.
+           @param archivePath The archive folder holding the chunk.
+           @param chunkID The chunk number.
+           @param memberDict A dict that maps the name of each tar member to extract to the list of paths to restore it to.
+           @param restorePath The folder to restore to."""
+        extractArgs = {}
+        #Trust the archive as pbackup created it. Python 3.12 added extraction filters.
+        if hasattr(tarfile, "tar_filter"):
+            extractArgs["filter"] = "tar"
+
+        restoredCount = 0
+        with tarfile.open(self._GetChunkFile(archivePath, chunkID), "r:*") as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                for relPath in memberDict.get(member.name, []):
+                    restoreMember = member
+                    if relPath != member.name:
+                        restoreMember = copy.copy(member)
+                        restoreMember.name = relPath
+                    tar.extract(restoreMember, restorePath, **extractArgs)
+                    restoredCount = restoredCount + 1
+
+        with self._lock:
+            self._restoredCount = self._restoredCount + restoredCount
+
+    def restore(self, restorePath, patternList=None):
+        """@brief Restore paths from the archive.
+           @param restorePath The folder to restore to.
+           @param patternList A list of glob patterns matched against the path of each file relative
+                              to the backup folder. If a folder matches, everything in it is restored.
+                              If None or empty everything is restored.
+           @return The number of paths restored."""
+        startTime = time.time()
+        patternList = [pattern.strip("/") for pattern in patternList or [] if pattern.strip("/")]
+        extractDict, dirList = self._getPaths(patternList)
+        if not extractDict and not dirList:
+            self._uo.warn("Nothing to restore.")
+            return 0
+
+        #Create the folders first so that chunks extracted at the same time do not both create them.
+        #Folders left read only by an earlier restore are made writable until the end.
+        os.makedirs(restorePath, exist_ok=True)
+        for relPath, _, _, _, _ in dirList:
+            dirPath = os.path.join(restorePath, relPath)
+            os.makedirs(dirPath, exist_ok=True)
+            dirMode = stat.S_IMODE(os.stat(dirPath).st_mode)
+            if dirMode & stat.S_IRWXU != stat.S_IRWXU:
+                os.chmod(dirPath, dirMode | stat.S_IRWXU)
+
+        self._uo.info("Restoring from {} chunks of {}".format(len(extractDict), self._archivePath))
+        with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+            futureList = [executor.submit(self._extractChunk, archivePath, chunkID, memberDict, restorePath) for (archivePath, chunkID), memberDict in extractDict.items()]
+            for future in futureList:
+                future.result()
+
+        #Set the folder attributes last as extracting the paths in a folder changes its modification time
+        for relPath, mtimeNs, mode, uid, gid in reversed(dirList):
+            dirPath = os.path.join(restorePath, relPath)
+            if self._isRoot:
+                os.chown(dirPath, uid, gid)
+            os.chmod(dirPath, stat.S_IMODE(mode))
+            os.utime(dirPath, ns=(mtimeNs, mtimeNs))
+        self._restoredCount = self._restoredCount + len(dirList)
+
+        self._uo.info("Restored {} paths in {:.1f} seconds.".format(self._restoredCount, time.time()-startTime))
+        return self._restoredCount
@@ -3,53 +3,202 @@
 import  sys
 import  os
 from    optparse import OptionParser
-from    subprocess import check_output, STDOUT
+from    subprocess import check_output, STDOUT, Popen, PIPE
+from    concurrent.futures import ThreadPoolExecutor
 import  time
-import  smtplib
 import  socket
 import  pickle
 import  getpass
 import  shutil
 import  datetime
+import  json
+import  shlex
+import  threading
+import  re
+import  signal
+import  codecs
+import  collections
+import  atexit
+import  gzip
+import  copy
+
+from    pbackup.catalog import SnapshotRecord, SnapshotCatalog
+from    pbackup.purge import PurgeEngine
+from    pbackup.usage import SnapshotUsageScanner
+from    pbackup.metrics import RunMetrics
+from    pbackup.notify import EmailNotifier
+from    pbackup.journal import ChangeJournal, ChangeWatcher
+from    pbackup.dedup import SnapshotDeduplicator
+from    pbackup.restore import SnapshotRestorer
+from    pbackup.manifest import ManifestIndex
+from    pbackup.diff import SnapshotDiff
+from    pbackup.verify import SnapshotVerifier
+from    pbackup.ssh import SshSession
+from    pbackup.forecast import SpaceForecaster
+from    pbackup.exclude import ExclusionCompiler
+from    pbackup.linkdest import LinkDestReport
+from    pbackup.retention import GFSRetention
+from    pbackup.archive import SnapshotArchiver, ArchiveReader
 
 class BackupError(Exception):
     """@brief An exception raised during the backup process."""
     pass
 
+class LogWriter(object):
+    """@brief Responsible for writing lines of text to a log file. The file is kept open and
+              written in blocks rather than once per line. The log file is rotated and the
+              old log files compressed when it reaches a maximum size."""
+
+    FLUSH_BYTES                     = 65536
+    FLUSH_INTERVAL_SECONDS          = 1.0
+
+    def __init__(self, logFile, maxBytes=0, backupCount=0, background=False):
+        """@brief Constructor
+           @param logFile The log file.
+           @param maxBytes The log file is rotated when it reaches this size (0 = never rotate).
+           @param backupCount The number of rotated (compressed) log files to keep.
+           @param background If True the log file is written by a background thread."""
+        self._logFile       = logFile
+        self._maxBytes      = maxBytes
+        self._backupCount   = backupCount
+        self._fd            = None
+        self._fileSize      = 0
+        self._buffer        = []
+        self._bufferBytes   = 0
+        self._lastFlushTime = time.time()
+        self._lock          = threading.Lock()
+        self._ioLock        = threading.Lock()
+        self._flushEvent    = threading.Event()
+        self._closed        = False
+        self._thread        = None
+
+        if background:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        atexit.register(self.close)
+
+    def write(self, line):
+        """@brief Add a line of text to the log file.
+           @param line The line of text (without a trailing newline)."""
+        with self._lock:
+            data = "{}\n".format(line)
+            self._buffer.append(data)
+            self._bufferBytes = self._bufferBytes + len(data)
+            flushRequired = self._bufferBytes >= LogWriter.FLUSH_BYTES or time.time()-self._lastFlushTime >= LogWriter.FLUSH_INTERVAL_SECONDS
+
+        if flushRequired:
+            if self._thread:
+                self._flushEvent.set()
+            else:
+                self.flush()
+
+    def flush(self):
+        """@brief Write all buffered lines to the log file."""
+        with self._ioLock:
+            with self._lock:
+                data = "".join(self._buffer)
+                self._buffer = []
+                self._bufferBytes = 0
+                self._lastFlushTime = time.time()
+
+            if not data:
+                return
+
+            if self._fd is None:
+                self._fd = open(self._logFile, "a")
+                self._fileSize = self._fd.tell()
+
+            if self._maxBytes > 0 and self._fileSize > 0 and self._fileSize + len(data) > self._maxBytes:
+                self._rotate()
+
+            self._fd.write(data)
+            self._fd.flush()
+            self._fileSize = self._fileSize + len(data)
+
+    def _getRotatedFile(self, index):
+        """@return The name of a rotated log file."""
+        return "{}.{}.gz".format(self._logFile, index)
+
+    def _rotate(self):
+        """@brief Compress the current log file into logFile.1.gz, renaming older log files to make space."""
+        self._fd.close()
+        self._fd = None
+
+        if self._backupCount > 0:
+            for index in range(self._backupCount-1, 0, -1):
+                if os.path.isfile(self._getRotatedFile(index)):
+                    os.replace(self._getRotatedFile(index), self._getRotatedFile(index+1))
+            with open(self._logFile, "rb") as srcFd:
+                with gzip.open(self._getRotatedFile(1), "wb") as destFd:
+                    shutil.copyfileobj(srcFd, destFd)
+
+        self._fd = open(self._logFile, "w")
+        self._fileSize = 0
+
+    def _run(self):
+        """@brief Write the log file in the background."""
+        while not self._closed:
+            self._flushEvent.wait(LogWriter.FLUSH_INTERVAL_SECONDS)
+            self._flushEvent.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print("ERROR: Failed to write to {}: {}".format(self._logFile, e))
+
+    def close(self):
+        """@brief Write all buffered lines and close the log file."""
+        if self._closed:
+            return
+        self._closed = True
+        #Many log writers may be created by one process (E.G pbackup-benchmark) so do not keep a closed one until exit
+        atexit.unregister(self.close)
+        if self._thread:
+            self._flushEvent.set()
+            self._thread.join()
+        self.flush()
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
 class UO(object):
     """@brief responsible for user viewable output."""
     def __init__(self):
         self._logFile = None
+        self._logWriter = None
         self._outputStore = []
+        self._lock = threading.Lock()
 
     def _output(self, msg):
         """@brief Output the message to stdout and the logFile if defined"""
-        print(msg)
-        self.appendLog(msg)
+        #Several rsync shards may report at the same time
+        with self._lock:
+            print(msg)
+            self.appendLog(msg)
 
     def appendLog(self, text):
         """@brief add the text to the log file
            @param text The text to add to the log file"""
 
-        if self._logFile:
+        if self._logWriter:
+            timeStamp = time.strftime("%Y-%b-%d_%H_%M_%S", time.gmtime())
+            self._logWriter.write("{}: {}".format(timeStamp, text))
 
-            fd = None
-            try:
-                if os.path.isfile(self._logFile):
-                    fd = open(self._logFile, "a")
-                else:
-                    fd = open(self._logFile, "w")
-
-                timeStamp = time.strftime("%Y-%b-%d_%H_%M_%S", time.gmtime())
-                fd.write("{}: {}\n".format(timeStamp, text))
-            finally:
-                if fd:
-                    fd.close()
-
-    def setLog(self, logFile):
+    def setLog(self, logFile, maxBytes=0, backupCount=0, background=False):
         """@brief Set the log file to be used to record all output
-           @param logFile The logFile to use"""
+           @param logFile The logFile to use
+           @param maxBytes The log file is rotated when it reaches this size (0 = never rotate).
+           @param backupCount The number of rotated (compressed) log files to keep.
+           @param background If True the log file is written by a background thread."""
+        self.closeLog()
         self._logFile = logFile
+        self._logWriter = LogWriter(logFile, maxBytes=maxBytes, backupCount=backupCount, background=background)
+
+    def closeLog(self):
+        """@brief Write any buffered output to the log file and close it."""
+        if self._logWriter:
+            self._logWriter.close()
+            self._logWriter = None
 
     def info(self, text):
         self._output( 'INFO:  '+str(text) )
@@ -85,6 +234,233 @@ class DiskUsage(object):
            @return The free disk space in GB"""
         return self._freeBytes /(2**30)
 
+    def getFreeBytes(self):
+        """@brief Get the free disk space in bytes
+           @return The free disk space in bytes"""
+        return self._freeBytes
+
+    def getUsedBytes(self):
+        """@brief Get used disk space in bytes
+           @return The used disk space in bytes"""
+        return self._usedBytes
+
+class RsyncStats(object):
+    """@brief Responsible for holding the numbers reported by rsync --stats."""
+
+    NUMBER_OF_FILES                 = "Number of files"
+    NUMBER_OF_REGULAR_FILES         = "Number of regular files"
+    NUMBER_OF_FILES_TRANSFERRED     = "Number of regular files transferred"
+    TOTAL_FILE_SIZE                 = "Total file size"
+    TOTAL_TRANSFERRED_FILE_SIZE     = "Total transferred file size"
+    LITERAL_DATA                    = "Literal data"
+    MATCHED_DATA                    = "Matched data"
+    TOTAL_BYTES_SENT                = "Total bytes sent"
+    TOTAL_BYTES_RECEIVED            = "Total bytes received"
+
+    UNIT_MULTIPLIERS                = {"K": 1E3, "M": 1E6, "G": 1E9, "T": 1E12, "P": 1E15}
+
+    def __init__(self):
+        self._values = {}
+
+    def parseLine(self, line):
+        """@brief Parse a line of rsync output, storing the value if it is an rsync stats line.
+           @param line A line of rsync output.
+           @return True if the line was an rsync stats line."""
+        elems = line.split(":", 1)
+        if len(elems) != 2:
+            return False
+
+        key = elems[0].strip()
+        if key not in (RsyncStats.NUMBER_OF_FILES,
+                       RsyncStats.NUMBER_OF_FILES_TRANSFERRED,
+                       RsyncStats.TOTAL_FILE_SIZE,
+                       RsyncStats.TOTAL_TRANSFERRED_FILE_SIZE,
+                       RsyncStats.LITERAL_DATA,
+                       RsyncStats.MATCHED_DATA,
+                       RsyncStats.TOTAL_BYTES_SENT,
+                       RsyncStats.TOTAL_BYTES_RECEIVED):
+            return False
+
+        #E.G '1,234 (reg: 1,000, dir: 234)' or '1.23G bytes'
+        try:
+            self._values[key] = RsyncStats.ParseNumber(elems[1].strip().split(" ")[0])
+            if key == RsyncStats.NUMBER_OF_FILES:
+                pos = elems[1].find("reg: ")
+                if pos != -1:
+                    self._values[RsyncStats.NUMBER_OF_REGULAR_FILES] = RsyncStats.ParseNumber(elems[1][pos+5:].split(",")[0].split(")")[0])
+        except ValueError:
+            return False
+
+        return True
+
+    def get(self, key):
+        """@brief Get a stats value.
+           @param key The rsync stats name (one of the RsyncStats constants).
+           @return The value or 0 if rsync did not report it."""
+        return self._values.get(key, 0)
+
+    def add(self, rsyncStats):
+        """@brief Add the values from another RsyncStats instance to this one.
+           @param rsyncStats The RsyncStats instance to add."""
+        for key, value in rsyncStats._values.items():
+            self._values[key] = self._values.get(key, 0) + value
+
+    @staticmethod
+    def ParseNumber(valueStr):
+        """@brief Parse a number as displayed by rsync.
+           @param valueStr The number text (E.G 1,234 or 1.23G).
+           @return The number as an int."""
+        valueStr = valueStr.replace(",", "")
+        multiplier = 1
+        if valueStr and valueStr[-1] in RsyncStats.UNIT_MULTIPLIERS:
+            multiplier = RsyncStats.UNIT_MULTIPLIERS[valueStr[-1]]
+            valueStr = valueStr[:-1]
+        return int(float(valueStr)*multiplier)
+
+class RsyncRunner(object):
+    """@brief Responsible for running an rsync process, passing its output to the user as it
+              is produced and reporting the progress of the transfer."""
+
+    #E.G '  1,234,567  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=100/2000)'
+    PROGRESS_REGEX                  = re.compile(r"^\s*([\d,.]+[KMGTP]?)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d{2}:\d{2})")
+    ERROR_LINE_COUNT                = 20
+
+    def __init__(self, uo, cmd, progressInterval=60, stallTimeout=0, prefix=""):
+        """@brief Constructor
+           @param uo The UO instance used to report the rsync output and progress.
+           @param cmd The rsync command to execute.
+           @param progressInterval The period in seconds between progress reports (0 = no progress reports).
+           @param stallTimeout If rsync makes no progress for this many seconds then it is killed (0 = never).
+           @param prefix Text added to the start of every line reported."""
+        self._uo                = uo
+        self._cmd               = cmd
+        self._progressInterval  = progressInterval
+        self._stallTimeout      = stallTimeout
+        self._prefix            = prefix
+        self._rsyncStats        = RsyncStats()
+        self._lastLines         = collections.deque(maxlen=RsyncRunner.ERROR_LINE_COUNT)
+        self._lock              = threading.Lock()
+        self._process           = None
+        self._stalled           = False
+        self._bytes             = 0
+        self._percent           = 0
+        self._progressText      = None
+        self._lastActivityTime  = None
+
+    def getStats(self):
+        """@return The RsyncStats instance holding the stats reported by rsync."""
+        return self._rsyncStats
+
+    def getLastLines(self):
+        """@return The last lines (excluding progress and stats lines) that rsync output."""
+        return list(self._lastLines)
+
+    def isStalled(self):
+        """@return True if rsync was killed because it stopped making progress."""
+        return self._stalled
+
+    def _report(self, text):
+        """@brief Report text to the user.
+           @param text The text to report."""
+        self._uo.info("{}{}".format(self._prefix, text))
+
+    def _handleLine(self, line):
+        """@brief Handle a line of rsync output.
+           @param line The line of text."""
+        match = RsyncRunner.PROGRESS_REGEX.match(line)
+        if match:
+            with self._lock:
+                #Any change (bytes moved or files checked) shows that rsync is still working
+                if line != self._progressText:
+                    self._lastActivityTime = time.time()
+                    self._progressText = line
+                try:
+                    self._bytes = RsyncStats.ParseNumber(match.group(1))
+                except ValueError:
+                    pass
+                self._percent = int(match.group(2))
+            return
+
+        with self._lock:
+            self._lastActivityTime = time.time()
+
+        if not line.strip() or (line.startswith(".") and len(line) == 2):
+            return
+
+        if not self._rsyncStats.parseLine(line):
+            self._lastLines.append(line)
+
+        self._report(line)
+
+    def _monitor(self, stopEvent):
+        """@brief Report the progress of the transfer and kill rsync if it stalls.
+           @param stopEvent Set when rsync has exited."""
+        startTime = time.time()
+        lastReportTime = startTime
+        lastReportBytes = 0
+        while not stopEvent.wait(1):
+            now = time.time()
+            with self._lock:
+                bytesMoved = self._bytes
+                percent = self._percent
+                lastActivityTime = self._lastActivityTime
+
+            if self._stallTimeout > 0 and now-lastActivityTime > self._stallTimeout:
+                self._stalled = True
+                self._report("rsync has made no progress for {} seconds. Stopping it.".format(self._stallTimeout))
+                try:
+                    os.killpg(self._process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                return
+
+            if self._progressInterval > 0 and now-lastReportTime >= self._progressInterval:
+                bytesPerSecond = (bytesMoved-lastReportBytes)/(now-lastReportTime)
+                etaStr = "unknown"
+                if percent > 0 and bytesPerSecond > 0:
+                    totalBytes = bytesMoved*100/percent
+                    etaStr = time.strftime("%H:%M:%S", time.gmtime((totalBytes-bytesMoved)/bytesPerSecond))
+                self._report("Progress: {:.1f} MB transferred ({}%), {:.1f} MB/s, ETA {}, elapsed {}".format(bytesMoved/1E6, percent, bytesPerSecond/1E6, etaStr, time.strftime("%H:%M:%S", time.gmtime(now-startTime))))
+                lastReportTime = now
+                lastReportBytes = bytesMoved
+
+    def run(self):
+        """@brief Run the rsync command, handling its output line by line as it is produced.
+           @return The rsync exit code."""
+        self._lastActivityTime = time.time()
+        #Start in a new session so that the shell and rsync can be killed together
+        self._process = Popen(self._cmd, shell=True, stdout=PIPE, stderr=STDOUT, start_new_session=True)
+        stopEvent = threading.Event()
+        monitorThread = threading.Thread(target=self._monitor, args=(stopEvent,), daemon=True)
+        monitorThread.start()
+        try:
+            #rsync separates progress updates with carriage returns
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            pending = ""
+            fd = self._process.stdout.fileno()
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                pending += decoder.decode(data).replace("\r", "\n")
+                lines = pending.split("\n")
+                pending = lines.pop()
+                for line in lines:
+                    self._handleLine(line)
+
+            if pending:
+                self._handleLine(pending)
+
+            return self._process.wait()
+
+        finally:
+            stopEvent.set()
+            monitorThread.join()
+            if self._process.poll() is None:
+                os.killpg(self._process.pid, signal.SIGTERM)
+                self._process.wait()
+            self._process.stdout.close()
+
 class Backup(object):
     """Responsible for providing backup functionality"""
 
@@ -94,23 +470,54 @@ class Backup(object):
 
     RSYNC_CMD                       = "/usr/bin/rsync"
     SSH_CMD                         = "/usr/bin/ssh"
+    CP_CMD                          = "/bin/cp"
 
-    FULL_BACKUP_DIR_TEXT            = "FULL"
-    INCREMENTAL_BACKUP_DIR_TEXT     = "INCR"
+    FULL_BACKUP_DIR_TEXT            = SnapshotRecord.FULL_TEXT
+    INCREMENTAL_BACKUP_DIR_TEXT     = SnapshotRecord.INCR_TEXT
     BACKUP_SIZE_LOG_FILE            = "backup_size.log"
     BACKUP_LOG_FILE                 = "backup.log"
-    INCOMPLETE_BACKUP_SUFFIX        = "incomplete"
-    NOT_STARTED_BACKUP_SUFFIX       = "not_started"
+    INCOMPLETE_BACKUP_SUFFIX        = SnapshotRecord.INCOMPLETE_SUFFIX
+    NOT_STARTED_BACKUP_SUFFIX       = SnapshotRecord.NOT_STARTED_SUFFIX
     DEFAULT_CMD_LINE_OP_LOG_FILE    = "cmd-line-output.log"
     RSYNC_LOG_FILE                  = "rsync.log"
-
-    def __init__(self, uo, options):
+    SHARD_STATS_FILE                = "shard_stats.json"
+    TOP_LEVEL_FILES_SHARD           = "."
+    #The cost of a file relative to its size when balancing shards
+    SHARD_BYTES_PER_FILE            = 65536
+    #The folder in the dest path that holds pbackup's own files
+    META_DIR                        = ".pbackup"
+    CATALOG_FILE                    = "catalog.json"
+    TRASH_DIR                       = "trash"
+    USAGE_CACHE_DIR                 = "usage"
+    METRICS_HISTORY_FILE            = "backup_metrics.jsonl"
+    JOURNAL_DIR                     = "journal"
+    DEDUP_INDEX_FILE                = "dedup.sqlite"
+    MANIFEST_DIR                    = "manifests"
+    VERIFY_DB_FILE                  = "verify.sqlite"
+    EXCLUDE_FILE                    = "exclude"
+    #The maximum number of --link-dest arguments that rsync accepts
+    MAX_LINK_DEST                   = 20
+
+    PURGE_MODE_FOREGROUND           = "foreground"
+    PURGE_MODE_BACKGROUND           = "background"
+    PURGE_MODE_DEFERRED             = "deferred"
+    PURGE_MODES                     = (PURGE_MODE_FOREGROUND, PURGE_MODE_BACKGROUND, PURGE_MODE_DEFERRED)
+
+    def __init__(self, uo, options, replica=False):
         """@brief Constructor
            @param uo = User output object for notifying user of progress
            @param options = Command line options
+           @param replica = True if this copies a backup to another dest path (see _replicate())
            """
         self._uo        = uo
         self._options   = options
+        self._replica   = replica
+        self._catalog   = None
+        self._purgeEngine = None
+        self._runMetrics = None
+        self._emailNotifier = None
+        self._sshSession = None
+        self._replicaDestList = []
 
         self._checkOptions()
 
@@ -119,6 +526,9 @@ class Backup(object):
 
         showCmdLine = self._options.show_cmd_line
 
+        if self._options.email_timeout <= 0:
+            raise BackupError("The email timeout must be greater than 0.")
+
         if self._options.test_email:
             if not self._options.email_server:
                 raise BackupError("To test the email you must define the email server.")
@@ -130,22 +540,102 @@ class Backup(object):
         if showCmdLine:
             self.showCmdLine()
 
-        if self._options.src == None:
+        if self._options.src == None and not self._isQueryMode():
             raise BackupError("Please define the src path on the command line.")
 
         #If the src path exists but does not end /. / at the end of the path ensures we copy the dir contents
-        if  os.path.isdir(self._options.src) and not self._options.src.endswith("/"):
+        if  self._options.src and os.path.isdir(self._options.src) and not self._options.src.endswith("/"):
             self._options.src="{}/".format(self._options.src)
 
         if self._options.dest == None:
             raise BackupError("Please define the dest path on the command line.")
 
+        #The backup is made in the first dest path and then copied to the others
+        destList = [dest.strip() for dest in self._options.dest.split(",") if dest.strip()]
+        if not destList:
+            raise BackupError("Please define the dest path on the command line.")
+        if len(set(destList)) != len(destList):
+            raise BackupError("The same dest path is defined more than once.")
+        self._options = copy.copy(self._options)
+        self._options.dest = destList[0]
+        self._replicaDestList = destList[1:]
+
+        if self._isQueryMode() and not os.path.isdir(self._options.dest):
+            raise BackupError("{} path does not exist.".format(self._options.dest) )
+
         if self._options.max_full < 2:
             raise BackupError("The minimum number of full backups that you can set is 2.")
 
         if self._options.max_inc < 0:
             raise BackupError("The minimum number of incremental backups cannot be negative.")
 
+        for keepOption in ("keep_hourly", "keep_daily", "keep_weekly", "keep_monthly"):
+            if getattr(self._options, keepOption) < 0:
+                raise BackupError("The --{} value cannot be negative.".format(keepOption))
+
+        if self._options.parallel < 1:
+            raise BackupError("The minimum number of parallel rsync processes is 1.")
+
+        if self._options.purge_threads < 1:
+            raise BackupError("The minimum number of purge threads is 1.")
+
+        if self._options.archive_days < 0:
+            raise BackupError("The --archive_days value cannot be negative.")
+
+        if self._options.archive_threads < 1:
+            raise BackupError("The minimum number of archive threads is 1.")
+
+        if self._options.scan_threads < 1:
+            raise BackupError("The minimum number of scan threads is 1.")
+
+        if self._options.progress_interval < 0:
+            raise BackupError("The progress interval cannot be negative.")
+
+        if self._options.stall_timeout < 0:
+            raise BackupError("The stall timeout cannot be negative.")
+
+        if self._options.restore and not self._options.restore_to:
+            raise BackupError("Please define the folder to restore to using the --restore_to option.")
+
+        if self._options.restore_threads < 1:
+            raise BackupError("The minimum number of restore threads is 1.")
+
+        if self._options.dedup_threads < 1:
+            raise BackupError("The minimum number of dedup threads is 1.")
+
+        if self._options.dedup_min_size < 0:
+            raise BackupError("The minimum dedup file size cannot be negative.")
+
+        if self._options.verify_threads < 1:
+            raise BackupError("The minimum number of verify threads is 1.")
+
+        if self._options.verify_rate < 0:
+            raise BackupError("The verify rate cannot be negative.")
+
+        if self._options.verify_max_time < 0:
+            raise BackupError("The maximum verify time cannot be negative.")
+
+        if self._options.verify_src and not (self._options.src and os.path.isdir(self._options.src)):
+            raise BackupError("The --verify_src option requires a src folder on the local machine.")
+
+        if self._options.space_margin < 0:
+            raise BackupError("The space margin cannot be negative.")
+
+        if self._options.link_dest_depth < 1 or self._options.link_dest_depth > Backup.MAX_LINK_DEST:
+            raise BackupError("The link dest depth must be between 1 and {}.".format(Backup.MAX_LINK_DEST))
+
+        if self._options.checksum_every < 0:
+            raise BackupError("The checksum period cannot be negative.")
+
+        if self._options.checksum_every and not self._options.synthetic_full:
+            raise BackupError("The --checksum_every option requires the --synthetic_full option.")
+
+        if self._options.watch:
+            if self._options.ssh:
+                raise BackupError("Only a src path on the local machine can be watched.")
+            if not os.path.isdir(self._options.src):
+                raise BackupError("{} folder does not exist.".format(self._options.src))
+
         #Ensure local dest path exists
         if not os.path.isdir(self._options.dest):
             if self._options.disable_create_dest:
@@ -162,13 +652,26 @@ class Backup(object):
         if self._options.email_list and not self._options.email_server:
             raise BackupError("If the email list is defined then you must define the email server")
 
+        if self._options.log_max_size < 0:
+            raise BackupError("The maximum log file size cannot be negative.")
+
+        if self._options.log_backups < 0:
+            raise BackupError("The number of rotated log files to keep cannot be negative.")
+
         #If defined set the log file
         if self._options.log:
-            self._uo.setLog(self._options.log)
+            detailLog = self._options.log
         else:
             #set default log file
             detailLog = os.path.join(self._options.dest, Backup.DEFAULT_CMD_LINE_OP_LOG_FILE)
-            self._uo.setLog(detailLog)
+        self._uo.setLog(detailLog, maxBytes=self._options.log_max_size*1000000, backupCount=self._options.log_backups, background=self._options.log_background)
+
+        self._catalog = SnapshotCatalog(self._options.dest, os.path.join(self._getMetaDir(), Backup.CATALOG_FILE))
+        self._purgeEngine = PurgeEngine(self._uo, os.path.join(self._getMetaDir(), Backup.TRASH_DIR), threadCount=self._options.purge_threads)
+
+    def _isQueryMode(self):
+        """@return True if the user only wants information about the backups already in the dest path."""
+        return self._options.report or self._options.restore or self._options.versions or self._options.diff or self._options.verify
 
     def showCmdLine(self):
         """@brief show the command line. Useful when the user loaded the cmd line options from a file and
@@ -183,15 +686,32 @@ class Backup(object):
         if self._options.src_exclude:
             optionList.append( "--src_exclude {}".format(self._options.src_exclude) )
 
+        if self._options.exclude_junk:
+            optionList.append( "--exclude_junk {}".format(self._options.exclude_junk) )
+
+        if self._options.exclude_cachedir:
+            optionList.append( "--exclude_cachedir" )
+
         if self._options.log:
             optionList.append( "--log {}".format(self._options.log) )
 
+        optionList.append( "--log_max_size {}".format(self._options.log_max_size) )
+
+        optionList.append( "--log_backups {}".format(self._options.log_backups) )
+
+        if self._options.log_background:
+            optionList.append( "--log_background" )
+
         if self._options.max_full:
             optionList.append( "--max_full {}".format(self._options.max_full) )
 
         if self._options.max_inc:
             optionList.append( "--max_inc {}".format(self._options.max_inc) )
 
+        for keepOption in ("keep_hourly", "keep_daily", "keep_weekly", "keep_monthly"):
+            if getattr(self._options, keepOption):
+                optionList.append( "--{} {}".format(keepOption, getattr(self._options, keepOption)) )
+
         if self._options.email_list:
             optionList.append( "--email_list {}".format(self._options.email_list) )
 
@@ -210,6 +730,46 @@ class Backup(object):
         if self._options.post_script:
             optionList.append( "--post_script {}".format(self._options.post_script) )
 
+        if self._options.parallel > 1:
+            optionList.append( "--parallel {}".format(self._options.parallel) )
+
+        if self._options.link_dest_depth > 1:
+            optionList.append( "--link_dest_depth {}".format(self._options.link_dest_depth) )
+
+        if self._options.fuzzy:
+            optionList.append( "--fuzzy" )
+
+        if self._options.synthetic_full:
+            optionList.append( "--synthetic_full" )
+
+        if self._options.checksum_every:
+            optionList.append( "--checksum_every {}".format(self._options.checksum_every) )
+
+        if self._options.manifest:
+            optionList.append( "--manifest" )
+
+        if self._options.dedup:
+            optionList.append( "--dedup" )
+            optionList.append( "--dedup_threads {}".format(self._options.dedup_threads) )
+            optionList.append( "--dedup_min_size {}".format(self._options.dedup_min_size) )
+
+        optionList.append( "--purge_mode {}".format(self._options.purge_mode) )
+
+        optionList.append( "--purge_threads {}".format(self._options.purge_threads) )
+
+        if self._options.archive_days:
+            optionList.append( "--archive_days {}".format(self._options.archive_days) )
+            optionList.append( "--archive_compression {}".format(self._options.archive_compression) )
+            optionList.append( "--archive_threads {}".format(self._options.archive_threads) )
+
+        optionList.append( "--progress_interval {}".format(self._options.progress_interval) )
+
+        if self._options.stall_timeout:
+            optionList.append( "--stall_timeout {}".format(self._options.stall_timeout) )
+
+        if self._options.prom_textfile:
+            optionList.append( "--prom_textfile {}".format(self._options.prom_textfile) )
+
         if self._options.debug:
             optionList.append( "--debug {}".format(self._options.debug) )
 
@@ -228,7 +788,8 @@ class Backup(object):
                 raise BackupError("Failed to create dest path: {}".format(self._options.dest) )
 
     def _notifyEmail(self, subjectMessage, body=""):
-        """@brief Responsible for notifying the user of the backup progress via email
+        """@brief Responsible for notifying the user of the backup progress via email.
+                  The email is sent in the background so this returns immediately.
            @param subject The subject line of the notification email
            @param body The body text of the notification email"""
         if self._options.email_list:
@@ -236,7 +797,14 @@ class Backup(object):
             subject = "{}: '{}' {}".format(socket.gethostname(), backupSrc , subjectMessage)
             if self._options.email_server:
                 toList = self._options.email_list.split(",")
-                self._sendMail( self._options.email_server, self._options.email_username, self._options.email_password, toList, subject, body)
+                if self._emailNotifier is None:
+                    self._emailNotifier = EmailNotifier(self._uo, self._options.email_server, self._options.email_username, self._options.email_password, timeout=self._options.email_timeout, allowPlainLogin=self._options.email_allow_plain)
+                self._emailNotifier.send(toList, subject, body)
+
+    def _flushEmail(self):
+        """@brief Wait for the email notifications to be sent."""
+        if self._emailNotifier:
+            self._emailNotifier.flush()
 
     def _getFullBackupID(self, backupDest):
         """@brief Given a backup dir name, extract the full backup ID
@@ -260,50 +828,23 @@ class Backup(object):
 
         return fullNum
 
+    def _getMetaDir(self):
+        """@return The folder in the dest path that holds pbackup's own files."""
+        return os.path.join(self._options.dest, Backup.META_DIR)
+
     def _getLastFullBackup(self):
         """@brief Get the last full backup from the destination directory.
            @return The last full backup directory name or an empty string if no backup is present."""
-
-        backup=""
-        fullBackupID = -1
-
-        #Check for the latest backup
-        entryList = os.listdir(self._options.dest)
-
-        for entry in entryList:
-            #Get the last full complete backup
-            if entry.find(".{}".format(Backup.FULL_BACKUP_DIR_TEXT) ) != -1 and entry.find(Backup.INCOMPLETE_BACKUP_SUFFIX) == -1:
-
-                thisFullBackupID = self._getFullBackupID(entry)
-
-                if fullBackupID == -1:
-
-                    fullBackupID = thisFullBackupID
-                    backup = entry
-
-                elif fullBackupID < thisFullBackupID:
-
-                    fullBackupID = thisFullBackupID
-                    backup = entry
-
-        return backup
+        record = self._catalog.getLastFull()
+        if record:
+            return record.name
+        return ""
 
     def _getIncBackupList(self, fullBackupID):
         """@brief Get incremental backup list for the given full backup ID
            @param fullBackupID The fuill backup ID
            @return A list of incremental backups against the given full backup"""
-
-        incrBackupList = []
-
-        entryList = os.listdir(self._options.dest)
-
-        for entry in entryList:
-
-            #If this is the correct full backup and we have found an incremental backup
-            if entry.find(".{}_{}".format(Backup.FULL_BACKUP_DIR_TEXT, fullBackupID)) != -1 and entry.find(Backup.INCREMENTAL_BACKUP_DIR_TEXT) != -1:
-                incrBackupList.append(entry)
-
-        return incrBackupList
+        return [record.name for record in self._catalog.getIncrementals(fullBackupID)]
 
     def _getIncrBackupID(self, backupDest):
         """@brief Given a backup dir name, extract the incremental backup ID
@@ -333,27 +874,10 @@ class Backup(object):
         """@brief get the last incremental backup with the given full backup ID
            @param fullBackupID The full backup ID
            @return The last incremental backup ID for the given full backup or an empty string if not found"""
-
-        incrBackupList = self._getIncBackupList(fullBackupID)
-
-        backup=""
-        incrBackupID = -1
-
-        #Check for the latest backup
-        for entry in incrBackupList:
-
-            thisIncrBackupID = self._getIncrBackupID(entry)
-            if incrBackupID == -1:
-
-                incrBackupID = thisIncrBackupID
-                backup = entry
-
-            elif thisIncrBackupID > incrBackupID:
-
-                incrBackupID = thisIncrBackupID
-                backup = entry
-
-        return backup
+        recordList = self._catalog.getIncrementals(fullBackupID, completeOnly=True)
+        if recordList:
+            return recordList[-1].name
+        return ""
 
     def _getFullBackupDest(self, fullBackupID):
         """@brief get the full backup destination path"""
@@ -367,49 +891,6 @@ class Backup(object):
         backupDest = os.path.join(self._options.dest, "{}.{}_{}_{}_{}".format(timeStamp, Backup.FULL_BACKUP_DIR_TEXT, fullBackupID, Backup.INCREMENTAL_BACKUP_DIR_TEXT, incrBackupID) )
         return backupDest
 
-    def _sendMail(self, server, username, password, toList, subject, body):
-        """@brief Send an email via an SMTP server
-           @param server The server name (E.G smtp.gmail.com). This string can include the
-                         server port number if required (E.G smtp.gmail.com:587)
-           @param username The username to be used in order to log into the SMTP server
-           @param password The password to be used in order to log into the SMTP server
-           @param toList   A List of email addresses to send the email to
-           @param subject  The subject text line of the email
-           @param body     The body text of the email
-        """
-        if username or password:
-            if not username:
-                raise Exception("You have define the email server password but not the username.")
-            if not password:
-                raise Exception("You have define the email server username but not the password.")
-            
-        srcID = f"{getpass.getuser()}@{socket.gethostname()}"
-        srcID = "pausten.ge@gmail.com"
-        # Prepare actual message
-        message = """From: {}\nTo: {}\nSubject: {}\n\n{}
-        """.format(srcID, ", ".join(toList), subject, body)
-        try:
-            port = 587
-            if server.find(":") != -1:
-                elems = server.split(":")
-                server = elems[0]
-                port = int(elems[1])
-            server = smtplib.SMTP("smtp.gmail.com", port) #or port 465 doesn't seem to work!
-            server.ehlo()
-            server.starttls()
-            #If we have a username and password, login to the email server
-            if username and password:
-                server.login(username, password)
-            server.sendmail(username, toList, message)
-            server.close()
-            self._uo.info("SUBJECT: {}".format( subject ) )
-            self._uo.info("BODY:    {}".format( body ) )
-            self._uo.info("Sent email to {} as backup status notification".format( str(toList) ) )
-        except Exception as e:
-            #We dont throw an error here or any error send email notifications could
-            #break the backup process
-            self._uo.error( e )
-
     def _getBackupDest(self):
         """@brief Get the backup dir name
            @return a The backup destination path
@@ -470,46 +951,65 @@ class Backup(object):
 
     def renameBackup(self, fullBackupID):
         """@brief Rename all backups to have a full backup ID one lower than their current full backup ID"""
-        entryList = os.listdir(self._options.dest)
-        for entry in entryList:
-            fullBackupIDText = "{}_{}".format(Backup.FULL_BACKUP_DIR_TEXT, fullBackupID)
-            newFullBackupIDText = "{}_{}".format(Backup.FULL_BACKUP_DIR_TEXT, fullBackupID-1)
-            if entry.find(fullBackupIDText) != -1:
-                currentPath = os.path.join(self._options.dest, entry)
-                newPath     = os.path.join(self._options.dest, entry)
-                newPath     = newPath.replace(fullBackupIDText, newFullBackupIDText)
-                cmd = "mv {} {}".format(currentPath, newPath)
-                cmdOutput = check_output(cmd, shell=True, stderr=STDOUT)
-                self._uo.info(cmdOutput)
+        for record in self._catalog.getRecords():
+            if record.fullID == fullBackupID:
+                fullBackupIDText = ".{}_{}".format(Backup.FULL_BACKUP_DIR_TEXT, fullBackupID)
+                newFullBackupIDText = ".{}_{}".format(Backup.FULL_BACKUP_DIR_TEXT, fullBackupID-1)
+                newName     = record.name.replace(fullBackupIDText, newFullBackupIDText, 1)
+                currentPath = os.path.join(self._options.dest, record.name)
+                newPath     = os.path.join(self._options.dest, newName)
+                os.rename(currentPath, newPath)
+                self._catalog.rename(record.name, newName)
                 self._uo.info("Renamed {} as {}".format(currentPath, newPath) )
 
     def _getFullBackupCount(self):
         """@brief Get the number of full backups currently stored in the dest location"""
-
-        fullBackupCount = 0
-
-        entryList = os.listdir(self._options.dest)
-        for entry in entryList:
-            #If this is a full backup path
-            if entry.find(".{}_".format(Backup.FULL_BACKUP_DIR_TEXT) ) != -1 and entry.find("_{}_".format(Backup.INCREMENTAL_BACKUP_DIR_TEXT) ) == -1:
-                fullBackupCount=fullBackupCount+1
-
-        return fullBackupCount
+        return self._catalog.getFullCount()
 
     def _getBackupList(self):
         """@brief Return a list of all full and incremental backups that are stored, sorted into date order"""
+        return [record.name for record in self._catalog.getRecords()]
+
+    def _removeBackups(self, recordList):
+        """@brief Remove backup folders from the dest path by moving them into the trash folder.
+                  They are deleted when the trash folder is emptied.
+           @param recordList The SnapshotRecord instances of the backups to remove."""
+        for record in recordList:
+            trashPath = self._purgeEngine.moveToTrash( os.path.join(self._options.dest, record.name) )
+            self._catalog.remove(record.name)
+            self._uo.info("Moved {} to {}".format(record.name, trashPath))
+
+    def _emptyTrash(self):
+        """@brief Delete the backups that have been purged as defined by the purge mode."""
+        if self._purgeEngine.isTrashEmpty():
+            return
 
-        fullBackupList = []
+        if self._options.purge_mode == Backup.PURGE_MODE_FOREGROUND:
+            self._uo.info("Deleting purged backups. Please wait...")
+            self._purgeEngine.emptyTrash()
 
-        entryList = os.listdir(self._options.dest)
-        for entry in entryList:
+        elif self._options.purge_mode == Backup.PURGE_MODE_BACKGROUND:
+            self._uo.info("Deleting purged backups in the background.")
+            self._purgeEngine.start()
 
-            if entry.find(".{}_".format(Backup.FULL_BACKUP_DIR_TEXT) ) != -1:
-                fullBackupList.append(entry)
+        else:
+            self._uo.info("Purged backups will be deleted during the next backup.")
 
-        fullBackupList.sort()
+    def _finishPurge(self):
+        """@brief Called at the end of a backup to wait for any purged backups being deleted in the background."""
+        if not self._purgeEngine:
+            return
 
-        return fullBackupList
+        try:
+            if self._options.purge_mode == Backup.PURGE_MODE_DEFERRED:
+                #Leave what has not been deleted until the next backup
+                self._purgeEngine.stop()
+            else:
+                self._purgeEngine.wait()
+
+        except Exception as e:
+            #The backup itself has completed so this is not a backup failure
+            self._uo.error("Failed to delete purged backups: {}".format(e))
 
     def _purgeBackups(self):
         """@brief A maximum number of full backups is defined. This ensure that we don't keep
@@ -520,112 +1020,330 @@ class Backup(object):
         if os.path.isfile(oldBackupLogFile):
             os.remove(oldBackupLogFile)
 
-        backupList = self._getBackupList()
-        fullBackupID = self._getFullBackupID(backupList[0])
+        purgeIDList = self._getPurgeFullBackupIDList( self._catalog.getRecords() )
 
-        if self._getFullBackupCount()  > self._options.max_full:
+        if purgeIDList:
             self._uo.info("Purging old backups.")
 
-        while self._getFullBackupCount()  > self._options.max_full:
+        for fullBackupID in purgeIDList:
+            self._removeFullBackupSet(self._catalog.getRecords(), fullBackupID)
+
+        self._thinBackups()
+
+        self._archiveBackups()
+
+        self._emptyTrash()
+
+    def _getRetention(self):
+        """@return A GFSRetention instance for the --keep_* options."""
+        return GFSRetention(hourly=self._options.keep_hourly,
+                            daily=self._options.keep_daily,
+                            weekly=self._options.keep_weekly,
+                            monthly=self._options.keep_monthly)
+
+    def _thinBackups(self):
+        """@brief Remove the incremental backups that are not kept by the --keep_hourly, --keep_daily,
+                  --keep_weekly and --keep_monthly options. Full backups and archived backups (which
+                  may hold the files of other archives in their set) are only removed by --max_full."""
+        retention = self._getRetention()
+        if not retention.isEnabled():
+            return
+
+        recordList = [record for record in self._catalog.getRecords() if record.isComplete() or record.isArchived()]
+        keepDict = retention.getKeepDict(recordList)
+        removeList = [record for record in recordList if not record.isFull() and not record.isArchived() and record.name not in keepDict]
+        if removeList:
+            self._uo.info("Removing {} incremental backups not kept by the --keep_* options.".format(len(removeList)))
+            self._removeBackups(removeList)
+        #_purgeBackups() may be called outside a backup run (E.G by pbackup-benchmark)
+        if self._runMetrics:
+            self._runMetrics.set("thinned_backups", len(removeList))
+
+    def _archiveBackups(self):
+        """@brief Pack the complete backups older than --archive_days into archive folders. Backups
+                  in the latest full backup set are not archived as the next backup may hard link
+                  files from them. Files already held by an archive of the same full backup set are
+                  not stored again. The backup has completed so a failure here is reported but does
+                  not fail the backup."""
+        if not self._options.archive_days:
+            return
+
+        recordList = self._catalog.getRecords()
+        if not recordList:
+            return
+
+        lastFullBackupID = max([record.fullID for record in recordList])
+        archiveTime = time.time() - self._options.archive_days*86400
+        archiveList = [record for record in recordList if record.isComplete() and record.fullID < lastFullBackupID and record.timeStamp is not None and record.timeStamp < archiveTime]
 
-            arg = os.path.join(self._options.dest, "*.FULL_{}".format(fullBackupID))
-            self._uo.info("Removing full backup {}. Please wait...".format(fullBackupID))
-            cmd = "rm -rf {}".format(arg)
-            cmdOutput = check_output(cmd, shell=True, stderr=STDOUT)
-            if cmdOutput is not None and len(cmdOutput):
-                self._uo.info(cmdOutput.decode())
+        archivedCount = 0
+        archiveBytes = 0
+        try:
+            #Remove archives that were not completed and will not be continued
+            for entryName in os.listdir(self._options.dest):
+                if entryName.endswith(SnapshotArchiver.TMP_SUFFIX) and SnapshotRecord.Parse(entryName[:-len(SnapshotArchiver.TMP_SUFFIX)]):
+                    self._purgeEngine.moveToTrash( os.path.join(self._options.dest, entryName) )
+
+            archiver = SnapshotArchiver(self._uo, threadCount=self._options.archive_threads, compression=self._options.archive_compression)
+            for record in archiveList:
+                archiveName = "{}.{}".format(record.name, SnapshotRecord.ARCHIVED_SUFFIX)
+                backupPath = os.path.join(self._options.dest, record.name)
+                linkArchivePathList = [os.path.join(self._options.dest, setRecord.name) for setRecord in self._catalog.getRecords() if setRecord.isArchived() and setRecord.fullID == record.fullID]
+
+                #The backup folder is only removed once the archive is complete
+                requiredBytes = int( archiver.getStoreBytes(backupPath, linkArchivePathList)*(100+self._options.space_margin)/100 )
+                freeBytes = DiskUsage(self._options.dest).getFreeBytes()
+                if freeBytes < requiredBytes:
+                    self._uo.warn("Not enough disk space in {} to archive {}. {:.3f} GB is free and up to {:.3f} GB is required.".format(self._options.dest, record.name, freeBytes/(2**30), requiredBytes/(2**30)))
+                    break
+
+                self._uo.info("Archiving {}. Please wait...".format(record.name))
+                _, _, packedBytes = archiver.pack(backupPath, os.path.join(self._options.dest, archiveName), linkArchivePathList=linkArchivePathList)
+                self._purgeEngine.moveToTrash( os.path.join(self._options.dest, record.name) )
+                self._catalog.rename(record.name, archiveName)
+                archivedCount = archivedCount + 1
+                archiveBytes = archiveBytes + packedBytes
 
-            self._uo.info("Removing {} incremental backups. Please wait...".format(fullBackupID))
-            arg = os.path.join(self._options.dest, "*.FULL_{}_*".format(fullBackupID))
-            cmd = "rm -rf {}".format(arg)
-            cmdOutput = check_output(cmd, shell=True, stderr=STDOUT)
-            if cmdOutput is not None and len(cmdOutput):
-                self._uo.info(cmdOutput.decode())
+        except Exception as e:
+            self._uo.error("Failed to archive old backups: {}".format(e))
+
+        #_purgeBackups() may be called outside a backup run (E.G by pbackup-benchmark)
+        if self._runMetrics:
+            self._runMetrics.set("archived_backups", archivedCount)
+            self._runMetrics.set("archive_bytes", archiveBytes)
+
+    def _getPurgeFullBackupIDList(self, recordList):
+        """@brief Get the full backup sets that are removed so that no more than --max_full full
+                  backup folders (complete, incomplete or archived) are kept. The oldest sets are
+                  removed first.
+           @param recordList The records of the backups in the dest path, sorted into the order they were created.
+           @return A list of full backup IDs, oldest first."""
+        fullBackupCount = len([record for record in recordList if record.isFull()])
+        purgeIDList = []
+        for fullBackupID in sorted(set([record.fullID for record in recordList])):
+            if fullBackupCount <= self._options.max_full:
+                break
+            purgeIDList.append(fullBackupID)
+            fullBackupCount = fullBackupCount - len([record for record in recordList if record.fullID == fullBackupID and record.isFull()])
+        return purgeIDList
+
+    def _removeFullBackupSet(self, recordList, fullBackupID):
+        """@brief Remove a full backup and its incremental backups.
+           @param recordList The records of all the backups in the dest path.
+           @param fullBackupID The ID of the full backup.
+           @return The number of full backup folders removed."""
+        self._uo.info("Removing full backup {}. Please wait...".format(fullBackupID))
+        fullRecordList = [record for record in recordList if record.fullID == fullBackupID and record.isFull()]
+        self._removeBackups(fullRecordList)
+
+        self._uo.info("Removing {} incremental backups. Please wait...".format(fullBackupID))
+        self._removeBackups([record for record in recordList if record.fullID == fullBackupID and not record.isFull()])
+
+        return len(fullRecordList)
+
+    def _checkSpace(self, backupDest):
+        """@brief Predict the disk space this backup will use from earlier backups. If there is
+                  not enough free space the backups that would be purged once this backup
+                  completes are purged now. If there is still not enough free space the backup
+                  is not started rather than failing when the disk is full.
+           @param backupDest The path of the backup about to start."""
+        record = SnapshotRecord.Parse( os.path.basename(backupDest) )
+        if not record.isFull():
+            backupType = SpaceForecaster.TYPE_INCREMENTAL
+        elif self._getSyntheticFullPath():
+            backupType = SpaceForecaster.TYPE_SYNTHETIC_FULL
+        else:
+            backupType = SpaceForecaster.TYPE_FULL
 
-            fullBackupID = fullBackupID + 1
+        forecaster = SpaceForecaster( RunMetrics.LoadHistory( self._getMetricsHistoryFile() ) )
+        expectedBytes = forecaster.getExpectedBytes(backupType)
+        if expectedBytes is None:
+            self._uo.info("No earlier {} backups to predict the disk space this backup will use from.".format(backupType))
+            return
+
+        requiredBytes = int( expectedBytes*(100+self._options.space_margin)/100 )
+        self._runMetrics.set("forecast_bytes", requiredBytes)
+        freeBytes = DiskUsage(self._options.dest).getFreeBytes()
+        self._uo.info("This {} backup is expected to use {:.3f} GB. {:.3f} GB is free.".format(backupType, requiredBytes/(2**30), freeBytes/(2**30)))
+        if freeBytes >= requiredBytes:
+            return
+
+        try:
+            #Wait for the backups purged previously to be deleted
+            self._purgeEngine.wait()
+        except Exception as e:
+            self._uo.error("Failed to delete purged backups: {}".format(e))
+
+        #The full backup sets that _purgeBackups() will remove once this backup completes
+        recordList = self._catalog.getRecords()
+        if record.isFull():
+            recordList.append(record)
+        purgeIDList = self._getPurgeFullBackupIDList(recordList)
+        if purgeIDList:
+            self._uo.info("Purging old backups now to free disk space for this backup.")
+            for fullBackupID in purgeIDList:
+                self._removeFullBackupSet(self._catalog.getRecords(), fullBackupID)
+            self._runMetrics.set("forecast_purged_sets", len(purgeIDList))
+
+        self._purgeEngine.emptyTrash()
+
+        freeBytes = DiskUsage(self._options.dest).getFreeBytes()
+        if freeBytes < requiredBytes:
+            raise BackupError("Not enough disk space in {} for this backup. {:.3f} GB is free and the backup is expected to use {:.3f} GB. The backup was not started.".format(self._options.dest, freeBytes/(2**30), requiredBytes/(2**30)))
 
     def _getFullBackupPath(self, backupPath):
         """@brief Get the full backup path associated with this backup path.
            @param backupPath Could hold a full or incremental backup path.
                   Incremental backup paths contain the name of the associated
                   full backup path with the incremental backup ID added
-           @return The Full backup path"""
+           @return The Full backup path or None if the full backup is not present"""
 
-        #If backupPath is a full backup path
-        fullBackupIDPos = backupPath.find(".{}_".format(Backup.FULL_BACKUP_DIR_TEXT) )
+        record = SnapshotRecord.Parse( os.path.basename(backupPath) )
+        if record is None:
+            raise BackupError("{} is not a valid backup path".format(backupPath) )
 
-        if fullBackupIDPos != -1 and backupPath.find("_{}_".format(Backup.INCREMENTAL_BACKUP_DIR_TEXT)) == -1:
+        #If backupPath is a full backup path
+        if record.isFull():
             return backupPath
 
-        #Extract the full backup ID
-        if fullBackupIDPos > 0:
-            elems = backupPath[fullBackupIDPos:].split("_")
-            fullBackupIDStr = elems[1]
-            try:
-                fullBackupID = int(fullBackupIDStr)
-            except:
-                raise BackupError("{} is not a valid full backup ID extracted from {}".format(fullBackupIDStr, backupPath) )
-
-            entryList = os.listdir(self._options.dest)
-            for entry in entryList:
-                if entry.endswith("{}_{}".format(Backup.FULL_BACKUP_DIR_TEXT, fullBackupID) ):
-                    return os.path.join(self._options.dest, entry)
+        fullRecord = self._catalog.getFull(record.fullID)
+        if fullRecord:
+            return os.path.join(self._options.dest, fullRecord.name)
 
-        else:
-            raise BackupError("{} is not a valid backup path".format(backupPath) )
+        return None
 
     def _getLastBackupPath(self, backupDest):
         """@brief Get the path of the last backup"""
 
+        record = SnapshotRecord.Parse( os.path.basename(backupDest) )
+        if record is None:
+            raise BackupError("{} is not a full or incremental backup path ???".format(backupDest) )
+
         #Get the full backup path associated with this backup
         lastFullBackup = self._getFullBackupPath(backupDest)
 
         #Check if the last backup we had was a full backup
-        pos = backupDest.find("_{}_".format(Backup.INCREMENTAL_BACKUP_DIR_TEXT) )
+        if record.isFull() or record.incrID <= 1:
+            return lastFullBackup
 
-        if pos == -1:
+        #Search for the previous incremental backup against the same full backup. Incremental
+        #backups may have been removed by the --keep_* options so the IDs may not be contiguous.
+        lastRecord = None
+        for incrRecord in self._catalog.getIncrementals(record.fullID, completeOnly=True):
+            if incrRecord.incrID < record.incrID:
+                lastRecord = incrRecord
 
-            #If this is a full backup path
-            if backupDest.find(".{}_".format(Backup.FULL_BACKUP_DIR_TEXT) ) != -1:
+        #If we found the incremental backup
+        if lastRecord:
+            #Build full backup path
+            lastBackupPath = os.path.join(self._options.dest, lastRecord.name)
+        else:
+            #Use last full backup
+            lastBackupPath = lastFullBackup
 
-                #If so then return this backup
-                return lastFullBackup
+        return lastBackupPath
 
+    def _getLinkDestChain(self, backupDest, lastBackupPath):
+        """@brief Get the backups that rsync hard links unchanged files from. A file that is not
+                  in the last backup (E.G it was deleted and then restored) may be in an older backup.
+           @param backupDest The path of the backup about to start.
+           @param lastBackupPath The path of the backup that rsync compares the src path with first.
+           @return A list of up to --link_dest_depth backup paths, most recent first. An incremental
+                   backup always includes its full backup."""
+        linkDestList = [lastBackupPath]
+        if self._options.link_dest_depth < 2:
+            return linkDestList
+
+        record = SnapshotRecord.Parse( os.path.basename(backupDest) )
+        recordList = self._catalog.getRecords(completeOnly=True)
+        fullBackupPath = None
+        if not record.isFull():
+            #Incremental backups only link to backups in their own set so purging a set frees its space
+            recordList = [setRecord for setRecord in recordList if setRecord.fullID == record.fullID]
+            fullBackupPath = self._getFullBackupPath(backupDest)
+
+        for linkRecord in reversed(recordList):
+            if len(linkDestList) >= self._options.link_dest_depth:
+                break
+            linkDestPath = os.path.join(self._options.dest, linkRecord.name)
+            if linkDestPath not in linkDestList:
+                linkDestList.append(linkDestPath)
+
+        if fullBackupPath and fullBackupPath not in linkDestList:
+            if len(linkDestList) >= self._options.link_dest_depth:
+                linkDestList[-1] = fullBackupPath
             else:
+                linkDestList.append(fullBackupPath)
 
-                raise BackupError("{} is not a full or incremental backup path ???".format(backupDest) )
+        return linkDestList
 
-        #Extract the incremental backup number
-        incNumStr = backupDest[pos+6:]
-        incNumStr.rstrip("\r")
-        incNumStr.rstrip("\n")
+    def _reportLinkDest(self, backupDest, linkDestList):
+        """@brief Report the data that was hard linked from the older backups in the link-dest chain
+                  rather than copied. The backup is complete so a failure here is reported but does
+                  not fail the backup.
+           @param backupDest The path of the backup.
+           @param linkDestList The backup paths passed to rsync with --link-dest."""
         try:
+            linkedList = LinkDestReport(backupDest, linkDestList).getLinkedBytes()
+            extraFileCount = sum([fileCount for fileCount, _ in linkedList[1:]])
+            extraBytes = sum([linkedBytes for _, linkedBytes in linkedList[1:]])
+            self._runMetrics.set("link_dest_count", len(linkDestList))
+            self._runMetrics.set("link_dest_extra_files", extraFileCount)
+            self._runMetrics.set("link_dest_extra_bytes", extraBytes)
+            self._uo.info("{} files ({:.3f} GB) not in {} were hard linked from older backups rather than copied.".format(extraFileCount, extraBytes/(2**30), os.path.basename(linkDestList[0])))
+
+        except Exception as e:
+            self._uo.error("Failed to read the files hard linked to {}: {}".format(backupDest, e))
 
-            incNum = int(incNumStr)
+    def _getSyntheticFullPath(self):
+        """@return The path of the backup that a synthetic full backup hard links unchanged files from
+                   or None if synthetic full backups are not enabled or there are no complete backups."""
+        if not self._options.synthetic_full:
+            return None
 
-        except ValueError:
-            raise BackupError("Failed to extract the incremental backup number from {}".format(backupDest) )
+        recordList = self._catalog.getRecords(completeOnly=True)
+        if not recordList:
+            return None
 
-        if incNum > 0:
-            incNum = incNum -1
+        return os.path.join(self._options.dest, recordList[-1].name)
 
-        #Search for this incremental backup
-        lastBackupPath = None
-        entryList = os.listdir(self._options.dest)
-        for entry in entryList:
-            if entry.endswith("_{}_{}".format(Backup.INCREMENTAL_BACKUP_DIR_TEXT, incNum)):
-                lastBackupPath = entry
-                break
+    def _isChecksumBackup(self, backupDest):
+        """@brief Determine if rsync should compare the contents of every file rather than the size and modification time.
+           @param backupDest The path of the full backup.
+           @return True if this is every --checksum_every full backup."""
+        if self._options.checksum_every <= 0:
+            return False
+
+        record = SnapshotRecord.Parse( os.path.basename(backupDest) )
+        return record is not None and record.fullID % self._options.checksum_every == 0
+
+    def _getSshTarget(self):
+        """@brief Get the remote machine from the --ssh option.
+           @return A tuple containing the username, host name and ssh port (None if not defined)."""
+        hostName = self._options.ssh
+
+        username=getpass.getuser()
+
+        #Get the username if supplied by the user
+        elems = hostName.split("@")
+
+        if len(elems) == 2:
+            username = elems[0]
+            hostName=hostName[len(username)+1:]
+
+        sshPort = None
+        elems = hostName.split(":")
+        if len(elems) == 2:
+            sshPort = int(elems[1])
+            hostName = elems[0]
+
+        elif len(elems) == 1:
+            hostName = elems[0]
 
-        #If we found the incremental backup
-        if lastBackupPath:
-            #Build full backup path
-            lastBackupPath = os.path.join(self._options.dest, lastBackupPath)
         else:
-            #Use last full backup
-            lastBackupPath = lastFullBackup
+            raise BackupError("{} is an invalid ssh server (E.G server or username@server or username@server:22)".format(hostName))
 
-        return lastBackupPath
+        return (username, hostName, sshPort)
 
     def _getSrc(self):
         """@brief Get the backup src string.
@@ -638,27 +1356,7 @@ class Backup(object):
         if self._options.ssh:
 
             #Build src string from user input
-            hostName = self._options.ssh
-
-            username=getpass.getuser()
-
-            #Get the username if supplied by the user
-            elems = hostName.split("@")
-
-            if len(elems) == 2:
-                username = elems[0]
-                hostName=hostName[len(username)+1:]
-
-            elems = hostName.split(":")
-            if len(elems) == 2:
-                sshPort = int(elems[1])
-                hostName = elems[0]
-
-            elif len(elems) == 1:
-                hostName = elems[0]
-
-            else:
-                raise BackupError("{} is an invalid ssh server (E.G server or username@server or username@server:22)".format(hostName))
+            username, hostName, sshPort = self._getSshTarget()
 
             backupSrc = "{}@{}:{}".format(username, hostName, self._options.src)
 
@@ -669,37 +1367,250 @@ class Backup(object):
 
     def _getBackupsToday(self):
         """@brief Get the number of backups that have been created today"""
-        backupsToday = 0
-
         dayStamp = time.strftime("%Y-%b-%d_", time.gmtime())
-
-        entryList = os.listdir(self._options.dest)
-        for entry in entryList:
-            if entry.find(dayStamp) != -1:
-                backupsToday=backupsToday+1
-
-        return backupsToday
+        return self._catalog.getCount(dayStamp)
 
     def _addExclusions(self, cmd):
-        """@brief Check any user defined exclusion patterns.
+        """@brief Check any user defined exclusion patterns and write all the exclusion patterns
+                  to a file that rsync reads.
            @param cmd The rsync command thus far.
            @return The rsync command with exclusions."""
+        exclusionCompiler = ExclusionCompiler(self._options.src)
+
         #If the user has defined an exclusion pattern
         if self._options.src_exclude:
-            exludePatternList  = self._options.src_exclude.split(",")
-            for exludePattern in exludePatternList:
-                if exludePattern.startswith(self._options.src):
-                    exludePattern = exludePattern.replace(self._options.src, "")
-                # If exclude pattern does not contain a wildcard character.
-                if exludePattern.find("*") == -1:
-                    # Check that it's an existing file or folder.
-                    fullPath = os.path.join(self._options.src, exludePattern)
-                    if not os.path.isdir(fullPath) and not os.path.isfile(fullPath):
-                        raise Exception(f"Failed to exclude {fullPath} as path/file not found.")
+            patternList = [exclusionCompiler.add(exludePattern) for exludePattern in self._options.src_exclude.split(",")]
+            #Paths on a remote machine cannot be checked
+            if not self._options.ssh:
+                # Check that the patterns without wildcard characters are existing files or folders.
+                missingList = ExclusionCompiler.GetMissingPaths(self._options.src, [pattern for pattern in patternList if pattern])
+                if missingList:
+                    raise Exception("Failed to exclude {} as path/file not found.".format(", ".join(missingList)))
+
+        if self._options.exclude_junk:
+            for name in self._options.exclude_junk.split(","):
+                exclusionCompiler.addFolderName(name)
+
+        if self._options.exclude_cachedir:
+            if self._options.ssh or not os.path.isdir(self._options.src):
+                self._uo.warn("--exclude_cachedir is only supported when the src is a local folder.")
+            else:
+                cacheDirList = exclusionCompiler.addCacheDirs(threadCount=self._options.scan_threads)
+                self._runMetrics.set("cache_dirs_excluded", len(cacheDirList))
+                for cacheDir in cacheDirList:
+                    self._uo.info("Excluding the {} cache folder.".format(cacheDir))
+
+        if not exclusionCompiler.getPatterns():
+            return cmd
+
+        if not os.path.isdir(self._getMetaDir()):
+            os.makedirs(self._getMetaDir())
+        excludeFile = os.path.join(self._getMetaDir(), Backup.EXCLUDE_FILE)
+        exclusionCompiler.write(excludeFile)
+        return "{} --exclude-from={}".format(cmd, shlex.quote(excludeFile))
+
+    def _isParallelBackup(self):
+        """@brief Determine if the backup should be split into shards that are backed up in parallel.
+           @return True if more than one rsync process should be used."""
+        if self._options.parallel < 2:
+            return False
+
+        if self._options.ssh or not os.path.isdir(self._options.src):
+            self._uo.warn("--parallel is only supported when the src is a local folder. A single rsync process will be used.")
+            return False
+
+        return True
+
+    def _getShardStatsFile(self):
+        """@return The file holding the size of each shard from the previous parallel backup."""
+        return os.path.join(self._options.dest, Backup.SHARD_STATS_FILE)
+
+    def _loadShardStats(self):
+        """@brief Load the number of files and bytes in each shard from the previous parallel backup.
+           @return A dict. Each key is a shard name and each value is a dict with files and bytes keys."""
+        shardStats = {}
+        shardStatsFile = self._getShardStatsFile()
+        if os.path.isfile(shardStatsFile):
+            try:
+                with open(shardStatsFile, 'r') as fd:
+                    shardStats = json.load(fd)
+            except ValueError:
+                self._uo.warn("Ignoring corrupt {} file.".format(shardStatsFile))
+
+        return shardStats
+
+    def _saveShardStats(self, shardStats):
+        """@brief Save the number of files and bytes in each shard so that the next parallel backup can balance the shards.
+           @param shardStats A dict. Each key is a shard name and each value is a dict with files and bytes keys."""
+        shardStatsFile = self._getShardStatsFile()
+        tmpFile = "{}.tmp".format(shardStatsFile)
+        with open(tmpFile, 'w') as fd:
+            json.dump(shardStats, fd)
+        os.replace(tmpFile, shardStatsFile)
+
+    def _getShardList(self):
+        """@brief Split the src path into shards. Each top level folder is a shard and all
+                  the other top level entries (files, links, etc) are held in one more shard.
+           @return A list of shard names with the largest (from the previous backup) first."""
+        shardList = []
+        hasTopLevelFiles = False
+        with os.scandir(self._options.src) as entryIter:
+            for entry in entryIter:
+                if entry.is_dir(follow_symlinks=False):
+                    shardList.append(entry.name)
+                else:
+                    hasTopLevelFiles = True
+
+        if hasTopLevelFiles:
+            shardList.append(Backup.TOP_LEVEL_FILES_SHARD)
+
+        shardStats = self._loadShardStats()
+        weightDict = {}
+        for shard in shardList:
+            if shard in shardStats:
+                weightDict[shard] = shardStats[shard]["bytes"] + shardStats[shard]["files"]*Backup.SHARD_BYTES_PER_FILE
+
+        #Shards not seen in the previous backup are given the average weight
+        defaultWeight = 0
+        if weightDict:
+            defaultWeight = sum(weightDict.values())/len(weightDict)
+
+        #Starting the largest shards first keeps the workers evenly loaded until the end
+        shardList.sort(key=lambda shard: (-weightDict.get(shard, defaultWeight), shard))
+        return shardList
+
+    def _backupShard(self, cmd, shard, incompleteBackupDest):
+        """@brief Run the rsync process for one shard.
+           @param cmd The rsync command without the src and dest arguments.
+           @param shard The shard name.
+           @param incompleteBackupDest The path the backup is being written to.
+           @return A tuple containing the rsync exit code and the RsyncRunner instance."""
+        if shard == Backup.TOP_LEVEL_FILES_SHARD:
+            #Only copy the entries at the top level of the src path
+            shardCmd = "{} --exclude='*/' {} {}/".format(cmd, shlex.quote(self._options.src), shlex.quote(incompleteBackupDest))
 
-                cmd="{} --exclude {}".format(cmd, exludePattern)
+        else:
+            shardCmd = "{} {} {}/".format(cmd, shlex.quote(os.path.join(self._options.src, shard)), shlex.quote(incompleteBackupDest))
+
+        self._uo.info("RSYNC CMD: {}".format(shardCmd) )
+
+        rsyncRunner = self._getRsyncRunner(shardCmd, prefix="[{}] ".format(shard))
+        exitCode = rsyncRunner.run()
+        return (exitCode, rsyncRunner)
+
+    def _getRsyncRunner(self, cmd, prefix=""):
+        """@brief Get an RsyncRunner instance to run an rsync command.
+           @param cmd The rsync command.
+           @param prefix Text added to the start of every line of rsync output reported.
+           @return The RsyncRunner instance."""
+        return RsyncRunner(self._uo, cmd, progressInterval=self._options.progress_interval, stallTimeout=self._options.stall_timeout, prefix=prefix)
+
+    def _doSingleBackup(self, cmd):
+        """@brief Run a single rsync process to perform the backup.
+           @param cmd The complete rsync command.
+           @return The RsyncStats instance holding the stats reported by rsync."""
+        rsyncRunner = self._getRsyncRunner(cmd)
+        exitCode = rsyncRunner.run()
+        if rsyncRunner.isStalled():
+            raise BackupError("rsync made no progress for {} seconds and was stopped.".format(self._options.stall_timeout) )
+
+        if exitCode != 0:
+            raise BackupError("rsync failed (exit code = {}).\n{}".format(exitCode, "\n".join(rsyncRunner.getLastLines())) )
+
+        return rsyncRunner.getStats()
+
+    def _doParallelBackup(self, cmd, incompleteBackupDest):
+        """@brief Backup the src path using several rsync processes at the same time.
+           @param cmd The rsync command without the src and dest arguments.
+           @param incompleteBackupDest The path the backup is being written to.
+           @return An RsyncStats instance holding the total of the stats reported by all the rsync processes."""
+        shardList = self._getShardList()
+
+        self._uo.info("Backing up {} shards using {} rsync processes.".format(len(shardList), self._options.parallel) )
+
+        #Create the dest folder before the rsync processes start so they do not race to create it
+        os.makedirs(incompleteBackupDest, exist_ok=True)
+
+        failedShardList = []
+        shardStats = {}
+        totalRsyncStats = RsyncStats()
+        with ThreadPoolExecutor(max_workers=self._options.parallel) as executor:
+            futureDict = {}
+            for shard in shardList:
+                futureDict[shard] = executor.submit(self._backupShard, cmd, shard, incompleteBackupDest)
+
+            for shard in shardList:
+                try:
+                    exitCode, rsyncRunner = futureDict[shard].result()
+                    rsyncStats = rsyncRunner.getStats()
+                except Exception as e:
+                    self._uo.error("[{}] {}".format(shard, e))
+                    exitCode, rsyncRunner, rsyncStats = (-1, None, RsyncStats())
+
+                if exitCode == 0:
+                    totalRsyncStats.add(rsyncStats)
+                    shardStats[shard] = {"files": rsyncStats.get(RsyncStats.NUMBER_OF_FILES),
+                                         "bytes": rsyncStats.get(RsyncStats.TOTAL_FILE_SIZE)}
+                    self._uo.info("Shard {} complete ({} files, {} bytes).".format(shard, shardStats[shard]["files"], shardStats[shard]["bytes"]) )
 
-        return cmd
+                else:
+                    failedShardList.append( (shard, exitCode) )
+                    if rsyncRunner and rsyncRunner.isStalled():
+                        self._uo.error("Shard {} stalled and was stopped.".format(shard) )
+                    else:
+                        self._uo.error("Shard {} failed (rsync exit code = {}).".format(shard, exitCode) )
+
+        if failedShardList:
+            raise BackupError("{} of {} shards failed: {}".format(len(failedShardList), len(shardList), ", ".join(["{} (exit code {})".format(shard, exitCode) for shard, exitCode in failedShardList])) )
+
+        #The shards add entries to the top level folder after its timestamps were set
+        srcStat = os.stat(self._options.src)
+        os.utime(incompleteBackupDest, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
+
+        self._saveShardStats(shardStats)
+
+        return totalRsyncStats
+
+    def _getJournal(self):
+        """@return A ChangeJournal instance if the src path has been watched for changes or None if not."""
+        #The journal of a replica dest path (if any) was not recorded for the backup being copied
+        if self._options.ssh or self._replica:
+            return None
+
+        journalDir = os.path.join(self._getMetaDir(), Backup.JOURNAL_DIR)
+        if not os.path.isdir(journalDir):
+            return None
+
+        return ChangeJournal(journalDir, self._options.src)
+
+    def _doJournalBackup(self, cmd, journal, pathList, lastBackupPath, incompleteBackupDest):
+        """@brief Backup only the paths that the change journal holds. Everything else is hard linked from the last backup.
+           @param cmd The rsync command without the src and dest arguments.
+           @param journal The ChangeJournal instance.
+           @param pathList The changed paths returned by ChangeJournal.beginBackup().
+           @param lastBackupPath The path of the last backup.
+           @param incompleteBackupDest The path the backup is being written to.
+           @return The RsyncStats instance holding the stats reported by rsync."""
+        self._uo.info("{} paths have changed since the last backup (from the change journal).".format(len(pathList)))
+
+        #Start with a copy of the last backup in which every file is a hard link
+        check_output([Backup.CP_CMD, "-al", lastBackupPath, incompleteBackupDest], stderr=STDOUT)
+
+        #rsync updates the attributes of files that already exist in the dest. These files are shared with
+        #the last backup so remove the changed paths and let rsync link them again if they have not changed.
+        incompleteBackupDestBytes = os.fsencode(incompleteBackupDest)
+        for path in pathList:
+            destPath = os.path.join(incompleteBackupDestBytes, path)
+            if os.path.isdir(destPath) and not os.path.islink(destPath):
+                shutil.rmtree(destPath)
+            elif os.path.lexists(destPath):
+                os.remove(destPath)
+
+        filesFrom = journal.writeFilesFrom(pathList)
+        cmd = "{} --files-from={} --from0 -r --delete-missing-args {} {}".format(cmd, shlex.quote(filesFrom), shlex.quote(self._options.src), shlex.quote(incompleteBackupDest))
+        self._uo.info("RSYNC CMD: {}".format(cmd) )
+
+        return self._doSingleBackup(cmd)
 
     def _doBackup(self):
         """@brief Execute the rsync command to perform the backup"""
@@ -707,9 +1618,16 @@ class Backup(object):
         diskUsageBefore         = None
         diskUsageAfter          = None
         incompleteBackupDest    = None
+        success                 = False
+        self._runMetrics        = RunMetrics()
         try:
             startTime = time.time()
 
+            #Delete backups purged previously while this backup runs
+            if not self._purgeEngine.isTrashEmpty():
+                self._uo.info("Deleting previously purged backups in the background.")
+                self._purgeEngine.start()
+
             diskUsageBefore = DiskUsage(self._options.dest)
             backupDest = self._getBackupDest()
             incompleteBackupDest    = "{}.{}".format(backupDest, Backup.NOT_STARTED_BACKUP_SUFFIX)
@@ -718,59 +1636,149 @@ class Backup(object):
             if( backupsToday >= self._options.max_daily_backups ):
                 raise BackupError("{} backups have been created today. The maximum daily backup count (set on the command line) is {}. Therefore no more backups can be created today".format(backupsToday, self._options.max_daily_backups) )
 
+            if self._options.space_forecast:
+                self._checkSpace(backupDest)
+
             #If required run the script before the backup starts (usefull for setting up LVM snapshots)
             if self._options.pre_script:
-                cmdOutput = check_output(self._options.pre_script, shell=True, stderr=STDOUT)
+                with self._runMetrics.phase(RunMetrics.PHASE_PRE_SCRIPT):
+                    cmdOutput = check_output(self._options.pre_script, shell=True, stderr=STDOUT)
                 self._uo.info(cmdOutput)
 
             backupSrc, sshPort = self._getSrc()
+            self._runMetrics.set("backup_name", os.path.basename(backupDest))
 
             self._uo.info("Backing up {} to {}".format(backupSrc, backupDest) )
 
             #Get the full backup path associated with this backup
             fullBackupPath = self._getFullBackupPath(backupDest)
 
+            lastBackupPath = None
+            linkDestList = []
             #If this is the full backup
             if backupDest == fullBackupPath:
 
-                cmd="{} --quiet -avh --safe-links --delete ".format(Backup.RSYNC_CMD)
+                self._runMetrics.set("backup_type", "full")
+                cmd="{} -ah --info=progress2 --stats --safe-links --delete ".format(Backup.RSYNC_CMD)
+
+                #A synthetic full backup starts a new full backup set but hard links unchanged files from the last backup
+                syntheticFullPath = self._getSyntheticFullPath()
+                if syntheticFullPath:
+                    self._runMetrics.set("synthetic_full", True)
+                    self._uo.info("Synthetic full backup. Unchanged files will be hard linked from {}".format(syntheticFullPath))
+                    linkDestList = self._getLinkDestChain(backupDest, syntheticFullPath)
+                    cmd="{}{}".format(cmd, "".join(["--link-dest={} ".format(linkDestPath) for linkDestPath in linkDestList]))
+                    if self._isChecksumBackup(backupDest):
+                        self._runMetrics.set("checksum", True)
+                        self._uo.info("The contents of every file will be compared with {} (--checksum_every {}).".format(syntheticFullPath, self._options.checksum_every))
+                        cmd="{}--checksum ".format(cmd)
 
             else:
 
+                self._runMetrics.set("backup_type", "incremental")
                 lastBackupPath = self._getLastBackupPath(backupDest)
-                cmd="{} --quiet -avh --safe-links --delete --link-dest={} ".format(Backup.RSYNC_CMD, lastBackupPath)
+                linkDestList = self._getLinkDestChain(backupDest, lastBackupPath)
+                cmd="{} -ah --info=progress2 --stats --safe-links --delete {}".format(Backup.RSYNC_CMD, "".join(["--link-dest={} ".format(linkDestPath) for linkDestPath in linkDestList]))
+
+            #Look for a similar file (E.G one that was renamed) to use as the basis for each new file
+            if self._options.fuzzy:
+                cmd="{}--fuzzy --fuzzy ".format(cmd)
+
+            #Checked once as the fallback to a single rsync process is reported as a warning
+            parallelBackup = self._isParallelBackup()
+
+            #If the src path is watched, get the paths that have changed since the last backup
+            journal = self._getJournal()
+            journalPathList = None
+            if journal:
+                journalPathList = journal.beginBackup( os.path.basename(lastBackupPath) if lastBackupPath else None )
+                if lastBackupPath and not parallelBackup:
+                    if journalPathList is None:
+                        self._uo.warn("The change journal does not hold every change since the last backup so the whole src path will be read.")
+                    else:
+                        self._runMetrics.set("journal_paths", len(journalPathList))
+                else:
+                    journalPathList = None
+
+            #We set the backup destination with an incomplete suffix and then when the backup is complete
+            #set it to the correct destination. This allows users to easily see if a backup did not complete
+            incompleteBackupDest = "{}.{}".format(backupDest, Backup.INCOMPLETE_BACKUP_SUFFIX)
+
+            #Continue a backup that did not complete rather than copying everything again
+            resumeRecord, staleRecordList = self._getIncompleteBackups(backupDest)
+            if resumeRecord:
+                self._uo.info("Resuming the backup in {}".format(resumeRecord.name))
+                os.rename(os.path.join(self._options.dest, resumeRecord.name), incompleteBackupDest)
+                self._catalog.rename(resumeRecord.name, os.path.basename(incompleteBackupDest))
+                self._runMetrics.set("resumed", True)
+                #The change journal paths are relative to the last backup, not the partial copy
+                journalPathList = None
+
+            #Files copied by a backup that did not complete need not be copied again
+            elif staleRecordList and linkDestList and len(linkDestList) < Backup.MAX_LINK_DEST:
+                cmd="{}--link-dest={} ".format(cmd, os.path.join(self._options.dest, staleRecordList[-1].name))
 
             rsync_log_file = os.path.join(self._options.dest, Backup.RSYNC_LOG_FILE)
             cmd = cmd + f"--log-file={rsync_log_file} "
             cmd = self._addExclusions(cmd)
 
-            #We set the backup destination with an incomplete suffix and then when the backup is complete
-            #set it to the correct destination. This allows users to easily see if a backup did not complete
-            incompleteBackupDest = "{}.{}".format(backupDest, Backup.INCOMPLETE_BACKUP_SUFFIX)
+            if parallelBackup:
+
+                with self._runMetrics.phase(RunMetrics.PHASE_EMAIL):
+                    self._notifyEmail("Backup Started", body="BACKUP COMMAND\n\n{}\n\n\nThe backup source is {} ({} parallel rsync processes). The backup will be stored in the {} path".format(cmd, backupSrc, self._options.parallel, backupDest) )
+
+                with self._runMetrics.phase(RunMetrics.PHASE_RSYNC):
+                    rsyncStats = self._doParallelBackup(cmd, incompleteBackupDest)
 
-            if sshPort:
+            elif journalPathList is not None:
 
-                cmd="{} -e \"ssh -p {} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null\" {} {}".format(cmd, sshPort, backupSrc, incompleteBackupDest)
+                with self._runMetrics.phase(RunMetrics.PHASE_EMAIL):
+                    self._notifyEmail("Backup Started", body="BACKUP COMMAND\n\n{}\n\n\nThe backup source is {} ({} changed paths from the change journal). The backup will be stored in the {} path".format(cmd, backupSrc, len(journalPathList), backupDest) )
+
+                with self._runMetrics.phase(RunMetrics.PHASE_RSYNC):
+                    rsyncStats = self._doJournalBackup(cmd, journal, journalPathList, lastBackupPath, incompleteBackupDest)
 
             else:
 
-                cmd="{} {} {}".format(cmd, backupSrc, incompleteBackupDest)
+                if self._sshSession:
 
-            self._notifyEmail("Backup Started", body="BACKUP COMMAND\n\n{}\n\n\nThe backup source is {}. The backup will be stored in the {} path".format(cmd, backupSrc, backupDest) )
+                    #rsync uses the ssh connection opened by the initial checks
+                    cmd="{} -e {} {} {}".format(cmd, shlex.quote(self._sshSession.getRsyncShell()), backupSrc, incompleteBackupDest)
 
-            self._uo.info("RSYNC CMD: {}".format(cmd) )
+                else:
 
-            #Do the backup
-            cmdOutput = check_output(cmd, shell=True, stderr=STDOUT)
-            if cmdOutput and len(cmdOutput) > 0:
-                lines = cmdOutput.decode().split("\n")
-                for line in lines:
-                    if not (line.startswith(".") and len(line) == 2):
-                        self._uo.info(line)
+                    cmd="{} {} {}".format(cmd, backupSrc, incompleteBackupDest)
+
+                with self._runMetrics.phase(RunMetrics.PHASE_EMAIL):
+                    self._notifyEmail("Backup Started", body="BACKUP COMMAND\n\n{}\n\n\nThe backup source is {}. The backup will be stored in the {} path".format(cmd, backupSrc, backupDest) )
+
+                self._uo.info("RSYNC CMD: {}".format(cmd) )
 
-            os.rename(incompleteBackupDest, backupDest)
+                #Do the backup
+                with self._runMetrics.phase(RunMetrics.PHASE_RSYNC):
+                    rsyncStats = self._doSingleBackup(cmd)
+
+            self._setRsyncMetrics(rsyncStats)
+
+            with self._runMetrics.phase(RunMetrics.PHASE_RENAME):
+                os.rename(incompleteBackupDest, backupDest)
+                self._catalog.rename(os.path.basename(incompleteBackupDest), os.path.basename(backupDest))
             self._uo.info("Changed {} to {}".format(incompleteBackupDest, backupDest))
 
+            if journal:
+                journal.endBackup( os.path.basename(backupDest) )
+
+            if len(linkDestList) > 1:
+                self._reportLinkDest(backupDest, linkDestList)
+
+            if self._options.dedup:
+                with self._runMetrics.phase(RunMetrics.PHASE_DEDUP):
+                    self._deduplicate(backupDest)
+
+            if self._options.manifest:
+                with self._runMetrics.phase(RunMetrics.PHASE_MANIFEST):
+                    self._createManifest(backupDest)
+
             diskUsageAfter = DiskUsage(self._options.dest)
             self._saveDiskUsage(backupDest, diskUsageBefore, diskUsageAfter, startTime)
 
@@ -779,11 +1787,15 @@ class Backup(object):
                 backupCompletedMessage =  "{}  !!! Low Disk Space !!!".format(backupCompletedMessage)
 
             self._uo.info(backupCompletedMessage)
-            self._notifyEmail(backupCompletedMessage, body="This backup has been stored in the {} path\n\n\n{}".format(backupDest, self._getBackupLog() ) )
+            with self._runMetrics.phase(RunMetrics.PHASE_EMAIL):
+                self._notifyEmail(backupCompletedMessage, body="This backup has been stored in the {} path\n\n\n{}".format(backupDest, self._getBackupLog() ) )
 
             #Purge old backups if required
-            self._purgeBackups()
+            with self._runMetrics.phase(RunMetrics.PHASE_PURGE):
+                self._removeStaleBackups(staleRecordList)
+                self._purgeBackups()
 
+            success = True
             self._uo.info("Backup success.")
 
         finally:
@@ -794,13 +1806,128 @@ class Backup(object):
 
             #If required run the script after the backup complete (usefull for closing down LVM snapshots)
             if self._options.post_script:
-                cmdOutput = check_output(self._options.post_script, shell=True, stderr=STDOUT)
+                with self._runMetrics.phase(RunMetrics.PHASE_POST_SCRIPT):
+                    cmdOutput = check_output(self._options.post_script, shell=True, stderr=STDOUT)
                 self._uo.info(cmdOutput)
 
             elapsedSeconds = time.time()-startTime
             self._uo.info(f"Took {elapsedSeconds:.1f} seconds to execute.")
 
+            self._saveMetrics(success, diskUsageBefore, diskUsageAfter)
+
+
+
+    def _getIncompleteBackups(self, backupDest):
+        """@brief Get the backups in the dest path that did not complete.
+           @param backupDest The path of the backup about to start.
+           @return A tuple containing the record of the incomplete backup with the same full
+                   and incremental backup IDs as this backup that this backup continues (None if
+                   not found or --disable_resume is set) and the list of the records of the other
+                   backups that did not complete, oldest first."""
+        record = SnapshotRecord.Parse( os.path.basename(backupDest) )
+        resumeRecord = None
+        staleRecordList = []
+        for incompleteRecord in self._catalog.getRecords():
+            #Archived backups completed and may hold the files of later archives in their set
+            if incompleteRecord.isArchived() or incompleteRecord.state not in (SnapshotRecord.STATE_INCOMPLETE, SnapshotRecord.STATE_NOT_STARTED) or \
+               not os.path.isdir(os.path.join(self._options.dest, incompleteRecord.name)):
+                continue
+
+            if not self._options.disable_resume and incompleteRecord.state == SnapshotRecord.STATE_INCOMPLETE and \
+               incompleteRecord.fullID == record.fullID and incompleteRecord.incrID == record.incrID:
+                #If there is more than one the latest holds the most recent copy of the files
+                if resumeRecord:
+                    staleRecordList.append(resumeRecord)
+                resumeRecord = incompleteRecord
+
+            else:
+                staleRecordList.append(incompleteRecord)
+
+        return (resumeRecord, staleRecordList)
+
+    def _removeStaleBackups(self, staleRecordList):
+        """@brief Move the backups that did not complete to the trash folder once a backup has
+                  completed. The backup is complete so a failure here is reported but does not
+                  fail the backup.
+           @param staleRecordList The records returned by _getIncompleteBackups()."""
+        if not staleRecordList:
+            return
+
+        try:
+            self._uo.info("Removing {} backups that did not complete.".format(len(staleRecordList)))
+            self._removeBackups(staleRecordList)
+        except Exception as e:
+            self._uo.error("Failed to remove the backups that did not complete: {}".format(e))
+
+    def _deduplicate(self, backupDest):
+        """@brief Replace files in the backup that are held elsewhere in the dest path with hard links.
+                  The backup is complete so a failure here is reported but does not fail the backup.
+           @param backupDest The path of the backup."""
+        try:
+            deduplicator = SnapshotDeduplicator(self._uo, self._options.dest, os.path.join(self._getMetaDir(), Backup.DEDUP_INDEX_FILE), threadCount=self._options.dedup_threads, minSize=self._options.dedup_min_size*1024)
+            linkedCount, freedBytes = deduplicator.deduplicate( os.path.basename(backupDest) )
+            self._runMetrics.set("dedup_files_linked", linkedCount)
+            self._runMetrics.set("dedup_bytes_freed", freedBytes)
+
+        except Exception as e:
+            self._uo.error("Failed to deduplicate {}: {}".format(backupDest, e))
+
+    def _getManifestIndex(self):
+        """@return The ManifestIndex instance for the backups in the dest path."""
+        return ManifestIndex(self._uo, self._options.dest, os.path.join(self._getMetaDir(), Backup.MANIFEST_DIR))
+
+    def _createManifest(self, backupDest):
+        """@brief Create the manifest of a backup used by the --versions option. The backup is
+                  complete so a failure here is reported but does not fail the backup.
+           @param backupDest The path of the backup."""
+        try:
+            self._getManifestIndex().create( os.path.basename(backupDest) )
+        except Exception as e:
+            self._uo.error("Failed to create the manifest of {}: {}".format(backupDest, e))
+
+    def _setRsyncMetrics(self, rsyncStats):
+        """@brief Record the numbers reported by rsync --stats in the run metrics.
+           @param rsyncStats The RsyncStats instance."""
+        regularFileCount = rsyncStats.get(RsyncStats.NUMBER_OF_REGULAR_FILES)
+        transferredFileCount = rsyncStats.get(RsyncStats.NUMBER_OF_FILES_TRANSFERRED)
+        self._runMetrics.set("files_total", rsyncStats.get(RsyncStats.NUMBER_OF_FILES))
+        self._runMetrics.set("files_regular", regularFileCount)
+        self._runMetrics.set("files_transferred", transferredFileCount)
+        #Regular files that were not transferred were hard linked to the previous backup (if there was one)
+        if self._runMetrics.get("backup_type") == "incremental" or self._runMetrics.get("synthetic_full"):
+            self._runMetrics.set("files_hardlinked", max(0, regularFileCount-transferredFileCount))
+        else:
+            self._runMetrics.set("files_hardlinked", 0)
+        self._runMetrics.set("bytes_total", rsyncStats.get(RsyncStats.TOTAL_FILE_SIZE))
+        self._runMetrics.set("bytes_transferred", rsyncStats.get(RsyncStats.TOTAL_TRANSFERRED_FILE_SIZE))
+        self._runMetrics.set("bytes_sent", rsyncStats.get(RsyncStats.TOTAL_BYTES_SENT))
+        self._runMetrics.set("bytes_received", rsyncStats.get(RsyncStats.TOTAL_BYTES_RECEIVED))
+
+    def _getMetricsHistoryFile(self):
+        """@return The file that holds the metrics of every backup run."""
+        return os.path.join(self._options.dest, Backup.METRICS_HISTORY_FILE)
+
+    def _saveMetrics(self, success, diskUsageBefore, diskUsageAfter):
+        """@brief Save the metrics of this backup run to the history file and the Prometheus textfile if required.
+           @param success True if the backup completed successfully.
+           @param diskUsageBefore The disk usage before the backup was started (may be None).
+           @param diskUsageAfter The disk usage after the backup was completed or failed (may be None)."""
+        try:
+            self._runMetrics.set("success", success)
+            if diskUsageAfter:
+                self._runMetrics.set("dest_free_bytes", diskUsageAfter.getFreeBytes())
+                self._runMetrics.set("dest_used_bytes", diskUsageAfter.getUsedBytes())
+                if diskUsageBefore:
+                    self._runMetrics.set("backup_size_bytes", diskUsageBefore.getFreeBytes()-diskUsageAfter.getFreeBytes())
+
+            self._runMetrics.appendHistory( self._getMetricsHistoryFile() )
 
+            if self._options.prom_textfile:
+                self._runMetrics.writePrometheus(self._options.prom_textfile, {"dest": self._options.dest})
+
+        except Exception as e:
+            #Failing to save the metrics should not fail the backup
+            self._uo.error("Failed to save backup metrics: {}".format(e))
 
     def _getBackupSizeLogFile(self):
         """@return The name of the backup size log file.
@@ -854,13 +1981,20 @@ class Backup(object):
     def _saveConfig(self):
         """@brief Save all the command line options to a config file"""
         if self._options.save_config:
-            pickle.dump( self._options, open(self._options.save_config, "wb") )
+            options = copy.copy(self._options)
+            options.dest = ",".join([self._options.dest] + self._replicaDestList)
+            pickle.dump( options, open(self._options.save_config, "wb") )
             self._uo.info("Saved command line options to {}".format(self._options.save_config) )
 
     def _loadConfig(self):
         """@brief Load the command line options saved previously to a config file"""
         if self._options.load_config:
+            cmdLineOptions = self._options
             self._options = pickle.load( open(self._options.load_config, "rb") )
+            #Config files saved by older versions do not hold options added since, so use their defaults
+            for name, value in vars(cmdLineOptions).items():
+                if not hasattr(self._options, name):
+                    setattr(self._options, name, value)
             self._uo.info("Loaded command line options from {}".format(self._options.load_config) )
 
     def _runChecks(self):
@@ -877,19 +2011,41 @@ class Backup(object):
             if not os.path.isfile(Backup.SSH_CMD):
                 raise Exception("{} file not found on the local machine. Please install ssh and try again.".format(Backup.SSH_CMD))
             self._uo.info("{} is installed locally.".format(Backup.SSH_CMD))
+
+            #Open one ssh connection that the checks below and rsync share
+            username, hostName, sshPort = self._getSshTarget()
+            #As before the shared connection was added, the host key is only ignored if a port is given
+            self._sshSession = SshSession(username, hostName, port=sshPort, sshCmd=Backup.SSH_CMD, checkHostKey=sshPort is None)
+            startTime = time.time()
+            self._sshSession.open()
+            self._uo.info("Checked ssh connection to remote source machine ({}) in {:.3f} seconds.".format(self._options.ssh, time.time()-startTime))
+
             try:
-                src, port = self._getSrc()
-                self._uo.info("Checked ssh connection to remote source machine ({}).".format(self._options.ssh))
+                rsyncVersion = self._sshSession.getRsyncVersion()
+                self._uo.info("rsync {} is installed on remote source machine ({}).".format(rsyncVersion, self._options.ssh))
+
             except:
-                raise Exception("Failed to connect to {} ssh server.".format(self._options.ssh))
+                self._closeSsh()
+                raise
 
+            #These are for information only. rsync reports any problem with the src path.
             try:
-                src, port = self._getSrc()
-                self._uo.info("{} is installed on remote source machine ({}).".format(Backup.RSYNC_CMD, self._options.ssh))
+                totalBytes, freeBytes = self._sshSession.getFreeSpace(self._options.src)
+                self._uo.info("Remote source disk: Free {:.1f} GB, Used {:.1f} GB".format(freeBytes/1E9, (totalBytes-freeBytes)/1E9))
+            except Exception as e:
+                self._uo.warn("Unable to read the remote source disk space: {}".format(e))
 
-            except:
-                raise Exception("rsync is not installed on the ssh server ({}). Please install it and try again.".format(self._options.ssh))
+            if self._options.ssh_file_count:
+                try:
+                    self._uo.info("{} files and folders in the remote source path.".format(self._sshSession.getFileCount(self._options.src)))
+                except Exception as e:
+                    self._uo.warn("Unable to count the files in the remote source path: {}".format(e))
 
+    def _closeSsh(self):
+        """@brief Close the ssh connection to the remote machine if open."""
+        if self._sshSession:
+            self._sshSession.close()
+            self._sshSession = None
 
     def execute(self):
         """@brief Called to execute the backup process"""
@@ -901,6 +2057,8 @@ class Backup(object):
 
            self._saveConfig()
 
+           self._replicate()
+
         except Exception as e:
             if self._options.email_server:
                 try:
@@ -916,30 +2074,293 @@ class Backup(object):
 
             raise
 
+        finally:
+            self._closeSsh()
+
+            self._finishPurge()
+
+            self._flushEmail()
+
+    def _getReplicaOptions(self, dest, backupPath):
+        """@brief Get the options used to copy a backup to another dest path.
+           @param dest The dest path to copy the backup to.
+           @param backupPath The path of the backup to copy.
+           @return The options instance."""
+        options = copy.copy(self._options)
+        options.dest            = dest
+        options.src             = backupPath
+        #The backup is copied from this machine without reading the src path again
+        options.ssh             = None
+        options.pre_script      = None
+        options.post_script     = None
+        options.save_config     = None
+        options.load_config     = None
+        options.show_cmd_line   = False
+        options.log             = None
+        options.prom_textfile   = None
+        #The backup only holds the included files and has already been checked, so the
+        #options that read or hash the whole src path again are not used
+        options.src_exclude     = None
+        options.exclude_junk    = None
+        options.exclude_cachedir = False
+        options.space_forecast  = False
+        options.dedup           = False
+        options.parallel        = 1
+        return options
+
+    def _replicate(self):
+        """@brief Copy the backup just made to the other dest paths. Each dest path holds its own
+                  backups (as if pbackup was run with each dest path and the backup as the src
+                  path) so only the files that changed are copied and old backups are purged
+                  from each dest path as defined by the options."""
+        if not self._replicaDestList:
+            return
+
+        backupPath = os.path.join(self._options.dest, self._catalog.getRecords(completeOnly=True)[-1].name)
+        failedList = []
+        for dest in self._replicaDestList:
+            self._uo.info("Copying {} to {}".format(backupPath, dest))
+            replicaUO = UO()
+            try:
+                replicaBackup = Backup(replicaUO, self._getReplicaOptions(dest, backupPath), replica=True)
+                replicaBackup.execute()
+
+            except Exception as e:
+                self._uo.error("Failed to copy {} to {}: {}".format(backupPath, dest, e))
+                failedList.append(dest)
+
+            finally:
+                replicaUO.closeLog()
+
+        if failedList:
+            raise BackupError("Failed to copy the backup to {}".format(", ".join(failedList)))
+
+    def report(self):
+        """@brief Report the disk space used by each backup in the dest path. Only space used
+                  by regular files is included and incomplete backups are not included."""
+        recordList = self._catalog.getRecords(completeOnly=True)
+        if not recordList:
+            self._uo.info("No backups found in {}".format(self._options.dest))
+            return
+
+        scanner = SnapshotUsageScanner(self._uo, self._options.dest, os.path.join(self._getMetaDir(), Backup.USAGE_CACHE_DIR), threadCount=self._options.scan_threads)
+        usageList = scanner.scan([record.name for record in recordList])
+        refCountDict = SnapshotUsageScanner.GetRefCounts(usageList)
+
+        self._uo.info("{:<45} {:>10} {:>12} {:>12} {:>12}".format("BACKUP", "FILES", "TOTAL GB", "UNIQUE GB", "SHARED GB"))
+        for record, snapshotUsage in zip(recordList, usageList):
+            totalBytes = snapshotUsage.getTotalBytes()
+            uniqueBytes = SnapshotUsageScanner.GetUniqueBytes(snapshotUsage, refCountDict)
+            self._uo.info("{:<45} {:>10} {:>12.3f} {:>12.3f} {:>12.3f}".format(record.name, snapshotUsage.fileCount, totalBytes/(2**30), uniqueBytes/(2**30), (totalBytes-uniqueBytes)/(2**30)))
+
+        fullBackupIDList = sorted(set([record.fullID for record in recordList]))
+        for fullBackupID in fullBackupIDList:
+            setUsageList = [snapshotUsage for record, snapshotUsage in zip(recordList, usageList) if record.fullID == fullBackupID]
+            freedBytes = SnapshotUsageScanner.GetFreedBytes(setUsageList, refCountDict)
+            self._uo.info("Purging full backup {} ({} backups) would free {:.3f} GB.".format(fullBackupID, len(setUsageList), freedBytes/(2**30)))
+
+        allBytes = SnapshotUsageScanner.GetFreedBytes(usageList, refCountDict)
+        self._uo.info("All backups use {:.3f} GB.".format(allBytes/(2**30)))
+
+        for record in self._catalog.getRecords():
+            if record.isArchived():
+                archivePath = os.path.join(self._options.dest, record.name)
+                archiveBytes = sum([os.path.getsize(os.path.join(archivePath, fileName)) for fileName in os.listdir(archivePath)])
+                self._uo.info("{:<45} archived {:>12.3f} GB".format(record.name, archiveBytes/(2**30)))
+
+    def watch(self):
+        """@brief Record the paths that change in the src path until stopped so that incremental
+                  backups only need to copy these paths."""
+        journal = ChangeJournal(os.path.join(self._getMetaDir(), Backup.JOURNAL_DIR), self._options.src)
+        if journal.isWatched():
+            raise BackupError("{} is already being watched.".format(self._options.src))
+
+        watcher = ChangeWatcher(self._uo, self._options.src, journal)
+        signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+        watcher.run()
+
+    def _selectRecord(self, selector, includeArchived=False):
+        """@brief Select a backup.
+           @param selector The backup name, latest or a local time (YYYY-MM-DD, YYYY-MM-DD HH:MM or
+                           YYYY-MM-DD HH:MM:SS). If a time is given the last backup started at or
+                           before that time is used (the end of the day if no time of day is given).
+           @param includeArchived If True archived backups may be selected.
+           @return The SnapshotRecord instance."""
+        recordList = [record for record in self._catalog.getRecords() if record.isComplete() or (includeArchived and record.isArchived())]
+        if not recordList:
+            raise BackupError("No complete backups found in {}".format(self._options.dest))
+
+        if selector == "latest":
+            return recordList[-1]
+
+        for record in recordList:
+            if record.name == os.path.basename(selector.rstrip("/")):
+                return record
+
+        restoreTime = None
+        for timeFormat, endOffset in (("%Y-%m-%d %H:%M:%S", 0), ("%Y-%m-%dT%H:%M:%S", 0), ("%Y-%m-%d %H:%M", 59), ("%Y-%m-%d", 86399)):
+            try:
+                restoreTime = time.mktime( time.strptime(selector, timeFormat) ) + endOffset
+                break
+            except ValueError:
+                pass
+
+        if restoreTime is None:
+            raise BackupError("{} is not a complete backup name, latest or a time (YYYY-MM-DD HH:MM:SS).".format(selector))
+
+        restoreRecord = None
+        for record in recordList:
+            if record.timeStamp is not None and record.timeStamp <= restoreTime:
+                restoreRecord = record
+        if restoreRecord is None:
+            raise BackupError("No backups were started at or before {}".format(selector))
+
+        return restoreRecord
+
+    def restore(self):
+        """@brief Restore the files in a backup to the --restore_to folder."""
+        record = self._selectRecord(self._options.restore, includeArchived=True)
+        patternList = None
+        if self._options.restore_include:
+            patternList = self._options.restore_include.split(",")
+
+        if record.isArchived():
+            reader = ArchiveReader(self._uo, os.path.join(self._options.dest, record.name), threadCount=self._options.restore_threads)
+            reader.restore(self._options.restore_to, patternList=patternList)
+            return
+
+        restorer = SnapshotRestorer(self._uo, os.path.join(self._options.dest, record.name), self._options.restore_to, patternList=patternList, threadCount=self._options.restore_threads, progressInterval=self._options.progress_interval)
+        restorer.restore()
+
+    def diff(self, selectorList):
+        """@brief Report the files added, removed and modified between two backups.
+           @param selectorList A list of the two backups to compare (see _selectRecord()). If
+                               empty the last two complete backups are compared."""
+        if selectorList:
+            if len(selectorList) != 2:
+                raise BackupError("The --diff option must be followed by two backups or none to compare the last two backups.")
+            recordA = self._selectRecord(selectorList[0])
+            recordB = self._selectRecord(selectorList[1])
+
+        else:
+            recordList = self._catalog.getRecords(completeOnly=True)
+            if len(recordList) < 2:
+                raise BackupError("Two complete backups are required in {} to compare them.".format(self._options.dest))
+            recordA, recordB = recordList[-2:]
+
+        snapshotDiff = SnapshotDiff(os.path.join(self._options.dest, recordA.name), os.path.join(self._options.dest, recordB.name), threadCount=self._options.scan_threads)
+        changeList = snapshotDiff.compare()
+        summaryDict = SnapshotDiff.GetDirSummary(changeList)
+
+        totalDict = {}
+        for changeType in SnapshotDiff.CHANGE_TYPES:
+            totalDict[changeType] = len([change for change in changeList if change[0] == changeType])
+            totalDict["{}_bytes".format(changeType)] = sum([change[2] for change in changeList if change[0] == changeType])
+
+        if self._options.json:
+            diffDict = {"from":         recordA.name,
+                        "to":           recordB.name,
+                        "totals":       totalDict,
+                        "directories":  summaryDict}
+            for changeType in SnapshotDiff.CHANGE_TYPES:
+                diffDict[changeType] = [path for pathChangeType, path, _ in changeList if pathChangeType == changeType]
+            print( json.dumps(diffDict, indent=4, sort_keys=True) )
+            return
+
+        self._uo.info("Changes from {} to {}".format(recordA.name, recordB.name))
+        self._uo.info("{:<50} {:>9} {:>9} {:>9} {:>12} {:>12} {:>12}".format("FOLDER", "ADDED", "REMOVED", "MODIFIED", "ADDED MB", "REMOVED MB", "MODIFIED MB"))
+        #The folders that added the most data to the newer backup first
+        for dirPath, dirDict in sorted(summaryDict.items(), key=lambda item: (-(item[1]["added_bytes"]+item[1]["modified_bytes"]), item[0])):
+            self._uo.info("{:<50} {:>9} {:>9} {:>9} {:>12.3f} {:>12.3f} {:>12.3f}".format(dirPath, dirDict[SnapshotDiff.ADDED], dirDict[SnapshotDiff.REMOVED], dirDict[SnapshotDiff.MODIFIED], dirDict["added_bytes"]/1E6, dirDict["removed_bytes"]/1E6, dirDict["modified_bytes"]/1E6))
+        self._uo.info("{:<50} {:>9} {:>9} {:>9} {:>12.3f} {:>12.3f} {:>12.3f}".format("TOTAL", totalDict[SnapshotDiff.ADDED], totalDict[SnapshotDiff.REMOVED], totalDict[SnapshotDiff.MODIFIED], totalDict["added_bytes"]/1E6, totalDict["removed_bytes"]/1E6, totalDict["modified_bytes"]/1E6))
+
+    def versions(self):
+        """@brief Report every version of a file, or of the files in a folder, held in the backups."""
+        path = self._options.versions
+        #The path may be given as it was in the src path
+        if self._options.src and path.startswith(self._options.src):
+            path = path[len(self._options.src):]
+        path = os.fsencode( path.strip("/") )
+
+        recordList = self._catalog.getRecords(completeOnly=True)
+        nameList = [record.name for record in recordList]
+        manifestIndex = self._getManifestIndex()
+        manifestIndex.update(nameList, threadCount=self._options.scan_threads)
+
+        startTime = time.time()
+        versionDict = manifestIndex.getVersions(nameList, path)
+        if not versionDict:
+            self._uo.info("{} was not found in any backup.".format(self._options.versions))
+            return
+
+        for entryPath in sorted(versionDict.keys()):
+            self._uo.info(os.fsdecode(entryPath))
+            for size, mtimeNs, versionNameList in versionDict[entryPath]:
+                modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtimeNs/1E9))
+                backups = versionNameList[0]
+                if len(versionNameList) > 1:
+                    backups = "{} .. {}".format(versionNameList[0], versionNameList[-1])
+                self._uo.info("  {} {:>14} bytes  in {} backups: {}".format(modified, size, len(versionNameList), backups))
+
+        self._uo.info("Found {} files in {} backups in {:.3f} seconds.".format(len(versionDict), len(nameList), time.time()-startTime))
+
+    def verify(self):
+        """@brief Check that the files in the backups have not changed since they were last checked."""
+        recordList = self._catalog.getRecords(completeOnly=True)
+        if not recordList:
+            raise BackupError("No complete backups were found in {}".format(self._options.dest))
+
+        srcPath = None
+        if self._options.verify_src:
+            srcPath = self._options.src
+
+        verifier = SnapshotVerifier(self._uo, os.path.join(self._getMetaDir(), Backup.VERIFY_DB_FILE), threadCount=self._options.verify_threads, bytesPerSecond=self._options.verify_rate*1E6, maxSeconds=self._options.verify_max_time*60)
+        result = verifier.verify([os.path.join(self._options.dest, record.name) for record in recordList], srcPath=srcPath)
+
+        if result.failedList:
+            for path, reason in result.failedList:
+                self._uo.error("{}: {}".format(path, reason))
+            self._notifyEmail("Backup Verify Failed", body="{} files in the {} path failed the check.\n\n\n{}".format(len(result.failedList), self._options.dest, "\n".join(["{}: {}".format(path, reason) for path, reason in result.failedList])))
+            self._flushEmail()
+            raise BackupError("{} files failed the check.".format(len(result.failedList)))
+
     def testEmail(self):
         """@brief Send a test email"""
         self._notifyEmail("Backup Email Test", body = "TESTING BACKUP EMAIL SEND\n\n\n" )
+        self._flushEmail()
 
-def main():
-    uo = UO()
-
+def getOptionParser():
+    """@brief Get the parser for the pbackup command line options.
+       @return An OptionParser instance."""
     opts=OptionParser(usage="\n\
      A command line backup tool that provides full and incremental backups using hard links\n\
      so that folders with a complete backup history are available using a minimum of storage space.\n\
      Rsync (/usr/bin/rsync) must be installed (installed by default on most Linux distributions).")
 
     opts.add_option("--src",                    help="Followed by the absolute path of the path to backup (required). This may include any regular expressions that can be used on the rsync src. See rsync documentation for more details of this.", default=None)
-    opts.add_option("--dest",                   help="Followed by the absolute path of the path to hold the backups. (required)", default=None)
+    opts.add_option("--dest",                   help="Followed by the absolute path of the path to hold the backups. (required) This may be a comma separated list of paths. The src path is then only read once to make the backup in the first path and the backup is copied from there to the other paths, each holding its own backups.", default=None)
     opts.add_option("--src_exclude",            help="Followed by a comma separated list of exclude patterns to be passed to rsync in order to exclude files in the src path from the backup (optional). See rsync documentation for more details of this.", default=None)
-    opts.add_option("--ssh",                    help="Followed by the src ssh host address (optional). If supplied this can include the username, E.G username@myserver (if no username is supplied the current username will be used). This may also include the SSH port number E.G username@myserver:22", default=None)
+    opts.add_option("--exclude_junk",           help="Followed by a comma separated list of folder names (E.G __pycache__,node_modules,.cache) to exclude wherever they are found in the src path (optional). The names may include wildcard characters.", default=None)
+    opts.add_option("--exclude_cachedir",       help="Read the local src path before the backup and exclude every folder that holds a CACHEDIR.TAG file (see https://bford.info/cachedir/). The --scan_threads option sets the number of folders read at the same time.", action="store_true", default=False)
+    opts.add_option("--ssh",                    help="Followed by the src ssh host address (optional). If supplied this can include the username, E.G username@myserver (if no username is supplied the current username will be used). This may also include the SSH port number E.G username@myserver:22. A single ssh connection is opened for each backup and shared by the initial checks and rsync.", default=None)
+    opts.add_option("--ssh_file_count",         help="Report the number of files in the src path on the remote machine before the backup starts.", action="store_true", default=False)
     opts.add_option("--log",                    help=f"Followed by the absolute path of the backup log file. Default = {Backup.DEFAULT_CMD_LINE_OP_LOG_FILE} (in dest folder).", default=None)
+    opts.add_option("--log_max_size",           help="Followed by the maximum size (MB) of the log file (default = 100). When this is reached the log file is compressed to <log file>.1.gz and a new log file started. 0 = no maximum size.", type="int", default=100)
+    opts.add_option("--log_backups",            help="Followed by the number of compressed log files to keep (default = 5).", type="int", default=5)
+    opts.add_option("--log_background",         help="Write the log file from a background thread.", action="store_true", default=False)
     opts.add_option("--max_full",               help="Followed by the maximum number of full backups to store (default=4).", type="int", default=4)
-    opts.add_option("--max_inc",                help="Followed by the maximum number of incremental backups to store (default=92).", type="int", default=92)
+    opts.add_option("--max_inc",                help="Followed by the maximum number of incremental backups to store (default=92). If any of the --keep_* options are used this is the number of incremental backups made before the next full backup.", type="int", default=92)
+    opts.add_option("--keep_hourly",            help="Followed by the number of hours (default = 0) to keep the latest backup of. If any of the --keep_* options are used, incremental backups that are not the latest backup in a kept hour, day, week or month are removed.", type="int", default=0)
+    opts.add_option("--keep_daily",             help="Followed by the number of days (default = 0) to keep the latest backup of.", type="int", default=0)
+    opts.add_option("--keep_weekly",            help="Followed by the number of weeks (default = 0) to keep the latest backup of.", type="int", default=0)
+    opts.add_option("--keep_monthly",           help="Followed by the number of months (default = 0) to keep the latest backup of.", type="int", default=0)
 
     opts.add_option("--email_server",           help="Followed by the email (SMTP) server for notification of backup progress (optional). The SMTP server address can include the port number of the SMTP server (E.G smtp.gmail.com:587).", default=None)
     opts.add_option("--email_list",             help="Followed by a comma separated list of email addresses to be sent email notifications of backup progress (optional).", default=None)
     opts.add_option("--email_username",         help="Followed by the email username for notification of backup progress (optional).", default=None)
     opts.add_option("--email_password",         help="Followed by the email password for notification of backup progress (optional).", default=None)
+    opts.add_option("--email_timeout",          help="Followed by the timeout in seconds when connecting and sending to the email server (default = {}). Emails are sent in the background and failed sends are retried.".format(EmailNotifier.DEFAULT_TIMEOUT_SECONDS), type="int", default=EmailNotifier.DEFAULT_TIMEOUT_SECONDS)
+    opts.add_option("--email_allow_plain",      help="Send the email username and password to an email server that does not support STARTTLS. By default no email is sent to such a server.", action="store_true", default=False)
     opts.add_option("--test_email",             help="Send a test email to check the email works.", action="store_true")
 
     opts.add_option("--pre_script",             help="Followed by the absolute path of a script to be executed before the backup (optional). This is useful is LVM snapshots are used. The script can be used to create the snapshot .", default=None)
@@ -950,20 +2371,87 @@ def main():
     opts.add_option("--show_cmd_line",          help="Show the command line (excluding --save_config, --load_config --list_options) and exit. This is useful if the --load_config option is used and you wish to find the original command line.", action="store_true", default=False)
     opts.add_option("--max_daily_backups",      help="Followed by the maximum number of backups that can be taken in one day (default = 5). This ensures that no matter how many times backup is executed, the backups stored will be limited.", type="int", default=5)
 
+    opts.add_option("--disable_resume",         help="Start each backup again rather than continuing a backup that did not complete. By default a backup that did not complete (ending .{}) is continued by the next backup and other backups that did not complete are removed once a backup completes.".format(SnapshotRecord.INCOMPLETE_SUFFIX), action="store_true", default=False)
     opts.add_option("--disable_create_dest",    help="Disable the creation of the dest path if it does not exist. By default the dest path is created if it does not exist", action="store_true", default=False)
 
+    opts.add_option("--space_forecast",         help="Before each backup predict the disk space it will use from the earlier backups of the same type. If there is not enough free space the backups that would be purged after the backup are purged first. If there is still not enough space the backup is not started and fails.", action="store_true", default=False)
+    opts.add_option("--space_margin",           help="Followed by the percentage added to the disk space that --space_forecast predicts (default = 20).", type="int", default=20)
     opts.add_option("--low",                    help="Low disk space threshold (MB). If the destination disk space drops below this then backup complete email messages will include a low disk space warning (default = 5000 MB).", type="int", default=5000)
 
     opts.add_option("--monthly_full",           help="Perform a full backup on the first day of every month. This overrides the max_inc argument.", action="store_true", default=False)
 
+    opts.add_option("--link_dest_depth",        help="Followed by the number of earlier backups (default = 1, maximum = {}) that rsync hard links unchanged files from. If more than 1, files that are not in the last backup but are in an older backup of the same set (E.G deleted and then restored) are hard linked rather than copied.".format(Backup.MAX_LINK_DEST), type="int", default=1)
+    opts.add_option("--fuzzy",                  help="Use the rsync --fuzzy option (twice) so that a new file is sent as the changes to a similar file (E.G the same file renamed or moved) in the backup or the --link-dest backups.", action="store_true", default=False)
+    opts.add_option("--synthetic_full",         help="Hard link the files that have not changed since the last backup when a full backup is created. The full backup still starts a new set of backups that are purged together but only changed files are copied.", action="store_true", default=False)
+    opts.add_option("--checksum_every",         help="Followed by N. Every Nth synthetic full backup compares the contents of every file with the last backup (rsync --checksum) rather than the size and modification time so that changed or damaged files are copied again (default = 0, never). Requires --synthetic_full.", type="int", default=0)
+
+    opts.add_option("--dedup",                  help="After each backup, replace the files in the backup that have the same contents and attributes as a file in any backup with hard links. This saves space when files are moved, renamed or copied in the src path. The hash of each file is saved in the dest path so each file is only read once.", action="store_true", default=False)
+    opts.add_option("--dedup_threads",          help="Followed by the number of files that --dedup reads at the same time (default = {}).".format(SnapshotDeduplicator.DEFAULT_THREAD_COUNT), type="int", default=SnapshotDeduplicator.DEFAULT_THREAD_COUNT)
+    opts.add_option("--dedup_min_size",         help="Followed by the size (KB) of the smallest file that --dedup replaces with a hard link (default = {}).".format(SnapshotDeduplicator.DEFAULT_MIN_SIZE//1024), type="int", default=SnapshotDeduplicator.DEFAULT_MIN_SIZE//1024)
+
+    opts.add_option("--parallel",               help="Followed by the number of rsync processes to run at the same time (default = 1). If more than one then the top level folders of the src path are backed up in parallel. Only used when the src is a local folder.", type="int", default=1)
+
+    opts.add_option("--purge_mode",             help="Followed by when old backups are deleted once moved to the trash folder in the dest path. {} = after the backup (default), {} = while the backup completes, {} = during the next backup.".format(*Backup.PURGE_MODES), type="choice", choices=Backup.PURGE_MODES, default=Backup.PURGE_MODE_FOREGROUND)
+    opts.add_option("--purge_threads",          help="Followed by the number of threads used to delete old backups (default = {}).".format(PurgeEngine.DEFAULT_THREAD_COUNT), type="int", default=PurgeEngine.DEFAULT_THREAD_COUNT)
+
+    opts.add_option("--archive_days",           help="Followed by the age in days (default = 0, do not archive) after which a backup is packed into an archive folder of compressed tar files and an index, replacing the backup folder. Backups in the latest full backup set are not archived. Archived backups can be restored with --restore and are only removed by --max_full.", type="float", default=0)
+    opts.add_option("--archive_compression",    help="Followed by the compression used by --archive_days. {} (default) or {} (smaller but slower).".format(*SnapshotArchiver.COMPRESSION_LIST), type="choice", choices=SnapshotArchiver.COMPRESSION_LIST, default=SnapshotArchiver.COMPRESSION_GZIP)
+    opts.add_option("--archive_threads",        help="Followed by the number of chunks of a backup that --archive_days compresses at the same time (default = {}).".format(SnapshotArchiver.DEFAULT_THREAD_COUNT), type="int", default=SnapshotArchiver.DEFAULT_THREAD_COUNT)
+
+    opts.add_option("--report",                 help="Report the disk space used by each backup in the dest path and the space that purging each full backup (and its incremental backups) would free, then exit. Only the --dest option is required.", action="store_true", default=False)
+    opts.add_option("--scan_threads",           help="Followed by the number of backups that --report reads at the same time (default = {}). The files found in each backup are cached in the dest path so each backup is only read once.".format(SnapshotUsageScanner.DEFAULT_THREAD_COUNT), type="int", default=SnapshotUsageScanner.DEFAULT_THREAD_COUNT)
+
+    opts.add_option("--restore",                help="Followed by the backup to restore. This may be the name of a backup folder in the dest path, latest or a local time (YYYY-MM-DD, YYYY-MM-DD HH:MM or YYYY-MM-DD HH:MM:SS) to restore the last backup started at or before that time. Only the --dest and --restore_to options are required. Files that have already been restored are skipped so a restore that was stopped can be run again.", default=None)
+    opts.add_option("--restore_to",             help="Followed by the absolute path of the folder to restore files to.", default=None)
+    opts.add_option("--restore_include",        help="Followed by a comma separated list of glob patterns (E.G home/auser/*.txt). Only the paths (relative to the backup folder) that match are restored. If a folder matches everything in it is restored. By default everything is restored.", default=None)
+    opts.add_option("--restore_threads",        help="Followed by the number of files to restore at the same time (default = {}).".format(SnapshotRestorer.DEFAULT_THREAD_COUNT), type="int", default=SnapshotRestorer.DEFAULT_THREAD_COUNT)
+
+    opts.add_option("--manifest",               help="After each backup, save a list of the files in the backup that the --versions option uses.", action="store_true", default=False)
+    opts.add_option("--versions",               help="Followed by the path of a file or folder (relative to the src path). Every version of the file, or of each file in the folder, held in the backups is listed with the backups that hold it and then pbackup exits. Only the --dest option is required. The lists of files are created for any backups that do not have them.", default=None)
+
+    opts.add_option("--diff",                   help="Report the files added, removed and modified in each folder between two backups and exit. This option may be followed by the two backups to compare (each a backup folder name, latest or a time as for --restore). By default the last two backups are compared. Only the --dest option is required.", action="store_true", default=False)
+    opts.add_option("--json",                   help="Output the --diff results as JSON, including every path that changed.", action="store_true", default=False)
+
+    opts.add_option("--verify",                 help="Read every file in the backups and check that it has not changed since it was last checked, then exit. Each file that is hard linked between backups is read once. The hash of each file is saved in the dest path. A check that was stopped continues from where it stopped when next run. Only the --dest option is required.", action="store_true", default=False)
+    opts.add_option("--verify_src",             help="Also check that files in the last backup have the same contents as the files in the local src path that have the same size and modification time.", action="store_true", default=False)
+    opts.add_option("--verify_threads",         help="Followed by the number of files that --verify reads at the same time (default = {}).".format(SnapshotVerifier.DEFAULT_THREAD_COUNT), type="int", default=SnapshotVerifier.DEFAULT_THREAD_COUNT)
+    opts.add_option("--verify_rate",            help="Followed by the maximum rate in MB/s that --verify reads files (default = 0). 0 = no limit.", type="float", default=0)
+    opts.add_option("--verify_max_time",        help="Followed by the maximum time in minutes that --verify runs (default = 0). The next --verify continues the check. 0 = no limit.", type="float", default=0)
+
+    opts.add_option("--progress_interval",      help="Followed by the period in seconds between reports of the rsync transfer progress (default = 60). 0 = no progress reports.", type="int", default=60)
+    opts.add_option("--stall_timeout",          help="Followed by a period in seconds (default = 0). If rsync makes no progress for this period the backup is stopped and fails. 0 = never stop rsync.", type="int", default=0)
+
+    opts.add_option("--watch",                  help="Watch the local src path and record the paths that change until stopped. While this runs incremental backups only copy the changed paths and hard link everything else from the last backup. If changes may have been missed the next backup reads the whole src path.", action="store_true", default=False)
+
+    opts.add_option("--prom_textfile",          help="Followed by the absolute path of a Prometheus node exporter textfile (ending .prom) to write the metrics of each backup run to (optional). The metrics of every run are also appended to the {} file in the dest folder.".format(Backup.METRICS_HISTORY_FILE), default=None)
+
     opts.add_option("-d", "--debug",            help="Enable debugging.", action="store_true", default=False)
 
+    return opts
+
+def main():
+    uo = UO()
+
+    opts = getOptionParser()
+
     try:
         (options, args) = opts.parse_args()
 
         backup = Backup(uo, options)
         if options.test_email:
             backup.testEmail()
+        elif options.report:
+            backup.report()
+        elif options.restore:
+            backup.restore()
+        elif options.versions:
+            backup.versions()
+        elif options.diff:
+            backup.diff(args)
+        elif options.verify:
+            backup.verify()
+        elif options.watch:
+            backup.watch()
         else:
             backup.execute()
 
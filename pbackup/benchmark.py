@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+import  os
+import  sys
+import  time
+import  json
+import  random
+import  shutil
+import  platform
+import  tempfile
+import  contextlib
+from    optparse import OptionParser
+
+from    pbackup.backup import Backup, BackupError, UO, getOptionParser
+from    pbackup.catalog import SnapshotRecord
+
+class TreeGenerator(object):
+    """@brief Responsible for creating synthetic backup source trees. The same seed always
+              creates the same tree so that benchmark results can be compared."""
+
+    def __init__(self, root, seed):
+        """@brief Constructor
+           @param root The folder to create the tree in.
+           @param seed The seed for the random number generator."""
+        self._root      = root
+        self._random    = random.Random(seed)
+        self._fileList  = []
+
+    def _writeFile(self, path, size):
+        """@brief Create a file of random content.
+           @param path The file path.
+           @param size The file size in bytes."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fd:
+            remaining = size
+            while remaining > 0:
+                blockSize = min(remaining, 1048576)
+                fd.write( self._random.getrandbits(blockSize*8).to_bytes(blockSize, "little") )
+                remaining = remaining - blockSize
+        self._fileList.append(path)
+
+    def addTinyFiles(self, count, folderCount=100):
+        """@brief Add many small files spread over a number of folders.
+           @param count The number of files.
+           @param folderCount The number of folders to spread them over."""
+        for index in range(0, count):
+            path = os.path.join(self._root, "tiny", "dir{:04d}".format(index%folderCount), "file{:07d}.txt".format(index))
+            self._writeFile(path, self._random.randint(0, 4096))
+
+    def addHugeFiles(self, count, sizeMB):
+        """@brief Add a few large files.
+           @param count The number of files.
+           @param sizeMB The size of each file in MB."""
+        for index in range(0, count):
+            self._writeFile(os.path.join(self._root, "huge", "file{:03d}.bin".format(index)), sizeMB*1048576)
+
+    def addDeepTree(self, depth, filesPerLevel):
+        """@brief Add a deeply nested set of folders.
+           @param depth The number of nested folders.
+           @param filesPerLevel The number of files in each folder."""
+        path = os.path.join(self._root, "deep")
+        for level in range(0, depth):
+            path = os.path.join(path, "level{:03d}".format(level))
+            for index in range(0, filesPerLevel):
+                self._writeFile(os.path.join(path, "file{:03d}.dat".format(index)), self._random.randint(0, 16384))
+
+    def churn(self, fraction):
+        """@brief Change the tree as happens between backups. Files are modified,
+                  deleted and added in equal numbers.
+           @param fraction The fraction of the files to change."""
+        changeCount = max(1, int(len(self._fileList)*fraction/3))
+        for path in self._random.sample(self._fileList, min(len(self._fileList), changeCount*2)):
+            self._fileList.remove(path)
+            if changeCount > 0:
+                self._writeFile(path, self._random.randint(0, 8192))
+                changeCount = changeCount - 1
+            else:
+                os.remove(path)
+        for index in range(0, max(1, int(len(self._fileList)*fraction/3))):
+            self._writeFile(os.path.join(self._root, "churn", "new{:07d}_{}.txt".format(index, self._random.randint(0, 1E9))), self._random.randint(0, 8192))
+
+class BackupBenchmark(object):
+    """@brief Responsible for timing the backup, incremental backup, catalog and purge
+              operations of pbackup against a local dest folder."""
+
+    RESULTS_VERSION                 = 1
+    SCALES                          = {"small":  {"tinyFiles": 2000,    "hugeFiles": 2, "hugeFileMB": 16,  "depth": 50,  "snapshots": 200},
+                                       "medium": {"tinyFiles": 50000,   "hugeFiles": 4, "hugeFileMB": 256, "depth": 200, "snapshots": 500},
+                                       "large":  {"tinyFiles": 500000,  "hugeFiles": 8, "hugeFileMB": 1024,"depth": 500, "snapshots": 1000}}
+
+    def __init__(self, uo, workDir, scale, seed, repeat):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param workDir The folder in which the src and dest folders are created.
+           @param scale The name of the scale (one of the SCALES keys).
+           @param seed The seed used when creating the src tree.
+           @param repeat The number of times each catalog lookup is repeated."""
+        self._uo        = uo
+        self._workDir   = workDir
+        self._scale     = BackupBenchmark.SCALES[scale]
+        self._scaleName = scale
+        self._seed      = seed
+        self._repeat    = repeat
+        self._results   = {}
+        self._backupUOList = []
+
+    def _getBackup(self, src, dest, argList=[]):
+        """@brief Create a Backup instance as the pbackup command line would.
+           @param src The src path.
+           @param dest The dest path.
+           @param argList Extra command line arguments.
+           @return The Backup instance."""
+        if src:
+            argList = ["--src", src] + argList
+        options, _ = getOptionParser().parse_args(["--dest", dest, "--max_daily_backups", "1000000", "--progress_interval", "0", "--log", os.path.join(self._workDir, "benchmark.log")] + argList)
+        #Keep the benchmark output to the results
+        uo = UO()
+        self._backupUOList.append(uo)
+        with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+            return Backup(uo, options)
+
+    def _time(self, name, method):
+        """@brief Time a method call and record the result.
+           @param name The name of the result.
+           @param method The method to call."""
+        with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+            startTime = time.perf_counter()
+            method()
+            seconds = time.perf_counter() - startTime
+        self._results[name] = seconds
+        self._uo.info("{:<40} {:>10.3f} seconds".format(name, seconds))
+
+    def _benchmarkBackups(self):
+        """@brief Time full and incremental backups of a synthetic src tree."""
+        src = os.path.join(self._workDir, "src")
+        dest = os.path.join(self._workDir, "dest")
+        self._uo.info("Creating src tree in {}".format(src))
+        treeGenerator = TreeGenerator(src, self._seed)
+        treeGenerator.addTinyFiles(self._scale["tinyFiles"])
+        treeGenerator.addHugeFiles(self._scale["hugeFiles"], self._scale["hugeFileMB"])
+        treeGenerator.addDeepTree(self._scale["depth"], 2)
+
+        self._time("full_backup", self._getBackup(src, dest).execute)
+        self._time("incremental_unchanged", self._getBackup(src, dest).execute)
+        treeGenerator.churn(0.1)
+        self._time("incremental_10pc_churn", self._getBackup(src, dest).execute)
+        self._time("report", self._getBackup(None, dest, ["--report"]).report)
+
+        #Create more full backup sets and time purging them
+        with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+            for _ in range(0, 2):
+                self._getBackup(src, dest, ["--max_inc", "0", "--max_full", "100"]).execute()
+        self._time("purge", self._getBackup(src, dest, ["--max_full", "2"])._purgeBackups)
+
+    def _benchmarkCatalog(self):
+        """@brief Time finding the next backup over a dest folder holding many backups."""
+        dest = os.path.join(self._workDir, "catalog_dest")
+        os.makedirs(dest)
+        snapshotCount = self._scale["snapshots"]
+        maxInc = 50
+        for index in range(0, snapshotCount):
+            fullID = int(index/(maxInc+1)) + 1
+            incrID = index%(maxInc+1)
+            timeStamp = time.strftime(SnapshotRecord.TIMESTAMP_FORMAT, time.gmtime(time.time() - (snapshotCount-index)*3600))
+            if incrID == 0:
+                name = "{}.{}_{}".format(timeStamp, Backup.FULL_BACKUP_DIR_TEXT, fullID)
+            else:
+                name = "{}.{}_{}_{}_{}".format(timeStamp, Backup.FULL_BACKUP_DIR_TEXT, fullID, Backup.INCREMENTAL_BACKUP_DIR_TEXT, incrID)
+            os.makedirs(os.path.join(dest, name))
+            #Other files that are often found in the dest folder
+            with open(os.path.join(dest, "other{}.txt".format(index)), 'w'):
+                pass
+
+        def lookups():
+            backup = self._getBackup(self._workDir, dest, ["--max_inc", str(maxInc), "--max_full", "1000"])
+            for _ in range(0, self._repeat):
+                backupDest = backup._getBackupDest()
+                backup._getFullBackupPath(backupDest)
+                backup._getLastBackupPath(backupDest)
+                backup._getBackupsToday()
+                backup._getFullBackupCount()
+
+        #The first run has no catalog file and so must read the dest folder
+        self._time("catalog_lookups_cold", lookups)
+        self._time("catalog_lookups_warm", lookups)
+
+    def run(self):
+        """@brief Run all the benchmarks.
+           @return A dict holding the results."""
+        self._results = {}
+        try:
+            self._benchmarkBackups()
+            self._benchmarkCatalog()
+        finally:
+            #Close the log files before the work folder is removed
+            for uo in self._backupUOList:
+                uo.closeLog()
+            self._backupUOList = []
+        return {"version":  BackupBenchmark.RESULTS_VERSION,
+                "scale":    self._scaleName,
+                "seed":     self._seed,
+                "python":   platform.python_version(),
+                "platform": platform.platform(),
+                "time":     time.time(),
+                "results":  self._results}
+
+    @staticmethod
+    def Compare(uo, results, baseline, threshold):
+        """@brief Compare results against a baseline.
+           @param uo The UO instance used to report the comparison.
+           @param results The dict returned by run().
+           @param baseline A dict returned by run() previously.
+           @param threshold The fractional slow down that counts as a regression (E.G 0.1 = 10%).
+           @return A list of the names of the results that have regressed."""
+        regressionList = []
+        if baseline.get("scale") != results.get("scale"):
+            uo.warn("The baseline scale ({}) is not the same as this scale ({}).".format(baseline.get("scale"), results.get("scale")))
+
+        uo.info("{:<40} {:>12} {:>12} {:>8}".format("BENCHMARK", "BASELINE", "THIS RUN", "CHANGE"))
+        for name, seconds in sorted(results["results"].items()):
+            baselineSeconds = baseline["results"].get(name)
+            if not baselineSeconds:
+                uo.info("{:<40} {:>12} {:>12.3f}".format(name, "-", seconds))
+                continue
+
+            change = (seconds-baselineSeconds)/baselineSeconds
+            marker = ""
+            if change > threshold:
+                regressionList.append(name)
+                marker = " REGRESSION"
+            uo.info("{:<40} {:>12.3f} {:>12.3f} {:>+7.1f}%{}".format(name, baselineSeconds, seconds, change*100, marker))
+
+        return regressionList
+
+def main():
+    uo = UO()
+
+    opts=OptionParser(usage="\n\
+     Measure the performance of pbackup on synthetic source trees using a local dest folder.\n\
+     The results are saved as JSON and can be compared against a previous (baseline) run.")
+
+    opts.add_option("--scale",                  help="Followed by the size of the synthetic source tree. One of {} (default = small).".format(", ".join(BackupBenchmark.SCALES.keys())), type="choice", choices=list(BackupBenchmark.SCALES.keys()), default="small")
+    opts.add_option("--seed",                   help="Followed by the seed used to create the source tree (default = 1).", type="int", default=1)
+    opts.add_option("--repeat",                 help="Followed by the number of times each catalog lookup is repeated (default = 100).", type="int", default=100)
+    opts.add_option("--work_dir",               help="Followed by the folder in which to create the source and dest folders (default = a temporary folder). This is deleted when the benchmark completes.", default=None)
+    opts.add_option("--output",                 help="Followed by the JSON file to save the results to (optional).", default=None)
+    opts.add_option("--baseline",               help="Followed by a JSON results file from a previous run to compare against (optional).", default=None)
+    opts.add_option("--threshold",              help="Followed by the percentage slow down compared to the baseline that is reported as a regression (default = 10).", type="float", default=10.0)
+    opts.add_option("--rsync",                  help="Followed by the rsync program to use (default = {}).".format(Backup.RSYNC_CMD), default=Backup.RSYNC_CMD)
+    opts.add_option("-d", "--debug",            help="Enable debugging.", action="store_true", default=False)
+
+    try:
+        (options, args) = opts.parse_args()
+
+        Backup.RSYNC_CMD = options.rsync
+        if not os.path.isfile(Backup.RSYNC_CMD):
+            raise BackupError("{} file not found on the local machine. Please install rsync and try again.".format(Backup.RSYNC_CMD))
+
+        if options.work_dir:
+            if os.path.exists(options.work_dir):
+                raise BackupError("{} already exists.".format(options.work_dir))
+            workDir = options.work_dir
+            os.makedirs(workDir)
+        else:
+            workDir = tempfile.mkdtemp(prefix="pbackup_benchmark_")
+
+        try:
+            results = BackupBenchmark(uo, workDir, options.scale, options.seed, options.repeat).run()
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+        if options.output:
+            with open(options.output, 'w') as fd:
+                json.dump(results, fd, indent=4, sort_keys=True)
+            uo.info("Saved results to {}".format(options.output))
+        else:
+            print(json.dumps(results, indent=4, sort_keys=True))
+
+        if options.baseline:
+            with open(options.baseline, 'r') as fd:
+                baseline = json.load(fd)
+            regressionList = BackupBenchmark.Compare(uo, results, baseline, options.threshold/100)
+            if regressionList:
+                uo.error("{} benchmarks regressed: {}".format(len(regressionList), ", ".join(regressionList)))
+                sys.exit(1)
+
+    #Don't print error information if CTRL C pressed
+    except KeyboardInterrupt:
+      pass
+
+    except Exception as e:
+        uo.error(str(e))
+        if options.debug:
+            raise
+        sys.exit(1)
+
+if __name__== '__main__':
+    main()
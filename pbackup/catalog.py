@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+import  os
+import  re
+import  time
+import  calendar
+import  json
+import  threading
+
+class SnapshotRecord(object):
+    """@brief Responsible for holding the details of a single backup folder in the dest path."""
+
+    FULL_TEXT                       = "FULL"
+    INCR_TEXT                       = "INCR"
+    INCOMPLETE_SUFFIX               = "incomplete"
+    NOT_STARTED_SUFFIX              = "not_started"
+    ARCHIVED_SUFFIX                 = "archived"
+    TIMESTAMP_FORMAT                = "%Y-%b-%d_%H_%M_%S"
+
+    STATE_COMPLETE                  = "complete"
+    STATE_INCOMPLETE                = INCOMPLETE_SUFFIX
+    STATE_NOT_STARTED               = NOT_STARTED_SUFFIX
+    #The backup folder has been packed into an archive folder (see pbackup.archive)
+    STATE_ARCHIVED                  = ARCHIVED_SUFFIX
+
+    #E.G 2022-Jun-02_06_06_33.FULL_1_INCR_1.incomplete
+    NAME_REGEX                      = re.compile(r"^(?P<timeStamp>\d{{4}}-[^_.]+-\d{{2}}_\d{{2}}_\d{{2}}_\d{{2}})\.{}_(?P<fullID>\d+)(_{}_(?P<incrID>\d+))?(\.(?P<suffix>{}|{}|{}))?$".format(FULL_TEXT, INCR_TEXT, INCOMPLETE_SUFFIX, NOT_STARTED_SUFFIX, ARCHIVED_SUFFIX))
+
+    @staticmethod
+    def Parse(name):
+        """@brief Parse a backup folder name.
+           @param name The name of the folder in the dest path.
+           @return A SnapshotRecord instance or None if the name is not a backup folder name."""
+        match = SnapshotRecord.NAME_REGEX.match(name)
+        if not match:
+            return None
+
+        try:
+            timeStamp = calendar.timegm( time.strptime(match.group("timeStamp"), SnapshotRecord.TIMESTAMP_FORMAT) )
+        except ValueError:
+            #The month name may have been written under a different locale
+            timeStamp = None
+
+        incrID = match.group("incrID")
+        if incrID is not None:
+            incrID = int(incrID)
+
+        state = SnapshotRecord.STATE_COMPLETE
+        if match.group("suffix"):
+            state = match.group("suffix")
+
+        return SnapshotRecord(name, timeStamp, int(match.group("fullID")), incrID, state)
+
+    @staticmethod
+    def FromDict(recordDict):
+        """@brief Create a SnapshotRecord from a dict created by toDict()
+           @param recordDict The dict.
+           @return A SnapshotRecord instance."""
+        return SnapshotRecord(recordDict["name"], recordDict["timeStamp"], recordDict["fullID"], recordDict["incrID"], recordDict["state"])
+
+    def __init__(self, name, timeStamp, fullID, incrID, state):
+        """@brief Constructor
+           @param name The name of the folder in the dest path.
+           @param timeStamp The time (seconds since the epoch, UTC) the backup was started or None if unknown.
+           @param fullID The full backup ID.
+           @param incrID The incremental backup ID or None if this is a full backup.
+           @param state One of the STATE_* constants."""
+        self.name       = name
+        self.timeStamp  = timeStamp
+        self.fullID     = fullID
+        self.incrID     = incrID
+        self.state      = state
+
+    def isFull(self):
+        """@return True if this is a full backup."""
+        return self.incrID is None
+
+    def isComplete(self):
+        """@return True if the backup completed successfully."""
+        return self.state == SnapshotRecord.STATE_COMPLETE
+
+    def isArchived(self):
+        """@return True if the backup completed successfully and has since been archived."""
+        return self.state == SnapshotRecord.STATE_ARCHIVED
+
+    def getSortKey(self):
+        """@return A key that sorts backups into the order they were created."""
+        incrID = self.incrID
+        if incrID is None:
+            incrID = -1
+        return (self.fullID, incrID, self.timeStamp or 0, self.name)
+
+    def toDict(self):
+        """@return This record as a dict that can be saved as JSON."""
+        return {"name":         self.name,
+                "timeStamp":    self.timeStamp,
+                "fullID":       self.fullID,
+                "incrID":       self.incrID,
+                "state":        self.state}
+
+class SnapshotCatalog(object):
+    """@brief Responsible for holding the list of backup folders in the dest path.
+              The list is saved to an index file so that the dest path only needs to be
+              read again when its modification time shows that it has changed."""
+
+    INDEX_VERSION                   = 1
+
+    def __init__(self, dest, indexFile):
+        """@brief Constructor
+           @param dest The dest path holding the backups.
+           @param indexFile The file to save the catalog in."""
+        self._dest          = dest
+        self._indexFile     = indexFile
+        self._recordDict    = None
+        self._destMTimeNs   = None
+        self._lock          = threading.RLock()
+
+    def _getDestMTimeNs(self):
+        """@return The modification time of the dest path."""
+        return os.stat(self._dest).st_mtime_ns
+
+    def _load(self):
+        """@brief Load the index file if not already loaded and reconcile the catalog with the dest path
+                  if the dest path has changed since it was last read. The dest path modification time
+                  is checked on every call so that a long running process sees backup folders created
+                  or removed by other processes."""
+        if self._recordDict is None and os.path.isfile(self._indexFile):
+            try:
+                with open(self._indexFile, 'r') as fd:
+                    index = json.load(fd)
+                if index.get("version") == SnapshotCatalog.INDEX_VERSION:
+                    loadedDict = {}
+                    for recordDict in index["records"]:
+                        record = SnapshotRecord.FromDict(recordDict)
+                        loadedDict[record.name] = record
+                    self._recordDict = loadedDict
+                    self._destMTimeNs = index["destMTimeNs"]
+            except (ValueError, KeyError, TypeError):
+                self._recordDict = None
+
+        if self._recordDict is None or self._destMTimeNs != self._getDestMTimeNs():
+            self.reconcile()
+
+    def _save(self):
+        """@brief Save the catalog to the index file. The dest path modification time saved is the one
+                  read when the dest path was last reconciled (not the current one) so that changes
+                  made to the dest path since then are picked up by the next _load()."""
+        index = {"version":     SnapshotCatalog.INDEX_VERSION,
+                 "destMTimeNs": self._destMTimeNs,
+                 "records":     [record.toDict() for record in self._recordDict.values()]}
+
+        indexDir = os.path.dirname(self._indexFile)
+        if not os.path.isdir(indexDir):
+            os.makedirs(indexDir)
+
+        tmpFile = "{}.tmp".format(self._indexFile)
+        with open(tmpFile, 'w') as fd:
+            json.dump(index, fd)
+        os.replace(tmpFile, self._indexFile)
+
+    def reconcile(self):
+        """@brief Read the dest path and update the catalog to match it."""
+        with self._lock:
+            #Read the modification time before the folder so that a change made while it is
+            #being read is seen by the next _load()
+            destMTimeNs = self._getDestMTimeNs()
+            recordDict = {}
+            with os.scandir(self._dest) as entryIter:
+                for entry in entryIter:
+                    #Reuse the record if we already have it as the name does not change
+                    record = None
+                    if self._recordDict:
+                        record = self._recordDict.get(entry.name)
+                    if record is None:
+                        record = SnapshotRecord.Parse(entry.name)
+                    if record:
+                        recordDict[entry.name] = record
+
+            self._recordDict = recordDict
+            self._destMTimeNs = destMTimeNs
+            self._save()
+
+    def add(self, name):
+        """@brief Add a backup folder that has been created in the dest path.
+           @param name The name of the backup folder."""
+        with self._lock:
+            self._load()
+            record = SnapshotRecord.Parse(name)
+            if record:
+                self._recordDict[name] = record
+            self._save()
+
+    def remove(self, name):
+        """@brief Remove a backup folder that has been deleted from the dest path.
+           @param name The name of the backup folder."""
+        with self._lock:
+            self._load()
+            self._recordDict.pop(name, None)
+            self._save()
+
+    def rename(self, oldName, newName):
+        """@brief Update the catalog after a backup folder has been renamed.
+           @param oldName The previous name of the backup folder.
+           @param newName The new name of the backup folder."""
+        with self._lock:
+            self._load()
+            self._recordDict.pop(oldName, None)
+            record = SnapshotRecord.Parse(newName)
+            if record:
+                self._recordDict[newName] = record
+            self._save()
+
+    def get(self, name):
+        """@brief Get the record of a backup folder.
+           @param name The name of the backup folder.
+           @return The SnapshotRecord or None if not found."""
+        with self._lock:
+            self._load()
+            return self._recordDict.get(name)
+
+    def getRecords(self, completeOnly=False):
+        """@brief Get the records of the backups in the dest path.
+           @param completeOnly If True only backups that completed successfully are returned.
+           @return A list of SnapshotRecord instances sorted into the order they were created."""
+        with self._lock:
+            self._load()
+            recordList = list(self._recordDict.values())
+
+        if completeOnly:
+            recordList = [record for record in recordList if record.isComplete()]
+
+        recordList.sort(key=lambda record: record.getSortKey())
+        return recordList
+
+    def getLastFull(self):
+        """@return The record of the latest complete full backup or None if there are no full backups."""
+        fullRecordList = [record for record in self.getRecords(completeOnly=True) if record.isFull()]
+        if fullRecordList:
+            return fullRecordList[-1]
+        return None
+
+    def getFull(self, fullID):
+        """@brief Get the complete full backup with the given ID.
+           @param fullID The full backup ID.
+           @return The SnapshotRecord or None if not found."""
+        for record in self.getRecords(completeOnly=True):
+            if record.isFull() and record.fullID == fullID:
+                return record
+        return None
+
+    def getIncrementals(self, fullID, completeOnly=False):
+        """@brief Get the incremental backups made against a full backup.
+           @param fullID The full backup ID.
+           @param completeOnly If True only backups that completed successfully are returned.
+           @return A list of SnapshotRecord instances sorted by incremental backup ID."""
+        return [record for record in self.getRecords(completeOnly=completeOnly) if not record.isFull() and record.fullID == fullID]
+
+    def getIncremental(self, fullID, incrID):
+        """@brief Get the complete incremental backup with the given IDs.
+           @param fullID The full backup ID.
+           @param incrID The incremental backup ID.
+           @return The SnapshotRecord or None if not found."""
+        for record in self.getIncrementals(fullID, completeOnly=True):
+            if record.incrID == incrID:
+                return record
+        return None
+
+    def getFullCount(self):
+        """@return The number of full backup folders (complete or not) in the dest path."""
+        return len([record for record in self.getRecords() if record.isFull()])
+
+    def getCount(self, namePrefix):
+        """@brief Get the number of backup folders whose name starts with the given text.
+           @param namePrefix The start of the name (E.G the date part of the timestamp).
+           @return The number of backup folders."""
+        return len([record for record in self.getRecords() if record.name.startswith(namePrefix)])
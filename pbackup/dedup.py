@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+import  os
+import  stat
+import  errno
+import  hashlib
+import  sqlite3
+from    concurrent.futures import ThreadPoolExecutor
+
+class SnapshotDeduplicator(object):
+    """@brief Responsible for replacing files in a backup that have the same contents as a file
+              in another backup (or elsewhere in the same backup) with hard links.
+
+              rsync only hard links a file to the last backup if it has not changed and is at
+              the same path, so moved or copied files are stored again. The hash of every file
+              that is not already hard linked is held in an index in the dest path so each
+              file is only read once."""
+
+    DEFAULT_THREAD_COUNT            = 4
+    #Small files use little more space than the inode a hard link saves
+    DEFAULT_MIN_SIZE                = 4096
+    READ_SIZE                       = 1048576
+    TMP_LINK_SUFFIX                 = ".pbackup_dedup"
+
+    def __init__(self, uo, dest, indexFile, threadCount=DEFAULT_THREAD_COUNT, minSize=DEFAULT_MIN_SIZE):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param dest The dest path holding the backups.
+           @param indexFile The sqlite file holding the index of file hashes.
+           @param threadCount The number of files to hash at the same time.
+           @param minSize Files smaller than this (bytes) are not deduplicated."""
+        self._uo            = uo
+        self._dest          = os.fsencode(dest)
+        self._indexFile     = indexFile
+        self._threadCount   = threadCount
+        self._minSize       = minSize
+
+    def _openIndex(self):
+        """@brief Open the index, creating it if required.
+           @return The sqlite3 connection."""
+        connection = sqlite3.connect(self._indexFile)
+        connection.execute("CREATE TABLE IF NOT EXISTS files (hash BLOB, size INTEGER, mode INTEGER, uid INTEGER, gid INTEGER, mtime_ns INTEGER, path BLOB, "\
+                           "PRIMARY KEY (hash, size, mode, uid, gid, mtime_ns))")
+        return connection
+
+    def _getFiles(self, backupName):
+        """@brief Find the files in a backup that may be deduplicated.
+           @param backupName The name of the backup folder.
+           @return A list of (path, os.stat_result) tuples. Each path is bytes and relative to the dest path."""
+        fileList = []
+        dirList = [os.fsencode(backupName)]
+        while dirList:
+            dirPath = dirList.pop()
+            with os.scandir(os.path.join(self._dest, dirPath)) as entryIter:
+                for entry in entryIter:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirList.append( os.path.join(dirPath, entry.name) )
+                        continue
+
+                    entryStat = entry.stat(follow_symlinks=False)
+                    #Files with more than one link are already shared with another backup
+                    if stat.S_ISREG(entryStat.st_mode) and entryStat.st_nlink == 1 and entryStat.st_size >= self._minSize:
+                        fileList.append( (os.path.join(dirPath, entry.name), entryStat) )
+
+        return fileList
+
+    def _getHash(self, path):
+        """@brief Get the hash of the contents of a file.
+           @param path The path of the file (bytes) relative to the dest path.
+           @return The hash (bytes)."""
+        fileHash = hashlib.sha256()
+        with open(os.path.join(self._dest, path), 'rb') as fd:
+            while True:
+                data = fd.read(SnapshotDeduplicator.READ_SIZE)
+                if not data:
+                    break
+                fileHash.update(data)
+        return fileHash.digest()
+
+    @staticmethod
+    def _GetKey(fileHash, fileStat):
+        """@return The index key of a file. Hard linked files share their attributes so these must match as well as the contents."""
+        return (fileHash, fileStat.st_size, fileStat.st_mode, fileStat.st_uid, fileStat.st_gid, fileStat.st_mtime_ns)
+
+    def _getIndexedFile(self, connection, key, fileStat):
+        """@brief Get the file held in the index with the same key.
+           @param connection The sqlite3 connection.
+           @param key The key returned by _GetKey().
+           @param fileStat The os.stat_result of the file to be deduplicated.
+           @return The path of the indexed file (bytes, relative to the dest path) or None if not
+                   found or the indexed file has been removed or changed since it was indexed."""
+        row = connection.execute("SELECT path FROM files WHERE hash=? AND size=? AND mode=? AND uid=? AND gid=? AND mtime_ns=?", key).fetchone()
+        if row is None:
+            return None
+
+        path = bytes(row[0])
+        try:
+            indexedStat = os.lstat(os.path.join(self._dest, path))
+        except FileNotFoundError:
+            #The backup holding the file has been purged
+            return None
+
+        if not stat.S_ISREG(indexedStat.st_mode) or self._GetKey(key[0], indexedStat) != key:
+            return None
+
+        if indexedStat.st_dev != fileStat.st_dev or indexedStat.st_ino == fileStat.st_ino:
+            return None
+
+        return path
+
+    def _link(self, indexedPath, path):
+        """@brief Replace a file with a hard link to another file.
+           @param indexedPath The path (bytes, relative to the dest path) of the file to link to.
+           @param path The path (bytes, relative to the dest path) of the file to replace."""
+        absPath = os.path.join(self._dest, path)
+        tmpPath = absPath + os.fsencode(SnapshotDeduplicator.TMP_LINK_SUFFIX)
+        os.link(os.path.join(self._dest, indexedPath), tmpPath)
+        try:
+            os.replace(tmpPath, absPath)
+        except:
+            os.remove(tmpPath)
+            raise
+
+    def deduplicate(self, backupName):
+        """@brief Replace the files in a backup that are held elsewhere in the dest path with hard links.
+           @param backupName The name of the complete backup folder.
+           @return A tuple containing the number of files replaced and the number of bytes of disk space freed."""
+        fileList = self._getFiles(backupName)
+        self._uo.info("Deduplicating {} files in {}".format(len(fileList), backupName))
+
+        linkedCount = 0
+        freedBytes = 0
+        connection = self._openIndex()
+        try:
+            with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+                hashIter = executor.map(self._getHash, [path for path, _ in fileList])
+                for (path, fileStat), fileHash in zip(fileList, hashIter):
+                    key = self._GetKey(fileHash, fileStat)
+                    indexedPath = self._getIndexedFile(connection, key, fileStat)
+                    if indexedPath is not None:
+                        try:
+                            self._link(indexedPath, path)
+                            linkedCount = linkedCount + 1
+                            freedBytes = freedBytes + fileStat.st_blocks*512
+                            continue
+
+                        except OSError as e:
+                            #If the indexed file has the maximum number of links use this file for later links
+                            if e.errno != errno.EMLINK:
+                                raise
+
+                    connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", key + (path,))
+
+            connection.commit()
+
+        finally:
+            connection.close()
+
+        self._uo.info("Replaced {} files with hard links, freeing {:.3f} GB.".format(linkedCount, freedBytes/(2**30)))
+        return (linkedCount, freedBytes)
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+import  os
+import  stat
+from    concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class SnapshotDiff(object):
+    """@brief Responsible for finding the differences between two backups without reading the
+              file contents. Files that rsync hard linked to the previous backup share an inode
+              so a file is unchanged if it has the same inode in both backups (or the same type,
+              size, mode and modification time if it was copied again)."""
+
+    ADDED                           = "added"
+    REMOVED                         = "removed"
+    MODIFIED                        = "modified"
+    CHANGE_TYPES                    = (ADDED, REMOVED, MODIFIED)
+    DEFAULT_THREAD_COUNT            = 8
+
+    def __init__(self, backupPathA, backupPathB, threadCount=DEFAULT_THREAD_COUNT):
+        """@brief Constructor
+           @param backupPathA The older backup folder.
+           @param backupPathB The newer backup folder.
+           @param threadCount The number of folders to read at the same time."""
+        self._backupPathA   = backupPathA
+        self._backupPathB   = backupPathB
+        self._threadCount   = threadCount
+
+    def _listDir(self, path):
+        """@brief Read a folder.
+           @param path The folder path.
+           @return A dict. Each key is a name and each value the os.stat_result of the entry.
+                   Empty if the folder does not exist."""
+        entryDict = {}
+        try:
+            with os.scandir(path) as entryIter:
+                for entry in entryIter:
+                    entryDict[entry.name] = entry.stat(follow_symlinks=False)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return entryDict
+
+    @staticmethod
+    def _IsUnchanged(statA, statB):
+        """@return True if a path is the same in both backups."""
+        if statA.st_ino == statB.st_ino and statA.st_dev == statB.st_dev:
+            return True
+        return stat.S_IFMT(statA.st_mode) == stat.S_IFMT(statB.st_mode) and statA.st_mode == statB.st_mode and \
+               statA.st_size == statB.st_size and statA.st_mtime_ns == statB.st_mtime_ns and \
+               statA.st_uid == statB.st_uid and statA.st_gid == statB.st_gid
+
+    def _compareDir(self, relPath, inA, inB):
+        """@brief Compare a folder in both backups.
+           @param relPath The path of the folder relative to the backup folders.
+           @param inA True if the folder is in the older backup.
+           @param inB True if the folder is in the newer backup.
+           @return A tuple of the list of folders still to compare (as arguments to this
+                   method) and the list of changes. Each change is a tuple of the change
+                   type, path and size in bytes."""
+        entryDictA = self._listDir(os.path.join(self._backupPathA, relPath)) if inA else {}
+        entryDictB = self._listDir(os.path.join(self._backupPathB, relPath)) if inB else {}
+
+        dirList = []
+        changeList = []
+        for name in set(entryDictA.keys()) | set(entryDictB.keys()):
+            path = os.path.join(relPath, name) if relPath else name
+            statA = entryDictA.get(name)
+            statB = entryDictB.get(name)
+            isDirA = statA is not None and stat.S_ISDIR(statA.st_mode)
+            isDirB = statB is not None and stat.S_ISDIR(statB.st_mode)
+
+            if isDirA or isDirB:
+                dirList.append( (path, isDirA, isDirB) )
+
+            if statA is not None and not isDirA:
+                if statB is None or isDirB:
+                    changeList.append( (SnapshotDiff.REMOVED, path, statA.st_size) )
+                elif not self._IsUnchanged(statA, statB):
+                    changeList.append( (SnapshotDiff.MODIFIED, path, statB.st_size) )
+
+            if statB is not None and not isDirB and (statA is None or isDirA):
+                changeList.append( (SnapshotDiff.ADDED, path, statB.st_size) )
+
+        return (dirList, changeList)
+
+    def compare(self):
+        """@brief Compare the backups. Folders are read in parallel.
+           @return A list of the changes. Each change is a tuple of the change type (one of
+                   CHANGE_TYPES), the path relative to the backup folders and the size in bytes
+                   (the size in the newer backup for modified files)."""
+        changeList = []
+        with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+            futureSet = set([executor.submit(self._compareDir, "", True, True)])
+            while futureSet:
+                doneSet, futureSet = wait(futureSet, return_when=FIRST_COMPLETED)
+                for future in doneSet:
+                    dirList, dirChangeList = future.result()
+                    changeList.extend(dirChangeList)
+                    for dirArgs in dirList:
+                        futureSet.add( executor.submit(self._compareDir, *dirArgs) )
+
+        changeList.sort(key=lambda change: change[1])
+        return changeList
+
+    @staticmethod
+    def GetDirSummary(changeList):
+        """@brief Total the changes in each folder.
+           @param changeList The list returned by compare().
+           @return A dict. Each key is a folder path (relative to the backup folders, . for the top
+                   level folder) and each value is a dict holding the count and bytes of each change type."""
+        summaryDict = {}
+        for changeType, path, size in changeList:
+            dirPath = os.path.dirname(path) or "."
+            if dirPath not in summaryDict:
+                summaryDict[dirPath] = {}
+                for summaryChangeType in SnapshotDiff.CHANGE_TYPES:
+                    summaryDict[dirPath][summaryChangeType] = 0
+                    summaryDict[dirPath]["{}_bytes".format(summaryChangeType)] = 0
+            summaryDict[dirPath][changeType] = summaryDict[dirPath][changeType] + 1
+            summaryDict[dirPath]["{}_bytes".format(changeType)] = summaryDict[dirPath]["{}_bytes".format(changeType)] + size
+        return summaryDict
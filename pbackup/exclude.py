@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+import  os
+from    concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class ExclusionCompiler(object):
+    """@brief Responsible for building the list of rsync exclude patterns for a backup and
+              writing it to the file passed to rsync with --exclude-from, so that long lists
+              of patterns are not limited by the command line length or shell quoting."""
+
+    WILDCARD_CHARS                  = "*?["
+    #See https://bford.info/cachedir/
+    CACHEDIR_TAG_FILE               = "CACHEDIR.TAG"
+    CACHEDIR_TAG_SIGNATURE          = b"Signature: 8a477f597d28d172789f06886806bc55"
+    DEFAULT_THREAD_COUNT            = 4
+
+    def __init__(self, src):
+        """@brief Constructor
+           @param src The local src path or the path on the remote machine."""
+        self._src           = src
+        self._patternList   = []
+        self._patternSet    = set()
+
+    @staticmethod
+    def _HasWildcard(pattern):
+        """@return True if rsync treats the pattern as a wildcard pattern."""
+        for char in ExclusionCompiler.WILDCARD_CHARS:
+            if pattern.find(char) >= 0:
+                return True
+        return False
+
+    @staticmethod
+    def _Escape(name):
+        """@return A path that rsync matches literally even if it holds wildcard characters."""
+        if not ExclusionCompiler._HasWildcard(name):
+            return name
+        return "".join(["\\{}".format(char) if char in ExclusionCompiler.WILDCARD_CHARS+"\\" else char for char in name])
+
+    def _normalise(self, pattern):
+        """@brief Normalise a pattern so that patterns that match the same paths are the same text.
+           @param pattern The pattern.
+           @return The normalised pattern or an empty string if the pattern is empty."""
+        pattern = pattern.strip()
+        #Keep the / after the src path so the pattern stays anchored at the top of the transfer
+        srcPrefix = self._src.rstrip("/")
+        if srcPrefix and pattern.startswith(srcPrefix + "/"):
+            pattern = pattern[len(srcPrefix):]
+        while pattern.find("//") >= 0:
+            pattern = pattern.replace("//", "/")
+        while pattern.startswith("./"):
+            pattern = pattern[2:]
+        return pattern
+
+    def add(self, pattern):
+        """@brief Add an exclude pattern. Patterns already added are ignored.
+           @param pattern The rsync exclude pattern (E.G home/auser/.cache or *.tmp). If the pattern
+                          starts with the src path the src path is removed leaving a pattern
+                          anchored at the top of the src path (E.G /.cache).
+           @return The normalised pattern or an empty string if the pattern was empty."""
+        pattern = self._normalise(pattern)
+        if pattern and pattern not in self._patternSet:
+            self._patternSet.add(pattern)
+            self._patternList.append(pattern)
+        return pattern
+
+    def addFolderName(self, name):
+        """@brief Exclude every folder with a name (E.G __pycache__) wherever it is found in the src path.
+           @param name The folder name. This may include wildcard characters."""
+        name = name.strip().strip("/")
+        if name:
+            self.add("{}/".format(name))
+
+    def getPatterns(self):
+        """@return The list of normalised exclude patterns in the order they were added."""
+        return list(self._patternList)
+
+    @staticmethod
+    def GetMissingPaths(src, patternList):
+        """@brief Find the patterns without wildcard characters that do not match a path in the src path.
+           @param src The local src path.
+           @param patternList The patterns.
+           @return The list of the missing paths."""
+        missingList = []
+        for pattern in patternList:
+            if not ExclusionCompiler._HasWildcard(pattern):
+                fullPath = os.path.join(src, pattern.lstrip("/"))
+                if not os.path.lexists(fullPath):
+                    missingList.append(fullPath)
+        return missingList
+
+    @staticmethod
+    def _IsCacheDir(path):
+        """@return True if a folder holds a valid CACHEDIR.TAG file."""
+        try:
+            with open(os.path.join(path, ExclusionCompiler.CACHEDIR_TAG_FILE), 'rb') as fd:
+                return fd.read(len(ExclusionCompiler.CACHEDIR_TAG_SIGNATURE)) == ExclusionCompiler.CACHEDIR_TAG_SIGNATURE
+        except OSError:
+            return False
+
+    def _scanDir(self, relPath):
+        """@brief Read a folder in the src path.
+           @param relPath The folder path relative to the src path.
+           @return A tuple of the list of the sub folders to read and the list of the sub folders that are caches."""
+        dirList = []
+        cacheDirList = []
+        try:
+            with os.scandir(os.path.join(self._src, relPath)) as entryIter:
+                for entry in entryIter:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    path = os.path.join(relPath, entry.name) if relPath else entry.name
+                    if self._IsCacheDir(entry.path):
+                        cacheDirList.append(path)
+                    else:
+                        dirList.append(path)
+        except OSError:
+            #rsync reports folders that cannot be read
+            pass
+        return (dirList, cacheDirList)
+
+    def addCacheDirs(self, threadCount=DEFAULT_THREAD_COUNT):
+        """@brief Read the local src path and exclude every folder that holds a CACHEDIR.TAG file.
+                  Folders are read in parallel.
+           @param threadCount The number of folders to read at the same time.
+           @return The list of the cache folders found (relative to the src path)."""
+        cacheDirList = []
+        with ThreadPoolExecutor(max_workers=threadCount) as executor:
+            futureSet = set([executor.submit(self._scanDir, "")])
+            while futureSet:
+                doneSet, futureSet = wait(futureSet, return_when=FIRST_COMPLETED)
+                for future in doneSet:
+                    dirList, dirCacheDirList = future.result()
+                    cacheDirList.extend(dirCacheDirList)
+                    for dirPath in dirList:
+                        futureSet.add( executor.submit(self._scanDir, dirPath) )
+
+        cacheDirList.sort()
+        for cacheDir in cacheDirList:
+            #Anchored at the top of the transfer so only this folder is excluded
+            self.add("/{}/".format(self._Escape(cacheDir)))
+        return cacheDirList
+
+    def write(self, excludeFile):
+        """@brief Write the patterns to a file for the rsync --exclude-from argument.
+           @param excludeFile The file to write."""
+        tmpFile = "{}.tmp".format(excludeFile)
+        with open(tmpFile, 'w') as fd:
+            for pattern in self._patternList:
+                #The rule prefix stops patterns starting with # or ; being read as comments
+                fd.write("- {}\n".format(pattern))
+        os.replace(tmpFile, excludeFile)
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+class SpaceForecaster(object):
+    """@brief Responsible for predicting the disk space that a backup will use from the metrics
+              of previous backup runs. Full, synthetic full and incremental backups use very
+              different amounts of space so each is predicted from earlier runs of the same type."""
+
+    TYPE_FULL                       = "full"
+    TYPE_SYNTHETIC_FULL             = "synthetic_full"
+    TYPE_INCREMENTAL                = "incremental"
+    #The number of earlier runs of the same type that the prediction is made from
+    HISTORY_RUN_COUNT               = 10
+
+    def __init__(self, historyList):
+        """@brief Constructor
+           @param historyList The metrics of previous runs (as returned by RunMetrics.LoadHistory()), oldest first."""
+        self._historyList = [history for history in historyList if history.get("success")]
+
+    @staticmethod
+    def _GetType(history):
+        """@return The type of backup (one of the TYPE_* constants) that a run made."""
+        if history.get("synthetic_full"):
+            return SpaceForecaster.TYPE_SYNTHETIC_FULL
+        return history.get("backup_type")
+
+    @staticmethod
+    def _GetUsedBytes(history):
+        """@return The disk space used by a run. The drop in free space is reduced if old backups
+                   were deleted while the backup ran, so the data copied is used if larger."""
+        return max(history.get("backup_size_bytes") or 0, history.get("bytes_transferred") or 0)
+
+    def getExpectedBytes(self, backupType):
+        """@brief Predict the disk space a backup will use.
+           @param backupType One of the TYPE_* constants.
+           @return The number of bytes or None if there are no earlier runs to predict from."""
+        usedList = [self._GetUsedBytes(history) for history in self._historyList if self._GetType(history) == backupType]
+        usedList = usedList[-SpaceForecaster.HISTORY_RUN_COUNT:]
+        if usedList:
+            #The largest recent run so that a busy day does not fill the disk
+            return max(usedList)
+
+        #A full backup copies every file so it uses about the total size of the last backup
+        if backupType == SpaceForecaster.TYPE_FULL:
+            totalList = [history["bytes_total"] for history in self._historyList if history.get("bytes_total")]
+            if totalList:
+                return totalList[-1]
+
+        return None
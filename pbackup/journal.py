@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+
+import  os
+import  time
+import  json
+import  uuid
+import  errno
+import  fcntl
+import  ctypes
+import  ctypes.util
+import  select
+import  struct
+import  threading
+
+class Inotify(object):
+    """@brief Responsible for providing access to the Linux inotify interface."""
+
+    IN_MODIFY                       = 0x00000002
+    IN_ATTRIB                       = 0x00000004
+    IN_CLOSE_WRITE                  = 0x00000008
+    IN_MOVED_FROM                   = 0x00000040
+    IN_MOVED_TO                     = 0x00000080
+    IN_CREATE                       = 0x00000100
+    IN_DELETE                       = 0x00000200
+    IN_DELETE_SELF                  = 0x00000400
+    IN_MOVE_SELF                    = 0x00000800
+    IN_Q_OVERFLOW                   = 0x00004000
+    IN_IGNORED                      = 0x00008000
+    IN_ONLYDIR                      = 0x01000000
+    IN_DONT_FOLLOW                  = 0x02000000
+    IN_EXCL_UNLINK                  = 0x04000000
+    IN_ISDIR                        = 0x40000000
+    IN_NONBLOCK                     = 0o4000
+    IN_CLOEXEC                      = 0o2000000
+
+    EVENT_HEADER                    = struct.Struct("iIII")
+
+    def __init__(self):
+        """@brief Constructor"""
+        libcName = ctypes.util.find_library("c")
+        if not libcName:
+            raise OSError("Unable to find the C library.")
+        self._libc = ctypes.CDLL(libcName, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not supported on this platform.")
+
+        self._fd = self._libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def fileno(self):
+        """@return The inotify file descriptor."""
+        return self._fd
+
+    def addWatch(self, path, mask):
+        """@brief Watch a folder.
+           @param path The folder path (bytes).
+           @param mask The events to watch for.
+           @return The watch descriptor."""
+        wd = self._libc.inotify_add_watch(self._fd, ctypes.c_char_p(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def removeWatch(self, wd):
+        """@brief Stop watching a folder.
+           @param wd The watch descriptor returned by addWatch()."""
+        self._libc.inotify_rm_watch(self._fd, ctypes.c_int(wd))
+
+    def read(self, timeout):
+        """@brief Read the events that have occurred.
+           @param timeout The maximum time to wait in seconds for an event.
+           @return A list of (wd, mask, cookie, name) tuples. The name is bytes."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return []
+
+        eventList = []
+        offset = 0
+        while offset + Inotify.EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, nameLength = Inotify.EVENT_HEADER.unpack_from(data, offset)
+            offset = offset + Inotify.EVENT_HEADER.size
+            name = data[offset:offset+nameLength].rstrip(b"\0")
+            offset = offset + nameLength
+            eventList.append( (wd, mask, cookie, name) )
+        return eventList
+
+    def close(self):
+        """@brief Close the inotify file descriptor."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+class ChangeJournal(object):
+    """@brief Responsible for the journal of changed paths in the src folder. The journal is
+              written by a ChangeWatcher and read by the backup.
+
+              Each watcher run has a generation ID that changes if events may have been
+              lost (E.G the inotify queue overflowed). When a backup starts it moves the
+              changes recorded so far to a pending file and when the backup completes it
+              saves a checkpoint holding the generation ID and the backup name. The next
+              backup may only use the journal if the watcher generation is unchanged since
+              the checkpoint and it links to the backup named in the checkpoint. Otherwise
+              rsync reads the whole src folder as normal."""
+
+    STATE_FILE                      = "state.json"
+    CHECKPOINT_FILE                 = "checkpoint.json"
+    CHANGES_FILE                    = "changes"
+    PENDING_FILE                    = "pending"
+    FILES_FROM_FILE                 = "files_from"
+    LOCK_FILE                       = "lock"
+    VERSION                         = 1
+    #If more paths than this have changed it is quicker for rsync to read the whole src folder
+    MAX_PATHS                       = 100000
+
+    def __init__(self, journalDir, src):
+        """@brief Constructor
+           @param journalDir The folder that holds the journal files.
+           @param src The src folder being watched."""
+        self._journalDir    = journalDir
+        self._src           = os.path.abspath(src)
+        self._generation    = None
+
+    def _getFile(self, name):
+        """@return The path of a file in the journal folder."""
+        return os.path.join(self._journalDir, name)
+
+    def _lock(self):
+        """@brief Lock the journal files.
+           @return The lock file object. Closing it releases the lock."""
+        if not os.path.isdir(self._journalDir):
+            os.makedirs(self._journalDir)
+        fd = open(self._getFile(ChangeJournal.LOCK_FILE), 'a')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _loadJSON(self, name):
+        """@brief Load a JSON journal file.
+           @param name The file name.
+           @return The dict held in the file or None if not present or not valid."""
+        try:
+            with open(self._getFile(name), 'r') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def _saveJSON(self, name, valueDict):
+        """@brief Save a JSON journal file.
+           @param name The file name.
+           @param valueDict The dict to save."""
+        fileName = self._getFile(name)
+        tmpFile = "{}.tmp".format(fileName)
+        with open(tmpFile, 'w') as fd:
+            json.dump(valueDict, fd)
+        os.replace(tmpFile, fileName)
+
+    def saveState(self, generation, complete):
+        """@brief Save the state of the watcher. Called by the watcher.
+           @param generation The watcher generation ID.
+           @param complete True if every folder in the src folder is being watched."""
+        if not os.path.isdir(self._journalDir):
+            os.makedirs(self._journalDir)
+        self._saveJSON(ChangeJournal.STATE_FILE, {"version":     ChangeJournal.VERSION,
+                                                  "src":         self._src,
+                                                  "pid":         os.getpid(),
+                                                  "generation":  generation,
+                                                  "complete":    complete})
+
+    def removeState(self):
+        """@brief Remove the state of the watcher when it stops. Called by the watcher."""
+        try:
+            os.remove(self._getFile(ChangeJournal.STATE_FILE))
+        except FileNotFoundError:
+            pass
+
+    def appendChanges(self, pathSet):
+        """@brief Add changed paths to the journal. Called by the watcher.
+           @param pathSet A set of paths (bytes) relative to the src folder."""
+        with self._lock():
+            with open(self._getFile(ChangeJournal.CHANGES_FILE), 'ab') as fd:
+                for path in pathSet:
+                    fd.write(path + b"\0")
+
+    def _getWatcherGeneration(self):
+        """@return The generation ID of the running watcher or None if no watcher is watching
+                   every folder of the src folder."""
+        stateDict = self._loadJSON(ChangeJournal.STATE_FILE)
+        if not stateDict or stateDict.get("version") != ChangeJournal.VERSION or stateDict.get("src") != self._src:
+            return None
+
+        if not stateDict.get("complete"):
+            return None
+
+        try:
+            os.kill(stateDict["pid"], 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+
+        return stateDict.get("generation")
+
+    def isWatched(self):
+        """@return True if a watcher is running for the src folder."""
+        return self._getWatcherGeneration() is not None
+
+    def beginBackup(self, lastBackupName):
+        """@brief Called when a backup starts. The changes recorded so far are moved to the
+                  pending file and new changes are recorded for the next backup.
+           @param lastBackupName The name of the backup that the new backup will link to.
+           @return A sorted list of the paths (bytes) that have changed since the last backup
+                   or None if the journal cannot be used and rsync must read the whole src folder."""
+        with self._lock():
+            self._generation = self._getWatcherGeneration()
+            changesFile = self._getFile(ChangeJournal.CHANGES_FILE)
+            pendingFile = self._getFile(ChangeJournal.PENDING_FILE)
+            if os.path.isfile(changesFile):
+                #Changes recorded before a backup that failed are still pending
+                with open(pendingFile, 'ab') as pendingFd, open(changesFile, 'rb') as changesFd:
+                    while True:
+                        data = changesFd.read(1048576)
+                        if not data:
+                            break
+                        pendingFd.write(data)
+                os.remove(changesFile)
+
+        if self._generation is None:
+            return None
+
+        checkpointDict = self._loadJSON(ChangeJournal.CHECKPOINT_FILE)
+        if not checkpointDict or checkpointDict.get("generation") != self._generation or checkpointDict.get("backup") != lastBackupName:
+            return None
+
+        pathSet = set()
+        if os.path.isfile(pendingFile):
+            with open(pendingFile, 'rb') as fd:
+                for path in fd.read().split(b"\0"):
+                    if path:
+                        pathSet.add(path)
+                        if len(pathSet) > ChangeJournal.MAX_PATHS:
+                            return None
+
+        return ChangeJournal.GetCompactPaths(pathSet)
+
+    def endBackup(self, backupName):
+        """@brief Called when a backup completes successfully.
+           @param backupName The name of the backup."""
+        with self._lock():
+            try:
+                os.remove(self._getFile(ChangeJournal.PENDING_FILE))
+            except FileNotFoundError:
+                pass
+
+            if self._generation is None:
+                try:
+                    os.remove(self._getFile(ChangeJournal.CHECKPOINT_FILE))
+                except FileNotFoundError:
+                    pass
+            else:
+                self._saveJSON(ChangeJournal.CHECKPOINT_FILE, {"generation": self._generation, "backup": backupName})
+
+    def writeFilesFrom(self, pathList):
+        """@brief Write the list of changed paths in the format read by the rsync --files-from and --from0 options.
+           @param pathList The list returned by beginBackup().
+           @return The file written."""
+        filesFrom = self._getFile(ChangeJournal.FILES_FROM_FILE)
+        with open(filesFrom, 'wb') as fd:
+            for path in pathList:
+                fd.write(path + b"\0")
+        return filesFrom
+
+    @staticmethod
+    def GetCompactPaths(pathSet):
+        """@brief Remove the paths inside folders that are in the set as rsync copies the
+                  whole of each folder listed.
+           @param pathSet A set of paths (bytes) relative to the src folder.
+           @return A sorted list of paths."""
+        pathList = []
+        lastFolder = None
+        for path in sorted(pathSet):
+            if lastFolder is not None and path.startswith(lastFolder):
+                continue
+            pathList.append(path)
+            lastFolder = path + b"/"
+        return pathList
+
+class ChangeWatcher(object):
+    """@brief Responsible for recording the paths that change in the src folder using inotify."""
+
+    FLUSH_SECONDS                   = 1.0
+    WATCH_MASK                      = Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_FROM | \
+                                      Inotify.IN_MOVED_TO | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_DELETE_SELF | \
+                                      Inotify.IN_MOVE_SELF | Inotify.IN_ONLYDIR | Inotify.IN_DONT_FOLLOW | Inotify.IN_EXCL_UNLINK
+
+    def __init__(self, uo, src, journal):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param src The local src folder to watch.
+           @param journal The ChangeJournal instance to record the changes in."""
+        self._uo            = uo
+        self._src           = os.fsencode(os.path.abspath(src))
+        self._journal       = journal
+        self._inotify       = None
+        #The path (bytes, relative to the src folder) of the folder watched by each watch descriptor
+        self._wdDict        = {}
+        self._pathSet       = set()
+        self._generation    = None
+        self._complete      = True
+        #False until every folder has been watched
+        self._ready         = False
+        self._stopEvent     = threading.Event()
+
+    def stop(self):
+        """@brief Stop watching."""
+        self._stopEvent.set()
+
+    def _newGeneration(self, reason):
+        """@brief Start a new generation. Backups will not use the changes recorded before this.
+           @param reason The reason for the new generation (None on startup)."""
+        if reason:
+            self._uo.warn("Changes may have been missed ({}). The next backup will read the whole src folder.".format(reason))
+        self._generation = uuid.uuid4().hex
+        self._journal.saveState(self._generation, self._complete and self._ready)
+
+    def _getAbsPath(self, relPath):
+        """@return The absolute path (bytes) of a path relative to the src folder."""
+        if relPath:
+            return os.path.join(self._src, relPath)
+        return self._src
+
+    def _addWatches(self, relPath):
+        """@brief Watch a folder and every folder inside it.
+           @param relPath The path of the folder (bytes) relative to the src folder."""
+        dirList = [relPath]
+        while dirList:
+            dirPath = dirList.pop()
+            try:
+                wd = self._inotify.addWatch(self._getAbsPath(dirPath), ChangeWatcher.WATCH_MASK)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    if self._complete:
+                        self._uo.error("Unable to watch every folder in the src folder. Increase /proc/sys/fs/inotify/max_user_watches. Backups will read the whole src folder.")
+                        self._complete = False
+                        self._newGeneration(None)
+                    return
+                #The folder was removed or is not a folder
+                continue
+
+            self._wdDict[wd] = dirPath
+            try:
+                with os.scandir(self._getAbsPath(dirPath)) as entryIter:
+                    for entry in entryIter:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirList.append( os.path.join(dirPath, entry.name) if dirPath else entry.name )
+            except OSError:
+                pass
+
+    def _renameWatches(self, oldPath, newPath):
+        """@brief Update the watched paths when a folder is moved inside the src folder.
+           @param oldPath The old path (bytes) of the folder relative to the src folder.
+           @param newPath The new path (bytes) of the folder relative to the src folder."""
+        oldPrefix = oldPath + b"/"
+        for wd, path in self._wdDict.items():
+            if path == oldPath:
+                self._wdDict[wd] = newPath
+            elif path.startswith(oldPrefix):
+                self._wdDict[wd] = newPath + path[len(oldPath):]
+
+    def _handleEvents(self, eventList):
+        """@brief Record the paths of a list of inotify events.
+           @param eventList The list returned by Inotify.read()."""
+        movedFromDict = {}
+        for wd, mask, cookie, name in eventList:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self._newGeneration("the inotify event queue overflowed")
+                continue
+
+            if wd not in self._wdDict:
+                continue
+
+            dirPath = self._wdDict[wd]
+            if mask & Inotify.IN_IGNORED:
+                del self._wdDict[wd]
+                continue
+
+            if mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+                if not dirPath:
+                    self._newGeneration("the src folder was removed")
+                continue
+
+            path = os.path.join(dirPath, name) if dirPath else name
+            self._pathSet.add(path)
+
+            if mask & Inotify.IN_ISDIR:
+                if mask & Inotify.IN_MOVED_FROM:
+                    movedFromDict[cookie] = path
+
+                elif mask & Inotify.IN_MOVED_TO and cookie in movedFromDict:
+                    self._renameWatches(movedFromDict.pop(cookie), path)
+
+                elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    #Files created in the folder before it was watched are copied as the whole folder is recorded
+                    self._addWatches(path)
+
+    def run(self):
+        """@brief Watch the src folder until stop() is called."""
+        self._inotify = Inotify()
+        try:
+            self._newGeneration(None)
+            self._uo.info("Adding watches to {}".format(os.fsdecode(self._src)))
+            self._addWatches(b"")
+            self._ready = True
+            self._journal.saveState(self._generation, self._complete)
+            self._uo.info("Watching {} folders in {}".format(len(self._wdDict), os.fsdecode(self._src)))
+
+            lastFlushTime = time.time()
+            while not self._stopEvent.is_set():
+                self._handleEvents( self._inotify.read(ChangeWatcher.FLUSH_SECONDS) )
+                if time.time() >= lastFlushTime + ChangeWatcher.FLUSH_SECONDS:
+                    if self._pathSet:
+                        self._journal.appendChanges(self._pathSet)
+                        self._pathSet = set()
+                    lastFlushTime = time.time()
+
+            if self._pathSet:
+                self._journal.appendChanges(self._pathSet)
+
+        finally:
+            self._journal.removeState()
+            self._inotify.close()
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+import  os
+import  stat
+
+class LinkDestReport(object):
+    """@brief Responsible for finding how much data rsync hard linked from each of the backups
+              passed to it with --link-dest rather than copying it. rsync does not report this
+              so the inode of each file in the new backup is compared with the file at the same
+              path in each link-dest backup."""
+
+    def __init__(self, backupPath, linkDestPathList):
+        """@brief Constructor
+           @param backupPath The new backup folder.
+           @param linkDestPathList The link-dest backup folders in the order passed to rsync."""
+        self._backupPath        = backupPath
+        self._linkDestPathList  = linkDestPathList
+
+    def _getLinkDestIndex(self, relPath, fileStat):
+        """@brief Find the link-dest backup that a file was hard linked from.
+           @param relPath The file path relative to the backup folder.
+           @param fileStat The os.stat_result of the file in the new backup.
+           @return The index of the link-dest backup or -1 if not linked from any of them."""
+        for index, linkDestPath in enumerate(self._linkDestPathList):
+            try:
+                linkDestStat = os.lstat(os.path.join(linkDestPath, relPath))
+            except OSError:
+                continue
+            if linkDestStat.st_ino == fileStat.st_ino and linkDestStat.st_dev == fileStat.st_dev:
+                return index
+        return -1
+
+    def getLinkedBytes(self):
+        """@brief Read the new backup.
+           @return A list holding a (file count, bytes) tuple for each link-dest backup."""
+        linkedList = [[0, 0] for _ in self._linkDestPathList]
+        dirList = [""]
+        while dirList:
+            dirPath = dirList.pop()
+            with os.scandir(os.path.join(self._backupPath, dirPath)) as entryIter:
+                for entry in entryIter:
+                    relPath = os.path.join(dirPath, entry.name) if dirPath else entry.name
+                    entryStat = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(entryStat.st_mode):
+                        dirList.append(relPath)
+                        continue
+                    #A file with one link was copied
+                    if not stat.S_ISREG(entryStat.st_mode) or entryStat.st_nlink < 2:
+                        continue
+
+                    index = self._getLinkDestIndex(relPath, entryStat)
+                    if index >= 0:
+                        linkedList[index][0] = linkedList[index][0] + 1
+                        linkedList[index][1] = linkedList[index][1] + entryStat.st_size
+
+        return [tuple(linked) for linked in linkedList]
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+import  os
+import  stat
+import  mmap
+import  struct
+from    array import array
+from    concurrent.futures import ThreadPoolExecutor
+
+class SnapshotManifest(object):
+    """@brief Responsible for the manifest of a single backup. The manifest lists every file
+              (not folder) in the backup in a binary file that can be searched without reading
+              it all.
+
+              The file holds a header, an array of offsets into the path table, arrays of the
+              inode, size, modification time and mode of each file and then the path table.
+              Paths (bytes, relative to the backup folder) are sorted so a path or folder is
+              found by a binary search. Arrays use the byte order of the machine."""
+
+    MAGIC                           = b"PBMF"
+    VERSION                         = 1
+    HEADER                          = struct.Struct("=4sIQ")
+    OFFSET                          = struct.Struct("=Q")
+    INODE                           = struct.Struct("=Q")
+    SIZE                            = struct.Struct("=Q")
+    MTIME                           = struct.Struct("=q")
+    MODE                            = struct.Struct("=I")
+    SUFFIX                          = ".manifest"
+
+    @staticmethod
+    def Create(manifestFile, backupPath):
+        """@brief Read a backup folder and write its manifest.
+           @param manifestFile The manifest file to write.
+           @param backupPath The backup folder."""
+        entryList = []
+        dirList = [b""]
+        backupPathBytes = os.fsencode(backupPath)
+        while dirList:
+            dirPath = dirList.pop()
+            with os.scandir(os.path.join(backupPathBytes, dirPath)) as entryIter:
+                for entry in entryIter:
+                    relPath = os.path.join(dirPath, entry.name) if dirPath else entry.name
+                    entryStat = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(entryStat.st_mode):
+                        dirList.append(relPath)
+                    else:
+                        entryList.append( (relPath, entryStat.st_ino, entryStat.st_size, entryStat.st_mtime_ns, entryStat.st_mode) )
+
+        entryList.sort()
+        offsets = array('Q', [0])
+        for entry in entryList:
+            offsets.append( offsets[-1] + len(entry[0]) )
+
+        tmpFile = "{}.tmp".format(manifestFile)
+        with open(tmpFile, 'wb') as fd:
+            fd.write( SnapshotManifest.HEADER.pack(SnapshotManifest.MAGIC, SnapshotManifest.VERSION, len(entryList)) )
+            offsets.tofile(fd)
+            array('Q', [entry[1] for entry in entryList]).tofile(fd)
+            array('Q', [entry[2] for entry in entryList]).tofile(fd)
+            array('q', [entry[3] for entry in entryList]).tofile(fd)
+            array('I', [entry[4] for entry in entryList]).tofile(fd)
+            for entry in entryList:
+                fd.write(entry[0])
+        os.replace(tmpFile, manifestFile)
+
+    def __init__(self, manifestFile):
+        """@brief Constructor. The manifest is memory mapped until close() is called.
+           @param manifestFile The manifest file written by Create()."""
+        self._fd = open(manifestFile, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            #An empty file cannot be mapped
+            self._fd.close()
+            raise ValueError("{} is not a valid manifest.".format(manifestFile))
+
+        magic, version, self._count = SnapshotManifest.HEADER.unpack_from(self._mmap, 0)
+        if magic != SnapshotManifest.MAGIC or version != SnapshotManifest.VERSION:
+            self.close()
+            raise ValueError("{} is not a valid manifest.".format(manifestFile))
+
+        self._offsetsStart  = SnapshotManifest.HEADER.size
+        self._inodesStart   = self._offsetsStart + (self._count+1)*SnapshotManifest.OFFSET.size
+        self._sizesStart    = self._inodesStart + self._count*SnapshotManifest.INODE.size
+        self._mtimesStart   = self._sizesStart + self._count*SnapshotManifest.SIZE.size
+        self._modesStart    = self._mtimesStart + self._count*SnapshotManifest.MTIME.size
+        self._pathsStart    = self._modesStart + self._count*SnapshotManifest.MODE.size
+
+    def close(self):
+        """@brief Release the memory mapped manifest."""
+        self._mmap.close()
+        self._fd.close()
+
+    def getCount(self):
+        """@return The number of files in the manifest."""
+        return self._count
+
+    def _getPath(self, index):
+        """@return The path (bytes) of a file in the manifest."""
+        start = SnapshotManifest.OFFSET.unpack_from(self._mmap, self._offsetsStart + index*SnapshotManifest.OFFSET.size)[0]
+        end = SnapshotManifest.OFFSET.unpack_from(self._mmap, self._offsetsStart + (index+1)*SnapshotManifest.OFFSET.size)[0]
+        return self._mmap[self._pathsStart+start:self._pathsStart+end]
+
+    def _bisect(self, path):
+        """@return The index of the first path in the manifest that is not less than path."""
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low+high)//2
+            if self._getPath(middle) < path:
+                low = middle+1
+            else:
+                high = middle
+        return low
+
+    def _getEntry(self, index):
+        """@return A tuple of the path, inode, size, modification time (ns) and mode of a file in the manifest."""
+        return (self._getPath(index),
+                SnapshotManifest.INODE.unpack_from(self._mmap, self._inodesStart + index*SnapshotManifest.INODE.size)[0],
+                SnapshotManifest.SIZE.unpack_from(self._mmap, self._sizesStart + index*SnapshotManifest.SIZE.size)[0],
+                SnapshotManifest.MTIME.unpack_from(self._mmap, self._mtimesStart + index*SnapshotManifest.MTIME.size)[0],
+                SnapshotManifest.MODE.unpack_from(self._mmap, self._modesStart + index*SnapshotManifest.MODE.size)[0])
+
+    def find(self, path):
+        """@brief Find a file or the files in a folder.
+           @param path The path (bytes) relative to the backup folder.
+           @return A list of tuples as returned by _getEntry()."""
+        entryList = []
+        index = self._bisect(path)
+        if index < self._count and self._getPath(index) == path:
+            entryList.append( self._getEntry(index) )
+
+        #The files in the folder follow the path with a / added
+        folderPrefix = path.rstrip(b"/") + b"/" if path else b""
+        index = self._bisect(folderPrefix)
+        while index < self._count:
+            entry = self._getEntry(index)
+            if not entry[0].startswith(folderPrefix):
+                break
+            entryList.append(entry)
+            index = index + 1
+
+        return entryList
+
+class ManifestIndex(object):
+    """@brief Responsible for the manifests of all the backups in the dest path and finding every
+              version of a file held in the backups."""
+
+    DEFAULT_THREAD_COUNT            = 4
+
+    def __init__(self, uo, dest, manifestDir):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param dest The dest path holding the backups.
+           @param manifestDir The folder holding the manifests."""
+        self._uo            = uo
+        self._dest          = dest
+        self._manifestDir   = manifestDir
+
+    def _getManifestFile(self, name):
+        """@return The manifest file of a backup."""
+        return os.path.join(self._manifestDir, "{}{}".format(name, SnapshotManifest.SUFFIX))
+
+    def create(self, name):
+        """@brief Create the manifest of a backup.
+           @param name The name of the complete backup folder."""
+        if not os.path.isdir(self._manifestDir):
+            os.makedirs(self._manifestDir, exist_ok=True)
+        SnapshotManifest.Create(self._getManifestFile(name), os.path.join(self._dest, name))
+
+    def update(self, nameList, threadCount=DEFAULT_THREAD_COUNT):
+        """@brief Create the manifests that are missing and remove those of backups that have been purged.
+           @param nameList The names of the complete backup folders."""
+        if not os.path.isdir(self._manifestDir):
+            os.makedirs(self._manifestDir)
+
+        nameSet = set(nameList)
+        for entry in os.listdir(self._manifestDir):
+            if entry.endswith(SnapshotManifest.SUFFIX) and entry[:-len(SnapshotManifest.SUFFIX)] not in nameSet:
+                os.remove(os.path.join(self._manifestDir, entry))
+
+        missingList = [name for name in nameList if not os.path.isfile(self._getManifestFile(name))]
+        if missingList:
+            self._uo.info("Creating the manifests of {} backups.".format(len(missingList)))
+            with ThreadPoolExecutor(max_workers=threadCount) as executor:
+                list(executor.map(self.create, missingList))
+
+    def getVersions(self, nameList, path):
+        """@brief Find every version of a file, or of the files in a folder, held in the backups.
+                  Copies of a file that are hard linked together are the same version.
+           @param nameList The names of the backups to search, oldest first.
+           @param path The path (bytes) relative to the backup folders.
+           @return A dict. Each key is a path (bytes) and each value is a list of versions, oldest
+                   first. Each version is a tuple of the size, modification time (ns) and the list
+                   of the names of the backups that hold it."""
+        versionDict = {}
+        for name in nameList:
+            manifest = SnapshotManifest(self._getManifestFile(name))
+            try:
+                for entryPath, inode, size, mtimeNs, mode in manifest.find(path):
+                    pathVersionDict = versionDict.setdefault(entryPath, {})
+                    if inode not in pathVersionDict:
+                        pathVersionDict[inode] = (size, mtimeNs, [])
+                    pathVersionDict[inode][2].append(name)
+            finally:
+                manifest.close()
+
+        resultDict = {}
+        for entryPath, pathVersionDict in versionDict.items():
+            #Dicts keep the order the versions were found in, which is oldest first
+            resultDict[entryPath] = list(pathVersionDict.values())
+        return resultDict
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+import  os
+import  time
+import  json
+from    contextlib import contextmanager
+
+class RunMetrics(object):
+    """@brief Responsible for recording machine readable metrics for a single backup run."""
+
+    PHASE_PRE_SCRIPT                = "pre_script"
+    PHASE_RSYNC                     = "rsync"
+    PHASE_RENAME                    = "rename"
+    PHASE_DEDUP                     = "dedup"
+    PHASE_MANIFEST                  = "manifest"
+    PHASE_PURGE                     = "purge"
+    PHASE_EMAIL                     = "email"
+    PHASE_POST_SCRIPT               = "post_script"
+
+    PROMETHEUS_PREFIX               = "pbackup"
+
+    def __init__(self):
+        self._startTime     = time.time()
+        self._phaseDict     = {}
+        self._valueDict     = {}
+
+    @contextmanager
+    def phase(self, name):
+        """@brief Record the time spent in a phase of the backup. Use as a context manager.
+                  If a phase is entered more than once the times are added together.
+           @param name The phase name (one of the PHASE_* constants)."""
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            self._phaseDict[name] = self._phaseDict.get(name, 0) + time.time() - startTime
+
+    def set(self, name, value):
+        """@brief Set a metric value.
+           @param name The metric name.
+           @param value The value. This must be a number, string, bool or None."""
+        self._valueDict[name] = value
+
+    def get(self, name, default=None):
+        """@brief Get a metric value.
+           @param name The metric name.
+           @param default The value returned if the metric has not been set.
+           @return The value."""
+        return self._valueDict.get(name, default)
+
+    def toDict(self):
+        """@return The metrics as a dict that can be saved as JSON."""
+        metricsDict = {"start_time":        self._startTime,
+                       "duration_seconds":  time.time() - self._startTime,
+                       "phase_seconds":     dict(self._phaseDict)}
+        metricsDict.update(self._valueDict)
+        return metricsDict
+
+    def appendHistory(self, historyFile):
+        """@brief Append the metrics as a single JSON line to a history file.
+           @param historyFile The history file."""
+        with open(historyFile, 'a') as fd:
+            fd.write("{}\n".format( json.dumps(self.toDict(), sort_keys=True) ))
+
+    @staticmethod
+    def LoadHistory(historyFile):
+        """@brief Load the metrics of previous runs.
+           @param historyFile The history file written by appendHistory().
+           @return A list of dicts, oldest first."""
+        historyList = []
+        if os.path.isfile(historyFile):
+            with open(historyFile, 'r') as fd:
+                for line in fd:
+                    try:
+                        historyList.append( json.loads(line) )
+                    except ValueError:
+                        #Ignore a line partly written when a previous run was killed
+                        pass
+        return historyList
+
+    def _getPrometheusLine(self, name, value, labelDict):
+        """@brief Get a single Prometheus sample line.
+           @param name The metric name without the prefix.
+           @param value The sample value.
+           @param labelDict The labels of the sample.
+           @return The line of text."""
+        labels = ",".join(['{}="{}"'.format(key, str(labelValue).replace("\\", "\\\\").replace('"', '\\"')) for key, labelValue in sorted(labelDict.items())])
+        return "{}_{}{{{}}} {}".format(RunMetrics.PROMETHEUS_PREFIX, name, labels, float(value))
+
+    def writePrometheus(self, textFile, labelDict):
+        """@brief Write the metrics to a node exporter textfile collector file.
+                  The file is replaced atomically so the exporter never reads a partial file.
+           @param textFile The file to write (must end in .prom).
+           @param labelDict The labels added to every sample (E.G the dest path)."""
+        metricsDict = self.toDict()
+        lines = []
+
+        lines.append("# HELP {}_phase_seconds Time spent in each phase of the last backup.".format(RunMetrics.PROMETHEUS_PREFIX))
+        lines.append("# TYPE {}_phase_seconds gauge".format(RunMetrics.PROMETHEUS_PREFIX))
+        for phase, seconds in sorted(metricsDict["phase_seconds"].items()):
+            phaseLabelDict = dict(labelDict)
+            phaseLabelDict["phase"] = phase
+            lines.append( self._getPrometheusLine("phase_seconds", seconds, phaseLabelDict) )
+
+        lines.append("# HELP {}_last_run_timestamp_seconds The time the last backup started.".format(RunMetrics.PROMETHEUS_PREFIX))
+        lines.append("# TYPE {}_last_run_timestamp_seconds gauge".format(RunMetrics.PROMETHEUS_PREFIX))
+        lines.append( self._getPrometheusLine("last_run_timestamp_seconds", metricsDict["start_time"], labelDict) )
+
+        lines.append("# HELP {}_duration_seconds The time taken by the last backup.".format(RunMetrics.PROMETHEUS_PREFIX))
+        lines.append("# TYPE {}_duration_seconds gauge".format(RunMetrics.PROMETHEUS_PREFIX))
+        lines.append( self._getPrometheusLine("duration_seconds", metricsDict["duration_seconds"], labelDict) )
+
+        #All other numeric metrics
+        for name, value in sorted(self._valueDict.items()):
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines.append("# TYPE {}_{} gauge".format(RunMetrics.PROMETHEUS_PREFIX, name))
+                lines.append( self._getPrometheusLine(name, value, labelDict) )
+
+        tmpFile = "{}.tmp".format(textFile)
+        with open(tmpFile, 'w') as fd:
+            fd.write("\n".join(lines))
+            fd.write("\n")
+        os.replace(tmpFile, textFile)
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import  queue
+import  socket
+import  getpass
+import  smtplib
+import  threading
+from    email.message import EmailMessage
+from    email.utils import formatdate, make_msgid
+
+class EmailWorker(threading.Thread):
+    """@brief Responsible for sending queued emails over one SMTP connection in a background thread.
+              Each worker has its own queue, stop event and connection, so a worker left running
+              after a flush() timeout never shares them with the worker started after it."""
+
+    def __init__(self, notifier):
+        """@brief Constructor
+           @param notifier The EmailNotifier that holds the SMTP server details."""
+        threading.Thread.__init__(self, daemon=True)
+        self._notifier      = notifier
+        self._uo            = notifier._uo
+        self._smtp          = None
+        self.queue          = queue.Queue()
+        self.stopEvent      = threading.Event()
+
+    def _connect(self):
+        """@brief Connect and log in to the SMTP server if not already connected."""
+        if self._smtp:
+            try:
+                self._smtp.noop()
+                return
+            except smtplib.SMTPException:
+                self._close()
+
+        notifier = self._notifier
+        smtp = smtplib.SMTP(notifier._host, notifier._port, timeout=notifier._timeout)
+        try:
+            smtp.ehlo()
+            if smtp.has_extn("starttls"):
+                smtp.starttls()
+                smtp.ehlo()
+            elif notifier._username and not notifier._allowPlainLogin:
+                raise smtplib.SMTPException("{} does not support STARTTLS so the email password will not be sent.".format(notifier._host))
+
+            #If we have a username and password, login to the email server
+            if notifier._username and notifier._password:
+                smtp.login(notifier._username, notifier._password)
+
+        except:
+            smtp.close()
+            raise
+
+        self._smtp = smtp
+
+    def _close(self):
+        """@brief Close the connection to the SMTP server."""
+        if self._smtp:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+    def _deliver(self, toList, message):
+        """@brief Send an email, retrying with an increasing delay if it fails.
+           @param toList   A List of email addresses to send the email to
+           @param message  The EmailMessage to send."""
+        retryDelay = self._notifier._retryDelay
+        for attempt in range(0, self._notifier._retryCount+1):
+            try:
+                self._connect()
+                self._smtp.send_message(message, from_addr=self._notifier._fromAddress, to_addrs=toList)
+                self._uo.info("SUBJECT: {}".format( message["Subject"] ) )
+                self._uo.info("BODY:    {}".format( message.get_content().rstrip() ) )
+                self._uo.info("Sent email to {} as backup status notification".format( str(toList) ) )
+                return
+
+            except (smtplib.SMTPException, OSError) as e:
+                self._close()
+                if attempt >= self._notifier._retryCount or self.stopEvent.is_set():
+                    #We dont throw an error here or any error send email notifications could
+                    #break the backup process
+                    self._uo.error("Failed to send email '{}': {}".format(message["Subject"], e))
+                    return
+
+                self._uo.warn("Failed to send email '{}' ({}). Retrying in {} seconds.".format(message["Subject"], e, retryDelay))
+                if self.stopEvent.wait(retryDelay):
+                    return
+                retryDelay = retryDelay * 2
+
+    def run(self):
+        """@brief Send the queued emails. Called in the background thread."""
+        try:
+            while not self.stopEvent.is_set():
+                item = self.queue.get()
+                if item is None:
+                    break
+                toList, message = item
+                self._deliver(toList, message)
+
+        finally:
+            self._close()
+
+class EmailNotifier(object):
+    """@brief Responsible for sending email notifications in a background thread so that a
+              slow or unreachable SMTP server never delays the backup. One SMTP connection
+              is used for all the emails sent during a backup run."""
+
+    DEFAULT_PORT                    = 587
+    DEFAULT_TIMEOUT_SECONDS         = 30
+    DEFAULT_FLUSH_TIMEOUT_SECONDS   = 120
+    RETRY_COUNT                     = 3
+    RETRY_DELAY_SECONDS             = 5
+
+    def __init__(self, uo, server, username, password, timeout=DEFAULT_TIMEOUT_SECONDS, retryCount=RETRY_COUNT, retryDelay=RETRY_DELAY_SECONDS, allowPlainLogin=False):
+        """@brief Constructor
+           @param uo The UO instance used to report the emails sent.
+           @param server The server name (E.G smtp.gmail.com). This string can include the
+                         server port number if required (E.G smtp.gmail.com:587)
+           @param username The username to be used in order to log into the SMTP server
+           @param password The password to be used in order to log into the SMTP server
+           @param timeout The timeout in seconds for connecting to and each command sent to the SMTP server.
+           @param retryCount The number of times sending an email is retried if it fails.
+           @param retryDelay The delay in seconds before the first retry. This doubles on every retry.
+           @param allowPlainLogin If True the username and password are sent to a server that does not
+                                  support STARTTLS. If False no email is sent to such a server."""
+        if username or password:
+            if not username:
+                raise Exception("You have define the email server password but not the username.")
+            if not password:
+                raise Exception("You have define the email server username but not the password.")
+
+        self._uo            = uo
+        self._host          = server
+        self._port          = EmailNotifier.DEFAULT_PORT
+        if server.find(":") != -1:
+            elems = server.split(":")
+            self._host = elems[0]
+            self._port = int(elems[1])
+        self._username      = username
+        self._password      = password
+        self._timeout       = timeout
+        self._retryCount    = retryCount
+        self._retryDelay    = retryDelay
+        self._allowPlainLogin = allowPlainLogin
+        self._worker        = None
+
+        self._fromAddress   = "{}@{}".format(getpass.getuser(), socket.gethostname())
+        if username and username.find("@") != -1:
+            self._fromAddress = username
+
+    def send(self, toList, subject, body):
+        """@brief Queue an email to be sent. This returns immediately.
+           @param toList   A List of email addresses to send the email to
+           @param subject  The subject text line of the email
+           @param body     The body text of the email"""
+        message = EmailMessage()
+        message["From"]         = self._fromAddress
+        message["To"]           = ", ".join(toList)
+        message["Subject"]      = subject
+        message["Date"]         = formatdate(localtime=True)
+        message["Message-ID"]   = make_msgid()
+        message.set_content(body)
+
+        #Start a worker if there is none or the last one was stopped after a flush() timeout
+        if self._worker is None or self._worker.stopEvent.is_set():
+            self._worker = EmailWorker(self)
+            self._worker.start()
+        self._worker.queue.put( (toList, message) )
+
+    def flush(self, timeout=DEFAULT_FLUSH_TIMEOUT_SECONDS):
+        """@brief Wait for the queued emails to be sent and close the SMTP connection.
+           @param timeout The maximum time to wait in seconds. Emails not sent by then are dropped."""
+        if self._worker is None:
+            return
+
+        self._worker.queue.put(None)
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            #The worker exits once the current send returns. The next send() starts a new worker.
+            self._worker.stopEvent.set()
+            self._uo.error("Timeout waiting {} seconds for email notifications to be sent.".format(timeout))
+            return
+
+        self._worker = None
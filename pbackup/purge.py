@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+import  os
+import  stat
+import  time
+import  errno
+import  threading
+from    concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class PurgeEngine(object):
+    """@brief Responsible for deleting old backups. Backups are first moved into a trash
+              folder (a fast rename) and then the trash folder is emptied by a pool of threads,
+              either straight away or in the background."""
+
+    DEFAULT_THREAD_COUNT            = 4
+    PROGRESS_INTERVAL_SECONDS       = 60
+
+    def __init__(self, uo, trashDir, threadCount=DEFAULT_THREAD_COUNT):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param trashDir The folder that deleted backups are moved into. This must be on the
+                           same file system as the backups.
+           @param threadCount The number of threads used to delete files."""
+        self._uo            = uo
+        self._trashDir      = trashDir
+        self._threadCount   = threadCount
+        self._thread        = None
+        self._stopEvent     = threading.Event()
+        self._lock          = threading.Lock()
+        self._error         = None
+
+    def moveToTrash(self, path):
+        """@brief Move a backup into the trash folder so that it no longer appears in the dest path.
+           @param path The path of the backup.
+           @return The path of the backup in the trash folder."""
+        if not os.path.isdir(self._trashDir):
+            os.makedirs(self._trashDir)
+
+        name = os.path.basename(path.rstrip("/"))
+        trashPath = os.path.join(self._trashDir, name)
+        index = 1
+        while os.path.lexists(trashPath):
+            trashPath = os.path.join(self._trashDir, "{}.{}".format(name, index))
+            index = index + 1
+
+        os.rename(path, trashPath)
+        return trashPath
+
+    def isTrashEmpty(self):
+        """@return True if there is nothing in the trash folder to delete."""
+        if not os.path.isdir(self._trashDir):
+            return True
+        with os.scandir(self._trashDir) as entryIter:
+            for _ in entryIter:
+                return False
+        return True
+
+    def start(self):
+        """@brief Start emptying the trash folder in the background if not already doing so."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopEvent.clear()
+            self._error = None
+            self._thread = threading.Thread(target=self._emptyTrash, daemon=True)
+            self._thread.start()
+
+    def wait(self):
+        """@brief Wait for the trash folder to be emptied.
+           @return None
+           @throws The exception raised while emptying the trash if it failed."""
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._error:
+            error = self._error
+            self._error = None
+            raise error
+
+    def stop(self):
+        """@brief Stop emptying the trash folder. Whatever has not been deleted is left in the
+                  trash folder to be deleted the next time the trash folder is emptied."""
+        self._stopEvent.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def emptyTrash(self):
+        """@brief Empty the trash folder, waiting until this is complete."""
+        self.start()
+        self.wait()
+
+    def _emptyTrash(self):
+        """@brief Delete everything in the trash folder. Called in the background thread."""
+        try:
+            while not self._stopEvent.is_set() and not self.isTrashEmpty():
+                with os.scandir(self._trashDir) as entryIter:
+                    pathList = [entry.path for entry in entryIter]
+                for path in pathList:
+                    if self._stopEvent.is_set():
+                        break
+                    self._deleteTree(path)
+
+        except Exception as e:
+            self._error = e
+            self._uo.error("Failed to empty {}: {}".format(self._trashDir, e))
+
+    def _makeWritable(self, path):
+        """@brief Ensure we have permission to read and change a folder.
+           @param path The folder path."""
+        mode = os.lstat(path).st_mode
+        os.chmod(path, stat.S_IMODE(mode) | stat.S_IRWXU)
+
+    def _scanDir(self, path):
+        """@brief Delete all entries in a folder apart from sub folders.
+           @param path The folder path.
+           @return A tuple containing a list of the sub folders and the number of entries deleted."""
+        subDirList = []
+        deletedCount = 0
+        if self._stopEvent.is_set():
+            return (subDirList, deletedCount)
+
+        try:
+            entryList = list(os.scandir(path))
+        except PermissionError:
+            self._makeWritable(path)
+            entryList = list(os.scandir(path))
+
+        #Backups keep the permissions of the src so the folder may be read only
+        if entryList and not os.access(path, os.W_OK | os.X_OK):
+            self._makeWritable(path)
+
+        for entry in entryList:
+            if entry.is_dir(follow_symlinks=False):
+                subDirList.append(entry.path)
+            else:
+                os.unlink(entry.path)
+                deletedCount = deletedCount + 1
+
+        return (subDirList, deletedCount)
+
+    def _deleteTree(self, path):
+        """@brief Delete a folder and all its contents using a pool of threads.
+           @param path The folder path."""
+        startTime = time.time()
+        lastReportTime = startTime
+        deletedCount = 0
+
+        if not os.path.isdir(path) or os.path.islink(path):
+            os.unlink(path)
+            return
+
+        self._uo.info("Deleting {}".format(path))
+        #A folder is always found before its sub folders so the reverse of this list is a safe order to remove them
+        dirList = [path]
+        with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+            pending = {executor.submit(self._scanDir, path)}
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subDirList, count = future.result()
+                    deletedCount = deletedCount + count
+                    dirList.extend(subDirList)
+                    for subDir in subDirList:
+                        pending.add(executor.submit(self._scanDir, subDir))
+
+                now = time.time()
+                if now-lastReportTime >= PurgeEngine.PROGRESS_INTERVAL_SECONDS:
+                    self._uo.info("Deleted {} files from {} ({:.0f} files/second).".format(deletedCount, path, deletedCount/(now-startTime)) )
+                    lastReportTime = now
+
+        for dirPath in reversed(dirList):
+            try:
+                os.rmdir(dirPath)
+            except OSError as e:
+                #If stopped early some folders will still hold files
+                if not (self._stopEvent.is_set() and e.errno == errno.ENOTEMPTY):
+                    raise
+
+        if not self._stopEvent.is_set():
+            self._uo.info("Deleted {} ({} files and {} folders) in {:.1f} seconds.".format(path, deletedCount, len(dirList), time.time()-startTime) )
@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+
+import  os
+import  re
+import  stat
+import  time
+import  errno
+import  fnmatch
+import  threading
+from    concurrent.futures import ThreadPoolExecutor
+
+class SnapshotRestorer(object):
+    """@brief Responsible for copying the files in a backup to a restore folder. Files are copied
+              in parallel and files already restored (same size and modification time) are skipped
+              so that a restore that was stopped can be started again."""
+
+    DEFAULT_THREAD_COUNT            = 8
+    COPY_SIZE                       = 8*1048576
+    TMP_SUFFIX                      = ".pbackup_restore"
+
+    def __init__(self, uo, backupPath, restorePath, patternList=None, threadCount=DEFAULT_THREAD_COUNT, progressInterval=60):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param backupPath The backup folder to restore from.
+           @param restorePath The folder to restore to.
+           @param patternList A list of glob patterns matched against the path of each file relative
+                              to the backup folder. If a folder matches, everything in it is restored.
+                              If None or empty everything is restored.
+           @param threadCount The number of files to copy at the same time.
+           @param progressInterval The period in seconds between progress reports (0 = no reports)."""
+        self._uo                = uo
+        self._backupPath        = backupPath
+        self._restorePath       = restorePath
+        self._patternList       = [pattern.strip("/") for pattern in patternList or [] if pattern.strip("/")]
+        self._threadCount       = threadCount
+        self._progressInterval  = progressInterval
+        self._isRoot            = os.geteuid() == 0
+        self._lock              = threading.Lock()
+        self._copiedBytes       = 0
+        self._copiedCount       = 0
+
+    def _isIncluded(self, relPath):
+        """@brief Determine if a path matches the restore patterns.
+           @param relPath The path relative to the backup folder.
+           @return True if the path should be restored."""
+        if not self._patternList:
+            return True
+
+        for pattern in self._patternList:
+            if fnmatch.fnmatchcase(relPath, pattern):
+                return True
+        return False
+
+    def _isParentOfMatch(self, relPath):
+        """@brief Determine if a folder may hold paths that match the restore patterns.
+           @param relPath The folder path relative to the backup folder.
+           @return True if the folder should be read."""
+        folderPrefix = relPath + "/"
+        for pattern in self._patternList:
+            #The part of the pattern before the first wildcard must be in the folder or hold the folder
+            literalPrefix = re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+            if literalPrefix.startswith(folderPrefix) or folderPrefix.startswith(literalPrefix):
+                return True
+        return False
+
+    def _scan(self):
+        """@brief Find the paths in the backup to restore.
+           @return A tuple of the folder, file, symlink and other (devices, fifos etc) lists. Each list holds (relPath, os.stat_result) tuples.
+                   Folders are in the order they must be created."""
+        dirList = []
+        fileList = []
+        linkList = []
+        otherList = []
+        #The folders read only because they may hold paths that match. These are restored if they do.
+        parentDict = {}
+        #Each entry is the relative path of a folder and True if everything in it is restored
+        searchList = [("", True if not self._patternList else False)]
+        while searchList:
+            dirPath, included = searchList.pop()
+            with os.scandir(os.path.join(self._backupPath, dirPath)) as entryIter:
+                for entry in entryIter:
+                    relPath = os.path.join(dirPath, entry.name) if dirPath else entry.name
+                    entryIncluded = included or self._isIncluded(relPath)
+                    entryStat = entry.stat(follow_symlinks=False)
+                    if not entryIncluded:
+                        if stat.S_ISDIR(entryStat.st_mode) and self._isParentOfMatch(relPath):
+                            parentDict[relPath] = entryStat
+                            searchList.append( (relPath, False) )
+                        continue
+
+                    #Restore the folders that hold a matching path
+                    parentPath = dirPath
+                    while parentPath in parentDict:
+                        dirList.append( (parentPath, parentDict.pop(parentPath)) )
+                        parentPath = os.path.dirname(parentPath)
+
+                    if stat.S_ISDIR(entryStat.st_mode):
+                        dirList.append( (relPath, entryStat) )
+                        searchList.append( (relPath, True) )
+
+                    elif stat.S_ISREG(entryStat.st_mode):
+                        fileList.append( (relPath, entryStat) )
+
+                    elif stat.S_ISLNK(entryStat.st_mode):
+                        linkList.append( (relPath, entryStat) )
+
+                    else:
+                        otherList.append( (relPath, entryStat) )
+
+        dirList.sort(key=lambda item: item[0])
+        return (dirList, fileList, linkList, otherList)
+
+    def _setOwner(self, path, entryStat, followSymlinks=True):
+        """@brief Set the owner of a restored path. Only root can set the owner of a file to another user."""
+        if self._isRoot:
+            os.chown(path, entryStat.st_uid, entryStat.st_gid, follow_symlinks=followSymlinks)
+
+    def _isRestored(self, targetPath, entryStat):
+        """@return True if the file has already been restored."""
+        try:
+            targetStat = os.lstat(targetPath)
+        except FileNotFoundError:
+            return False
+        return stat.S_ISREG(targetStat.st_mode) and targetStat.st_size == entryStat.st_size and targetStat.st_mtime_ns == entryStat.st_mtime_ns
+
+    def _copyData(self, srcFd, dstFd, size):
+        """@brief Copy the contents of a file using the kernel to avoid copying the data through user space where possible.
+           @param srcFd The file descriptor of the file to read.
+           @param dstFd The file descriptor of the file to write.
+           @param size The number of bytes to copy."""
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    count = os.copy_file_range(srcFd, dstFd, min(SnapshotRestorer.COPY_SIZE, size-copied))
+                    if count == 0:
+                        break
+                    copied = copied + count
+                    self._addProgress(count)
+                return
+
+            except OSError as e:
+                #Not supported between these file systems
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL) or copied > 0:
+                    raise
+
+        while copied < size:
+            count = os.sendfile(dstFd, srcFd, copied, min(SnapshotRestorer.COPY_SIZE, size-copied))
+            if count == 0:
+                break
+            copied = copied + count
+            self._addProgress(count)
+
+    def _addProgress(self, byteCount):
+        """@brief Record the number of bytes copied."""
+        with self._lock:
+            self._copiedBytes = self._copiedBytes + byteCount
+
+    def _restoreFile(self, relPath, entryStat):
+        """@brief Restore a single file. The file is copied to a temporary file that is renamed when complete.
+           @param relPath The path of the file relative to the backup folder.
+           @param entryStat The os.stat_result of the file in the backup.
+           @return True if the file was copied, False if it was already restored."""
+        targetPath = os.path.join(self._restorePath, relPath)
+        if self._isRestored(targetPath, entryStat):
+            return False
+
+        tmpPath = "{}{}".format(targetPath, SnapshotRestorer.TMP_SUFFIX)
+        srcFd = os.open(os.path.join(self._backupPath, relPath), os.O_RDONLY)
+        try:
+            dstFd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                self._copyData(srcFd, dstFd, entryStat.st_size)
+                if self._isRoot:
+                    os.fchown(dstFd, entryStat.st_uid, entryStat.st_gid)
+                os.fchmod(dstFd, stat.S_IMODE(entryStat.st_mode))
+            finally:
+                os.close(dstFd)
+        finally:
+            os.close(srcFd)
+
+        os.utime(tmpPath, ns=(entryStat.st_atime_ns, entryStat.st_mtime_ns))
+        os.replace(tmpPath, targetPath)
+        with self._lock:
+            self._copiedCount = self._copiedCount + 1
+        return True
+
+    def _restoreLink(self, relPath, entryStat):
+        """@brief Restore a symlink.
+           @param relPath The path of the symlink relative to the backup folder.
+           @param entryStat The os.stat_result of the symlink in the backup."""
+        targetPath = os.path.join(self._restorePath, relPath)
+        linkTarget = os.readlink(os.path.join(self._backupPath, relPath))
+        if os.path.islink(targetPath) and os.readlink(targetPath) == linkTarget:
+            return
+        if os.path.lexists(targetPath):
+            os.remove(targetPath)
+        os.symlink(linkTarget, targetPath)
+        self._setOwner(targetPath, entryStat, followSymlinks=False)
+        if os.utime in os.supports_follow_symlinks:
+            os.utime(targetPath, ns=(entryStat.st_atime_ns, entryStat.st_mtime_ns), follow_symlinks=False)
+
+    def _restoreOther(self, relPath, entryStat):
+        """@brief Restore a device, fifo or socket. Only root can create devices.
+           @param relPath The path relative to the backup folder.
+           @param entryStat The os.stat_result of the path in the backup."""
+        targetPath = os.path.join(self._restorePath, relPath)
+        if os.path.lexists(targetPath):
+            return
+        try:
+            os.mknod(targetPath, entryStat.st_mode, entryStat.st_rdev)
+            self._setOwner(targetPath, entryStat)
+            os.utime(targetPath, ns=(entryStat.st_atime_ns, entryStat.st_mtime_ns))
+        except OSError as e:
+            self._uo.warn("Unable to restore {}: {}".format(targetPath, e))
+
+    def _report(self, startTime, totalBytes):
+        """@brief Report the restore progress.
+           @param startTime The time the restore started.
+           @param totalBytes The number of bytes to be copied."""
+        elapsedSeconds = max(time.time()-startTime, 0.001)
+        with self._lock:
+            copiedBytes = self._copiedBytes
+            copiedCount = self._copiedCount
+        percentage = 100.0
+        if totalBytes:
+            percentage = 100.0*copiedBytes/totalBytes
+        self._uo.info("Restored {} files, {:.1f} MB ({:.0f}%) at {:.1f} MB/s".format(copiedCount, copiedBytes/1E6, percentage, copiedBytes/1E6/elapsedSeconds))
+
+    def _monitor(self, stopEvent, startTime, totalBytes):
+        """@brief Report the restore progress periodically. Called in a background thread."""
+        while not stopEvent.wait(self._progressInterval):
+            self._report(startTime, totalBytes)
+
+    def restore(self):
+        """@brief Restore the backup.
+           @return A tuple containing the number of files copied, the number of files already
+                   restored and the number of bytes copied."""
+        startTime = time.time()
+        dirList, fileList, linkList, otherList = self._scan()
+        if not dirList and not fileList and not linkList and not otherList:
+            self._uo.warn("Nothing to restore.")
+            return (0, 0, 0)
+
+        #Folders left read only by a restore that was stopped are made writable until the end
+        os.makedirs(self._restorePath, exist_ok=True)
+        for relPath, _ in dirList:
+            targetPath = os.path.join(self._restorePath, relPath)
+            os.makedirs(targetPath, exist_ok=True)
+            dirMode = stat.S_IMODE(os.stat(targetPath).st_mode)
+            if dirMode & stat.S_IRWXU != stat.S_IRWXU:
+                os.chmod(targetPath, dirMode | stat.S_IRWXU)
+
+        #Files that are hard linked together in the backup are copied once and then linked
+        inodeDict = {}
+        copyList = []
+        hardLinkList = []
+        for relPath, entryStat in fileList:
+            if entryStat.st_nlink > 1:
+                if entryStat.st_ino in inodeDict:
+                    hardLinkList.append( (relPath, inodeDict[entryStat.st_ino]) )
+                    continue
+                inodeDict[entryStat.st_ino] = relPath
+            copyList.append( (relPath, entryStat) )
+
+        totalBytes = sum([entryStat.st_size for _, entryStat in copyList])
+        self._uo.info("Restoring {} files ({:.1f} MB) from {} to {}".format(len(fileList), totalBytes/1E6, self._backupPath, self._restorePath))
+
+        stopEvent = threading.Event()
+        monitorThread = None
+        if self._progressInterval > 0:
+            monitorThread = threading.Thread(target=self._monitor, args=(stopEvent, startTime, totalBytes), daemon=True)
+            monitorThread.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+                copiedList = list(executor.map(lambda item: self._restoreFile(*item), copyList))
+        finally:
+            stopEvent.set()
+            if monitorThread:
+                monitorThread.join()
+
+        for relPath, linkedRelPath in hardLinkList:
+            targetPath = os.path.join(self._restorePath, relPath)
+            linkedPath = os.path.join(self._restorePath, linkedRelPath)
+            if os.path.lexists(targetPath):
+                if os.path.samefile(targetPath, linkedPath):
+                    continue
+                os.remove(targetPath)
+            os.link(linkedPath, targetPath)
+
+        for relPath, entryStat in linkList:
+            self._restoreLink(relPath, entryStat)
+
+        for relPath, entryStat in otherList:
+            self._restoreOther(relPath, entryStat)
+
+        #Set the folder attributes last as restoring the files changes the folder modification times
+        for relPath, entryStat in reversed(dirList):
+            targetPath = os.path.join(self._restorePath, relPath)
+            self._setOwner(targetPath, entryStat)
+            os.chmod(targetPath, stat.S_IMODE(entryStat.st_mode))
+            os.utime(targetPath, ns=(entryStat.st_atime_ns, entryStat.st_mtime_ns))
+
+        copiedCount = copiedList.count(True)
+        skippedCount = copiedList.count(False)
+        if skippedCount:
+            self._uo.info("{} files had already been restored.".format(skippedCount))
+        elapsedSeconds = max(time.time()-startTime, 0.001)
+        self._uo.info("Restored {} files, {:.1f} MB in {:.1f} seconds ({:.1f} MB/s)".format(copiedCount, self._copiedBytes/1E6, elapsedSeconds, self._copiedBytes/1E6/elapsedSeconds))
+        return (copiedCount, skippedCount, self._copiedBytes)
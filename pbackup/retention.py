@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+import  time
+
+class GFSRetention(object):
+    """@brief Responsible for selecting the backups to keep under a grandfather-father-son policy.
+              The latest backup in each of the last N hours, days, weeks and months is kept. Each
+              backup is a complete hard linked copy of the src path so any backup that is not
+              selected can be removed without affecting the others."""
+
+    BUCKET_HOURLY                   = "hourly"
+    BUCKET_DAILY                    = "daily"
+    BUCKET_WEEKLY                   = "weekly"
+    BUCKET_MONTHLY                  = "monthly"
+    #The time.strftime() format that gives the same text for all the times in one bucket
+    BUCKET_FORMAT_DICT              = {BUCKET_HOURLY:   "%Y-%m-%d %H",
+                                       BUCKET_DAILY:    "%Y-%m-%d",
+                                       BUCKET_WEEKLY:   "%G-%V",
+                                       BUCKET_MONTHLY:  "%Y-%m"}
+
+    def __init__(self, hourly=0, daily=0, weekly=0, monthly=0):
+        """@brief Constructor
+           @param hourly The number of hours to keep a backup for.
+           @param daily The number of days to keep a backup for.
+           @param weekly The number of weeks to keep a backup for.
+           @param monthly The number of months to keep a backup for."""
+        self._keepDict = {GFSRetention.BUCKET_HOURLY:   hourly,
+                          GFSRetention.BUCKET_DAILY:    daily,
+                          GFSRetention.BUCKET_WEEKLY:   weekly,
+                          GFSRetention.BUCKET_MONTHLY:  monthly}
+
+    def isEnabled(self):
+        """@return True if any of the bucket counts are set."""
+        return max(self._keepDict.values()) > 0
+
+    def getKeepDict(self, recordList):
+        """@brief Select the backups to keep.
+           @param recordList The SnapshotRecord instances of the complete backups, oldest first.
+           @return A dict. The keys are the names of the backups to keep. Each value is the list of
+                   buckets (BUCKET_* constants) that the backup was kept for. The latest backup
+                   and backups with an unknown time are always kept."""
+        keepDict = {}
+        if not recordList:
+            return keepDict
+
+        keepDict[recordList[-1].name] = []
+        lastKeyDict = {}
+        countDict = dict([(bucket, 0) for bucket in self._keepDict])
+        for record in reversed(recordList):
+            if record.timeStamp is None:
+                keepDict.setdefault(record.name, [])
+                continue
+
+            localTime = time.localtime(record.timeStamp)
+            for bucket, keepCount in self._keepDict.items():
+                if countDict[bucket] >= keepCount:
+                    continue
+                key = time.strftime(GFSRetention.BUCKET_FORMAT_DICT[bucket], localTime)
+                #Newest first so the first backup seen in a bucket is the latest in it
+                if key != lastKeyDict.get(bucket):
+                    lastKeyDict[bucket] = key
+                    countDict[bucket] = countDict[bucket] + 1
+                    keepDict.setdefault(record.name, []).append(bucket)
+
+        return keepDict
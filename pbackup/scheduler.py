@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+
+import  os
+import  sys
+import  time
+import  json
+import  pickle
+import  signal
+import  datetime
+import  threading
+import  subprocess
+from    optparse import OptionParser
+
+from    pbackup.backup import Backup, BackupError, UO
+from    pbackup.metrics import RunMetrics
+
+class BackupJob(object):
+    """@brief Responsible for holding the details of a single backup job run by the scheduler."""
+
+    DEFAULT_PRIORITY                = 0
+    #The number of previous runs used to find the expected duration of a job
+    HISTORY_RUN_COUNT               = 5
+
+    def __init__(self, name, configFile, atList, priority=DEFAULT_PRIORITY):
+        """@brief Constructor
+           @param name The name of the job.
+           @param configFile The config file saved by pbackup --save_config that holds the backup options.
+           @param atList A list of the times of day (HH:MM) that the job should run.
+           @param priority Jobs with a higher priority are started first when several are waiting."""
+        self.name           = name
+        self.configFile     = os.path.abspath(configFile)
+        self.atList         = []
+        self.priority       = priority
+        self.nextTrigger    = None
+        #The metrics history of the job and the stat key of the history file it was read from
+        self._historyList   = []
+        self._historyKey    = None
+
+        for at in atList:
+            try:
+                self.atList.append( datetime.datetime.strptime(at, "%H:%M").time() )
+            except ValueError:
+                raise BackupError("{}: {} is not a valid time of day (HH:MM).".format(name, at))
+
+        if not os.path.isfile(self.configFile):
+            raise BackupError("{}: {} config file not found.".format(name, self.configFile))
+        with open(self.configFile, "rb") as fd:
+            options = pickle.load(fd)
+        #The dest option may hold a comma separated list of dest paths. The first is the primary
+        #dest path that holds the metrics of each run.
+        destList = [dest.strip() for dest in (options.dest or "").split(",") if dest.strip()]
+        if not destList:
+            raise BackupError("{}: {} does not define the dest path.".format(name, self.configFile))
+        self.dest = destList[0]
+
+    def getDevice(self):
+        """@return The ID of the device holding the dest path. If the dest path does not exist
+                   yet the device holding the nearest parent folder is returned."""
+        path = self.dest
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        return os.stat(path).st_dev
+
+    def _getHistory(self):
+        """@brief Get the metrics saved by previous runs of the job. The history file is only read
+                  again when its modification time or size changes as the scheduler checks the
+                  waiting jobs every second.
+           @return A list of dicts, oldest first."""
+        historyFile = os.path.join(self.dest, Backup.METRICS_HISTORY_FILE)
+        try:
+            fileStat = os.stat(historyFile)
+            historyKey = (fileStat.st_mtime_ns, fileStat.st_size)
+        except OSError:
+            historyKey = None
+
+        if historyKey != self._historyKey:
+            self._historyList = RunMetrics.LoadHistory(historyFile)
+            self._historyKey = historyKey
+        return self._historyList
+
+    def getExpectedDuration(self):
+        """@return The average time in seconds taken by the last successful runs of the job
+                   or 0 if the job has not run successfully before."""
+        durationList = [history["duration_seconds"] for history in self._getHistory() if history.get("success") and "duration_seconds" in history]
+        durationList = durationList[-BackupJob.HISTORY_RUN_COUNT:]
+        if not durationList:
+            return 0
+        return sum(durationList)/len(durationList)
+
+    def getLastRunSuccess(self, startTime):
+        """@brief Find out if a run of the job succeeded from the metrics it saved.
+           @param startTime The time the run was started.
+           @return True if the run succeeded, False if it failed or None if it saved no metrics."""
+        for history in reversed(self._getHistory()):
+            if history.get("start_time", 0) >= startTime:
+                return bool(history.get("success"))
+        return None
+
+    def updateNextTrigger(self, now):
+        """@brief Set the next time the job should run.
+           @param now The current datetime."""
+        self.nextTrigger = None
+        for at in self.atList:
+            trigger = datetime.datetime.combine(now.date(), at)
+            if trigger <= now:
+                trigger = trigger + datetime.timedelta(days=1)
+            if self.nextTrigger is None or trigger < self.nextTrigger:
+                self.nextTrigger = trigger
+
+    def getCmd(self):
+        """@return The command used to run the job."""
+        return [sys.executable, "-m", "pbackup.backup", "--load_config", self.configFile]
+
+class BackupScheduler(object):
+    """@brief Responsible for running many backup jobs. The number of jobs running at the same
+              time is limited in total and for each dest device so that jobs that are triggered
+              at the same time do not compete for the same disks. Waiting jobs are started in
+              priority order and then longest expected duration first."""
+
+    DEFAULT_MAX_JOBS                = 2
+    DEFAULT_MAX_JOBS_PER_DEVICE     = 1
+    POLL_SECONDS                    = 1.0
+
+    def __init__(self, uo, jobList, maxJobs=DEFAULT_MAX_JOBS, maxJobsPerDevice=DEFAULT_MAX_JOBS_PER_DEVICE):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param jobList A list of BackupJob instances.
+           @param maxJobs The maximum number of jobs to run at the same time.
+           @param maxJobsPerDevice The maximum number of jobs to run at the same time that back up to the same dest device."""
+        self._uo                = uo
+        self._jobList           = jobList
+        self._maxJobs           = maxJobs
+        self._maxJobsPerDevice  = maxJobsPerDevice
+        self._waitingList       = []
+        #Each value is a tuple of the job, Popen instance, dest device and start time
+        self._runningDict       = {}
+        self._stopEvent         = threading.Event()
+
+        nameSet = set()
+        for job in jobList:
+            if job.name in nameSet:
+                raise BackupError("More than one job is named {}.".format(job.name))
+            nameSet.add(job.name)
+
+    @staticmethod
+    def Load(configFile):
+        """@brief Load the jobs from a JSON jobs file.
+           @param configFile The JSON file. This holds a dict with the max_jobs (optional),
+                             max_jobs_per_device (optional) and jobs keys. The jobs value
+                             is a list of dicts, each with the name, config, at (list of
+                             HH:MM times) and priority (optional) keys.
+           @return A tuple of the jobs list, max jobs and max jobs per device."""
+        with open(configFile, 'r') as fd:
+            try:
+                configDict = json.load(fd)
+            except ValueError as e:
+                raise BackupError("{}: {}".format(configFile, e))
+
+        jobList = []
+        for jobDict in configDict.get("jobs", []):
+            for key in ("name", "config"):
+                if key not in jobDict:
+                    raise BackupError("{}: A job does not define {}.".format(configFile, key))
+            jobList.append( BackupJob(jobDict["name"], jobDict["config"], jobDict.get("at", []), priority=jobDict.get("priority", BackupJob.DEFAULT_PRIORITY)) )
+
+        if not jobList:
+            raise BackupError("{}: No jobs defined.".format(configFile))
+
+        return (jobList,
+                configDict.get("max_jobs", BackupScheduler.DEFAULT_MAX_JOBS),
+                configDict.get("max_jobs_per_device", BackupScheduler.DEFAULT_MAX_JOBS_PER_DEVICE))
+
+    def stop(self):
+        """@brief Stop starting jobs. Running jobs are left to complete."""
+        self._stopEvent.set()
+
+    def trigger(self, job):
+        """@brief Add a job to the list of jobs waiting to run. If the job (or another job
+                  using the same config file) is already waiting or running the trigger is ignored.
+           @param job The BackupJob instance."""
+        activeJobList = self._waitingList + [runningJob for runningJob, _, _, _ in self._runningDict.values()]
+        if job.configFile in [activeJob.configFile for activeJob in activeJobList]:
+            self._uo.warn("{}: Already waiting or running, trigger ignored.".format(job.name))
+            return
+        self._uo.info("{}: Triggered.".format(job.name))
+        self._waitingList.append(job)
+
+    def _checkTriggers(self, now):
+        """@brief Trigger each job whose trigger time has been reached.
+           @param now The current datetime."""
+        for job in self._jobList:
+            if job.nextTrigger and job.nextTrigger <= now:
+                self.trigger(job)
+                #If the scheduler was busy and more than one trigger time has passed the job only runs once
+                job.updateNextTrigger(now)
+
+    def _startJobs(self):
+        """@brief Start as many waiting jobs as the limits allow."""
+        deviceCountDict = {}
+        for _, _, device, _ in self._runningDict.values():
+            deviceCountDict[device] = deviceCountDict.get(device, 0) + 1
+
+        durationDict = {job.name: job.getExpectedDuration() for job in self._waitingList}
+        self._waitingList.sort(key=lambda job: (-job.priority, -durationDict[job.name]))
+        for job in list(self._waitingList):
+            if len(self._runningDict) >= self._maxJobs:
+                break
+
+            device = job.getDevice()
+            if deviceCountDict.get(device, 0) >= self._maxJobsPerDevice:
+                continue
+
+            self._waitingList.remove(job)
+            deviceCountDict[device] = deviceCountDict.get(device, 0) + 1
+            self._uo.info("{}: Started (expected to take {:.0f} seconds).".format(job.name, durationDict[job.name]))
+            #The job runs in its own session so that CTRL C stops the scheduler but not the job
+            process = subprocess.Popen(job.getCmd(), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+            self._runningDict[job.name] = (job, process, device, time.time())
+
+    def _checkJobs(self):
+        """@brief Check for jobs that have completed."""
+        for name, (job, process, _, startTime) in list(self._runningDict.items()):
+            exitCode = process.poll()
+            if exitCode is None:
+                continue
+
+            del self._runningDict[name]
+            success = job.getLastRunSuccess(startTime)
+            if exitCode == 0 and success:
+                self._uo.info("{}: Completed successfully in {:.0f} seconds.".format(name, time.time()-startTime))
+            else:
+                self._uo.error("{}: Failed after {:.0f} seconds (exit code {}). See the log file in {}.".format(name, time.time()-startTime, exitCode, job.dest))
+
+    def run(self, runNow=False):
+        """@brief Run the jobs until stop() is called.
+           @param runNow If True all the jobs are triggered at once and this method returns
+                         when they have completed."""
+        now = datetime.datetime.now()
+        for job in self._jobList:
+            if runNow:
+                self.trigger(job)
+            else:
+                job.updateNextTrigger(now)
+                if job.nextTrigger:
+                    self._uo.info("{}: Next run at {}.".format(job.name, job.nextTrigger.strftime("%Y-%m-%d %H:%M")))
+                else:
+                    self._uo.warn("{}: No run times defined.".format(job.name))
+
+        while not self._stopEvent.is_set():
+            self._checkJobs()
+            if not runNow:
+                self._checkTriggers(datetime.datetime.now())
+            self._startJobs()
+            if runNow and not self._waitingList and not self._runningDict:
+                break
+            self._stopEvent.wait(BackupScheduler.POLL_SECONDS)
+
+        self.waitForJobs()
+
+    def waitForJobs(self):
+        """@brief Wait for the running jobs to complete."""
+        if self._runningDict:
+            self._uo.info("Waiting for {} running jobs to complete.".format(len(self._runningDict)))
+        while self._runningDict:
+            self._checkJobs()
+            time.sleep(BackupScheduler.POLL_SECONDS)
+
+def main():
+    uo = UO()
+
+    opts=OptionParser(usage="\n\
+     Run many pbackup jobs. Each job is defined by a config file saved with pbackup --save_config.\n\
+     The jobs file is a JSON file of the form\n\
+     {\"max_jobs\": 2, \"max_jobs_per_device\": 1, \"jobs\": [{\"name\": \"home\", \"config\": \"/root/home.cfg\", \"at\": [\"02:00\"], \"priority\": 10}]}")
+
+    opts.add_option("--jobs",                   help="Followed by the JSON jobs file (required).", default=None)
+    opts.add_option("--max_jobs",               help="Followed by the maximum number of jobs to run at the same time. Overrides the max_jobs value in the jobs file.", type="int", default=None)
+    opts.add_option("--max_jobs_per_device",    help="Followed by the maximum number of jobs backing up to the same dest device to run at the same time. Overrides the max_jobs_per_device value in the jobs file.", type="int", default=None)
+    opts.add_option("--run_now",                help="Run all the jobs now and exit when they have completed.", action="store_true", default=False)
+    opts.add_option("--log",                    help="Followed by the absolute path of the scheduler log file (optional).", default=None)
+    opts.add_option("-d", "--debug",            help="Enable debugging.", action="store_true", default=False)
+
+    try:
+        (options, args) = opts.parse_args()
+
+        if not options.jobs:
+            raise BackupError("Please define the jobs file using the --jobs command line option.")
+
+        if options.log:
+            uo.setLog(options.log)
+
+        jobList, maxJobs, maxJobsPerDevice = BackupScheduler.Load(options.jobs)
+        if options.max_jobs is not None:
+            maxJobs = options.max_jobs
+        if options.max_jobs_per_device is not None:
+            maxJobsPerDevice = options.max_jobs_per_device
+        if maxJobs < 1 or maxJobsPerDevice < 1:
+            raise BackupError("The maximum number of jobs must be 1 or more.")
+
+        scheduler = BackupScheduler(uo, jobList, maxJobs=maxJobs, maxJobsPerDevice=maxJobsPerDevice)
+        #Let running jobs complete when asked to stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+        try:
+            scheduler.run(runNow=options.run_now)
+        except KeyboardInterrupt:
+            scheduler.stop()
+            scheduler.waitForJobs()
+
+    #Don't print error information if CTRL C pressed
+    except KeyboardInterrupt:
+      pass
+
+    except Exception as e:
+        uo.error(str(e))
+        if options.debug:
+            raise
+        sys.exit(1)
+
+    finally:
+        uo.closeLog()
+
+if __name__== '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import  os
+import  shlex
+import  shutil
+import  tempfile
+from    subprocess import check_output, call, STDOUT, CalledProcessError, DEVNULL
+
+class SshSession(object):
+    """@brief Responsible for a single ssh connection to a remote machine (an OpenSSH ControlMaster)
+              that is opened once and then shared by every ssh command and the rsync transport.
+              Each command then starts without the cost of connecting and authenticating again."""
+
+    DEFAULT_SSH_CMD                 = "/usr/bin/ssh"
+    CONNECT_TIMEOUT                 = 30
+    #The options that pbackup has always used when an ssh port is given. These disable the check
+    #of the remote machine's host key.
+    NO_HOST_KEY_CHECK_OPTIONS       = ("-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", "-o", "LogLevel=ERROR")
+
+    @staticmethod
+    def QuotePath(path):
+        """@brief Quote a path for the remote shell. A leading ~ or ~user is not quoted so that
+                  the remote shell expands it to the home folder.
+           @param path The path on the remote machine.
+           @return The quoted path."""
+        if path.startswith("~"):
+            homePart, sep, rest = path.partition("/")
+            if all([char.isalnum() or char in "~._-" for char in homePart]):
+                if not rest:
+                    return homePart + sep
+                return "{}/{}".format(homePart, shlex.quote(rest))
+        return shlex.quote(path)
+
+    def __init__(self, username, hostName, port=None, sshCmd=DEFAULT_SSH_CMD, checkHostKey=True):
+        """@brief Constructor
+           @param username The username on the remote machine.
+           @param hostName The address of the remote machine.
+           @param port The ssh port or None to use the default port.
+           @param sshCmd The ssh program.
+           @param checkHostKey If False the host key of the remote machine is not checked."""
+        self._username      = username
+        self._hostName      = hostName
+        self._port          = port
+        self._sshCmd        = sshCmd
+        self._checkHostKey  = checkHostKey
+        self._controlDir    = None
+
+    def _getOptions(self):
+        """@return The ssh arguments used by every connection to the remote machine."""
+        argList = []
+        if self._port:
+            argList = argList + ["-p", str(self._port)]
+        if not self._checkHostKey:
+            argList = argList + list(SshSession.NO_HOST_KEY_CHECK_OPTIONS)
+        return argList
+
+    def getTarget(self):
+        """@return The username@host string."""
+        return "{}@{}".format(self._username, self._hostName)
+
+    def _getControlPath(self):
+        """@return The path of the socket that the shared connection is reached through."""
+        return os.path.join(self._controlDir, "control")
+
+    def getSshArgs(self):
+        """@return A list of the ssh program and the arguments (not including the target) that use the shared connection."""
+        argList = [self._sshCmd] + self._getOptions()
+        if self._controlDir:
+            #If the shared connection has closed ssh connects again
+            argList = argList + ["-o", "ControlMaster=no", "-o", "ControlPath={}".format(self._getControlPath())]
+        return argList
+
+    def getRsyncShell(self):
+        """@return The remote shell command for the rsync -e argument."""
+        return " ".join([shlex.quote(arg) for arg in self.getSshArgs()])
+
+    def open(self):
+        """@brief Connect to the remote machine. ssh asks for a password if required and then runs
+                  in the background holding the connection until close() is called."""
+        self._controlDir = tempfile.mkdtemp(prefix="pbackup_ssh_")
+        argList = [self._sshCmd] + self._getOptions()
+        argList = argList + ["-o", "ConnectTimeout={}".format(SshSession.CONNECT_TIMEOUT),
+                             "-o", "ControlMaster=yes",
+                             "-o", "ControlPersist=yes",
+                             "-o", "ControlPath={}".format(self._getControlPath()),
+                             "-N", "-f", self.getTarget()]
+        try:
+            check_output(argList, stderr=STDOUT)
+        except CalledProcessError as e:
+            self._removeControlDir()
+            raise Exception("Failed to connect to {}: {}".format(self.getTarget(), e.output.decode(errors="replace").strip()))
+
+    def run(self, remoteCmd):
+        """@brief Run a command on the remote machine.
+           @param remoteCmd The command line to run.
+           @return The output of the command (str)."""
+        try:
+            output = check_output(self.getSshArgs() + [self.getTarget(), remoteCmd], stderr=STDOUT, stdin=DEVNULL)
+        except CalledProcessError as e:
+            raise Exception("'{}' failed on {}: {}".format(remoteCmd, self.getTarget(), e.output.decode(errors="replace").strip()))
+        return output.decode(errors="replace")
+
+    def getRsyncVersion(self, rsyncCmd="rsync"):
+        """@return The version of rsync on the remote machine (E.G 3.2.7)."""
+        output = self.run("{} --version".format(shlex.quote(rsyncCmd)))
+        elems = output.split()
+        if len(elems) < 3 or elems[0] != "rsync" or elems[1] != "version":
+            raise Exception("rsync is not installed on {}.".format(self.getTarget()))
+        return elems[2]
+
+    def getFreeSpace(self, path):
+        """@brief Get the disk space on the remote machine.
+           @param path A path on the remote disk.
+           @return A tuple of the total and free space in bytes."""
+        output = self.run("df -Pk {}".format(SshSession.QuotePath(path)))
+        lines = output.strip().splitlines()
+        elems = lines[-1].split() if lines else []
+        try:
+            return (int(elems[1])*1024, int(elems[3])*1024)
+        except (IndexError, ValueError):
+            raise Exception("Failed to read the disk space of {} on {}.".format(path, self.getTarget()))
+
+    def getFileCount(self, path):
+        """@return The number of files and folders below a path on the remote machine."""
+        output = self.run("find {} -xdev | wc -l".format(SshSession.QuotePath(path)))
+        try:
+            return int(output.strip())
+        except ValueError:
+            raise Exception("Failed to count the files in {} on {}.".format(path, self.getTarget()))
+
+    def _removeControlDir(self):
+        """@brief Remove the folder holding the control socket."""
+        if self._controlDir:
+            shutil.rmtree(self._controlDir, ignore_errors=True)
+            self._controlDir = None
+
+    def close(self):
+        """@brief Close the shared connection."""
+        if self._controlDir is None:
+            return
+        if os.path.exists(self._getControlPath()):
+            call([self._sshCmd, "-o", "ControlPath={}".format(self._getControlPath()), "-O", "exit", self.getTarget()], stdout=DEVNULL, stderr=DEVNULL, stdin=DEVNULL)
+        self._removeControlDir()
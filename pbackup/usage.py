@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+import  os
+import  stat
+import  pickle
+from    array import array
+from    concurrent.futures import ThreadPoolExecutor
+
+class SnapshotUsage(object):
+    """@brief Responsible for holding the files found in a single backup folder."""
+
+    def __init__(self, name, fileCount, inodes, sizes):
+        """@brief Constructor
+           @param name The name of the backup folder.
+           @param fileCount The number of regular files (including hard links) in the backup folder.
+           @param inodes An array of the inode numbers of the regular files. Each inode appears once.
+           @param sizes An array of the file sizes in bytes, in the same order as the inodes."""
+        self.name       = name
+        self.fileCount  = fileCount
+        self.inodes     = inodes
+        self.sizes      = sizes
+
+    def getTotalBytes(self):
+        """@return The number of bytes held in the files of this backup."""
+        return sum(self.sizes)
+
+class SnapshotUsageScanner(object):
+    """@brief Responsible for finding how much disk space each backup uses on its own
+              and how much it shares with other backups through hard links. The files
+              found in each backup are cached so a backup is only ever read once."""
+
+    CACHE_VERSION                   = 1
+    CACHE_SUFFIX                    = ".usage"
+    DEFAULT_THREAD_COUNT            = 4
+
+    def __init__(self, uo, dest, cacheDir, threadCount=DEFAULT_THREAD_COUNT):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param dest The dest path holding the backups.
+           @param cacheDir The folder that holds the cached results.
+           @param threadCount The number of backups to read at the same time."""
+        self._uo            = uo
+        self._dest          = dest
+        self._cacheDir      = cacheDir
+        self._threadCount   = threadCount
+
+    def _getCacheFile(self, name):
+        """@return The file that the results for a backup are cached in."""
+        return os.path.join(self._cacheDir, "{}{}".format(name, SnapshotUsageScanner.CACHE_SUFFIX))
+
+    def _loadCache(self, name):
+        """@brief Load the cached results for a backup.
+           @param name The name of the backup folder.
+           @return A SnapshotUsage instance or None if not cached."""
+        cacheFile = self._getCacheFile(name)
+        if not os.path.isfile(cacheFile):
+            return None
+
+        try:
+            with open(cacheFile, 'rb') as fd:
+                cache = pickle.load(fd)
+            if cache["version"] == SnapshotUsageScanner.CACHE_VERSION:
+                return SnapshotUsage(name, cache["fileCount"], cache["inodes"], cache["sizes"])
+        except (pickle.UnpicklingError, EOFError, KeyError, TypeError):
+            pass
+
+        return None
+
+    def _saveCache(self, snapshotUsage):
+        """@brief Save the results for a backup.
+           @param snapshotUsage The SnapshotUsage instance to save."""
+        cache = {"version":     SnapshotUsageScanner.CACHE_VERSION,
+                 "fileCount":   snapshotUsage.fileCount,
+                 "inodes":      snapshotUsage.inodes,
+                 "sizes":       snapshotUsage.sizes}
+        cacheFile = self._getCacheFile(snapshotUsage.name)
+        tmpFile = "{}.tmp".format(cacheFile)
+        with open(tmpFile, 'wb') as fd:
+            pickle.dump(cache, fd)
+        os.replace(tmpFile, cacheFile)
+
+    def _scan(self, name):
+        """@brief Read all the files in a backup.
+           @param name The name of the backup folder.
+           @return A SnapshotUsage instance."""
+        self._uo.info("Reading {}".format(name))
+        inodeSet = set()
+        inodes = array('Q')
+        sizes = array('Q')
+        fileCount = 0
+        dirList = [os.path.join(self._dest, name)]
+        while dirList:
+            with os.scandir(dirList.pop()) as entryIter:
+                for entry in entryIter:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirList.append(entry.path)
+                        continue
+
+                    entryStat = entry.stat(follow_symlinks=False)
+                    if not stat.S_ISREG(entryStat.st_mode):
+                        continue
+
+                    fileCount = fileCount + 1
+                    #Files with more than one link may be linked more than once in this backup
+                    if entryStat.st_nlink > 1:
+                        if entryStat.st_ino in inodeSet:
+                            continue
+                        inodeSet.add(entryStat.st_ino)
+
+                    inodes.append(entryStat.st_ino)
+                    sizes.append(entryStat.st_size)
+
+        return SnapshotUsage(name, fileCount, inodes, sizes)
+
+    def _getUsage(self, name):
+        """@brief Get the files in a backup, reading them if not cached.
+           @param name The name of the backup folder.
+           @return A SnapshotUsage instance."""
+        snapshotUsage = self._loadCache(name)
+        if snapshotUsage is None:
+            snapshotUsage = self._scan(name)
+            self._saveCache(snapshotUsage)
+        return snapshotUsage
+
+    def scan(self, nameList):
+        """@brief Get the files in each of the backups given.
+           @param nameList The names of the complete backup folders.
+           @return A list of SnapshotUsage instances in the same order as nameList."""
+        if not os.path.isdir(self._cacheDir):
+            os.makedirs(self._cacheDir)
+
+        #Remove results of backups that have been deleted
+        nameSet = set(nameList)
+        for entry in os.listdir(self._cacheDir):
+            if entry.endswith(SnapshotUsageScanner.CACHE_SUFFIX) and entry[:-len(SnapshotUsageScanner.CACHE_SUFFIX)] not in nameSet:
+                os.remove(os.path.join(self._cacheDir, entry))
+
+        with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+            return list(executor.map(self._getUsage, nameList))
+
+    @staticmethod
+    def GetRefCounts(snapshotUsageList):
+        """@brief Count the number of backups that hold each inode.
+           @param snapshotUsageList A list of SnapshotUsage instances.
+           @return A dict. Each key is an inode and each value is the number of backups holding it."""
+        refCountDict = {}
+        for snapshotUsage in snapshotUsageList:
+            for inode in snapshotUsage.inodes:
+                refCountDict[inode] = refCountDict.get(inode, 0) + 1
+        return refCountDict
+
+    @staticmethod
+    def GetUniqueBytes(snapshotUsage, refCountDict):
+        """@brief Get the number of bytes that are held only by one backup.
+           @param snapshotUsage The SnapshotUsage instance of the backup.
+           @param refCountDict The dict returned by GetRefCounts().
+           @return The number of bytes that would be freed if the backup was deleted."""
+        uniqueBytes = 0
+        for inode, size in zip(snapshotUsage.inodes, snapshotUsage.sizes):
+            if refCountDict[inode] == 1:
+                uniqueBytes = uniqueBytes + size
+        return uniqueBytes
+
+    @staticmethod
+    def GetFreedBytes(snapshotUsageList, refCountDict):
+        """@brief Get the number of bytes that would be freed if a group of backups were deleted.
+           @param snapshotUsageList The SnapshotUsage instances of the backups to be deleted.
+           @param refCountDict The dict returned by GetRefCounts() for all the backups.
+           @return The number of bytes held only by the given backups."""
+        groupRefCountDict = SnapshotUsageScanner.GetRefCounts(snapshotUsageList)
+        freedBytes = 0
+        sizeDict = {}
+        for snapshotUsage in snapshotUsageList:
+            for inode, size in zip(snapshotUsage.inodes, snapshotUsage.sizes):
+                sizeDict[inode] = size
+        for inode, refCount in groupRefCountDict.items():
+            if refCountDict[inode] == refCount:
+                freedBytes = freedBytes + sizeDict[inode]
+        return freedBytes
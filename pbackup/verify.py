@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+import  os
+import  stat
+import  time
+import  hashlib
+import  sqlite3
+import  threading
+from    concurrent.futures import ThreadPoolExecutor
+
+class RateLimiter(object):
+    """@brief Responsible for limiting the rate that data is read by several threads."""
+
+    def __init__(self, bytesPerSecond):
+        """@brief Constructor
+           @param bytesPerSecond The maximum rate. 0 = no limit."""
+        self._bytesPerSecond    = bytesPerSecond
+        self._lock              = threading.Lock()
+        self._nextTime          = time.time()
+
+    def wait(self, byteCount):
+        """@brief Wait until the given number of bytes may be read.
+           @param byteCount The number of bytes about to be read."""
+        if self._bytesPerSecond <= 0:
+            return
+
+        with self._lock:
+            now = time.time()
+            startTime = max(now, self._nextTime)
+            self._nextTime = startTime + byteCount/self._bytesPerSecond
+        if startTime > now:
+            time.sleep(startTime-now)
+
+class VerifyResult(object):
+    """@brief Responsible for holding the results of a verify run."""
+
+    def __init__(self):
+        self.fileCount      = 0
+        self.byteCount      = 0
+        self.newCount       = 0
+        self.skippedCount   = 0
+        self.complete       = False
+        #Each entry is a tuple of the path and the reason it failed
+        self.failedList     = []
+
+class SnapshotVerifier(object):
+    """@brief Responsible for checking that the files in the backups can be read and have not
+              changed since they were last checked. The hash of each file is saved in the dest
+              path. As files hard linked together share an inode, each inode is only read once
+              however many backups hold it.
+
+              Each verify run is part of a session. A session that was stopped (E.G by the
+              --verify_max_time limit) is continued by the next run, skipping the files already
+              checked, so a large dest path can be checked over several runs."""
+
+    DEFAULT_THREAD_COUNT            = 4
+    READ_SIZE                       = 8*1048576
+    #The number of files hashed between each save of the results
+    BATCH_SIZE                      = 256
+
+    def __init__(self, uo, dbFile, threadCount=DEFAULT_THREAD_COUNT, bytesPerSecond=0, maxSeconds=0):
+        """@brief Constructor
+           @param uo The UO instance used to report progress.
+           @param dbFile The sqlite file holding the saved hashes.
+           @param threadCount The number of files to read at the same time.
+           @param bytesPerSecond The maximum rate to read files. 0 = no limit.
+           @param maxSeconds Stop after this time. The next run continues the session. 0 = no limit."""
+        self._uo            = uo
+        self._dbFile        = dbFile
+        self._threadCount   = threadCount
+        self._rateLimiter   = RateLimiter(bytesPerSecond)
+        self._maxSeconds    = maxSeconds
+
+    def _openDB(self):
+        """@brief Open the database, creating it if required.
+           @return The sqlite3 connection."""
+        connection = sqlite3.connect(self._dbFile)
+        connection.execute("CREATE TABLE IF NOT EXISTS inodes (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, hash BLOB, verified REAL, PRIMARY KEY (dev, ino))")
+        connection.execute("CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, completed REAL)")
+        return connection
+
+    def _getSession(self, connection):
+        """@brief Get the session that this run is part of.
+           @param connection The sqlite3 connection.
+           @return The time the session started. Files checked since this time are skipped."""
+        row = connection.execute("SELECT id, started, completed FROM sessions ORDER BY id DESC LIMIT 1").fetchone()
+        if row and row[2] is None:
+            self._uo.info("Continuing the verify session started {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[1]))))
+            return row[1]
+
+        startTime = time.time()
+        connection.execute("INSERT INTO sessions (started) VALUES (?)", (startTime,))
+        connection.commit()
+        return startTime
+
+    def _getHash(self, path):
+        """@brief Get the hash of the contents of a file. The file is read in large blocks and
+                  removed from the page cache once read so that checking does not push other
+                  data out of memory.
+           @param path The file path.
+           @return The hash (bytes)."""
+        fileHash = hashlib.sha256()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            offset = 0
+            while True:
+                data = os.read(fd, SnapshotVerifier.READ_SIZE)
+                if not data:
+                    break
+                self._rateLimiter.wait(len(data))
+                fileHash.update(data)
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+                offset = offset + len(data)
+        finally:
+            os.close(fd)
+        return fileHash.digest()
+
+    def _check(self, item):
+        """@brief Hash a backup file and, if required, the src file it was copied from.
+           @param item A tuple of the backup file path, its os.stat_result and the src file path (or None).
+           @return A tuple of the backup file hash (None if it could not be read), the src file
+                   hash (None if not required) and the error text (None if no error)."""
+        path, fileStat, srcPath = item
+        try:
+            fileHash = self._getHash(path)
+        except OSError as e:
+            return (None, None, str(e))
+
+        srcHash = None
+        if srcPath:
+            try:
+                srcHash = self._getHash(srcPath)
+            except OSError:
+                #The src file may have been removed since it was checked
+                pass
+        return (fileHash, srcHash, None)
+
+    def _getSrcPath(self, srcPath, relPath, fileStat):
+        """@brief Get the src file to compare a backup file with.
+           @return The src file path or None if the src file does not exist or has changed since the backup."""
+        path = os.path.join(srcPath, relPath)
+        try:
+            srcStat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            return None
+        if stat.S_ISREG(srcStat.st_mode) and srcStat.st_size == fileStat.st_size and srcStat.st_mtime_ns == fileStat.st_mtime_ns:
+            return path
+        return None
+
+    def _getFiles(self, backupPathList, srcPath):
+        """@brief Find the files in the backups. Each inode is returned once.
+           @param backupPathList The backup folders.
+           @param srcPath If not None, the files in the last backup are compared with the files in this folder.
+           @return A list of (path, os.stat_result, src file path) tuples."""
+        fileList = []
+        inodeSet = set()
+        #The last backup is read first so that the files it shares with older backups are compared with the src path
+        for backupPath in reversed(backupPathList):
+            compareSrc = srcPath is not None and backupPath == backupPathList[-1]
+            dirList = [""]
+            while dirList:
+                dirPath = dirList.pop()
+                with os.scandir(os.path.join(backupPath, dirPath)) as entryIter:
+                    for entry in entryIter:
+                        relPath = os.path.join(dirPath, entry.name) if dirPath else entry.name
+                        entryStat = entry.stat(follow_symlinks=False)
+                        if stat.S_ISDIR(entryStat.st_mode):
+                            dirList.append(relPath)
+                            continue
+                        if not stat.S_ISREG(entryStat.st_mode):
+                            continue
+
+                        key = (entryStat.st_dev, entryStat.st_ino)
+                        if key in inodeSet:
+                            continue
+                        inodeSet.add(key)
+                        fileSrcPath = None
+                        if compareSrc:
+                            fileSrcPath = self._getSrcPath(srcPath, relPath, entryStat)
+                        fileList.append( (entry.path, entryStat, fileSrcPath) )
+        return fileList
+
+    def verify(self, backupPathList, srcPath=None):
+        """@brief Check the files in the backups.
+           @param backupPathList All the complete backup folders, oldest first. The hashes of
+                                 files not in these backups are removed when a session completes.
+           @param srcPath If not None, files in the last backup that have the same size and
+                          modification time as the file in this folder must have the same contents.
+           @return A VerifyResult instance."""
+        startTime = time.time()
+        result = VerifyResult()
+        connection = self._openDB()
+        try:
+            sessionStartTime = self._getSession(connection)
+
+            self._uo.info("Reading {} backups.".format(len(backupPathList)))
+            fileList = self._getFiles(backupPathList, srcPath)
+
+            checkList = []
+            savedDict = {}
+            for path, fileStat, fileSrcPath in fileList:
+                row = connection.execute("SELECT size, mtime_ns, hash, verified FROM inodes WHERE dev=? AND ino=?", (fileStat.st_dev, fileStat.st_ino)).fetchone()
+                #An inode number may be used again by a new file once a backup is purged
+                if row and (row[0] != fileStat.st_size or row[1] != fileStat.st_mtime_ns):
+                    row = None
+                if row and row[3] >= sessionStartTime and not fileSrcPath:
+                    result.skippedCount = result.skippedCount + 1
+                    continue
+                savedDict[(fileStat.st_dev, fileStat.st_ino)] = row[2] if row else None
+                checkList.append( (path, fileStat, fileSrcPath) )
+
+            totalBytes = sum([fileStat.st_size for _, fileStat, _ in checkList])
+            self._uo.info("Checking {} files ({:.1f} GB). {} files were checked earlier in this session.".format(len(checkList), totalBytes/(2**30), result.skippedCount))
+
+            lastReportTime = time.time()
+            with ThreadPoolExecutor(max_workers=self._threadCount) as executor:
+                for batchStart in range(0, len(checkList), SnapshotVerifier.BATCH_SIZE):
+                    if self._maxSeconds and time.time()-startTime >= self._maxSeconds:
+                        self._uo.info("Stopped after {:.0f} minutes. The next verify run will continue from here.".format(self._maxSeconds/60))
+                        break
+
+                    batchList = checkList[batchStart:batchStart+SnapshotVerifier.BATCH_SIZE]
+                    for (path, fileStat, fileSrcPath), (fileHash, srcHash, error) in zip(batchList, executor.map(self._check, batchList)):
+                        if error:
+                            result.failedList.append( (path, error) )
+                            continue
+
+                        result.fileCount = result.fileCount + 1
+                        result.byteCount = result.byteCount + fileStat.st_size
+                        if srcHash is not None and srcHash != fileHash:
+                            result.failedList.append( (path, "The contents are not the same as {}".format(fileSrcPath)) )
+
+                        savedHash = savedDict[(fileStat.st_dev, fileStat.st_ino)]
+                        if savedHash is None:
+                            result.newCount = result.newCount + 1
+                        elif savedHash != fileHash:
+                            result.failedList.append( (path, "The contents have changed since the file was last checked.") )
+                            #Keep the first hash so the file fails every check until it is replaced
+                            continue
+
+                        connection.execute("INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?, ?, ?)", (fileStat.st_dev, fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns, savedHash or fileHash, time.time()))
+
+                    connection.commit()
+                    if time.time() >= lastReportTime + 60:
+                        lastReportTime = time.time()
+                        elapsedSeconds = time.time()-startTime
+                        self._uo.info("Checked {} files, {:.1f} GB ({:.1f} MB/s)".format(result.fileCount, result.byteCount/(2**30), result.byteCount/1E6/elapsedSeconds))
+
+                else:
+                    result.complete = True
+                    connection.execute("UPDATE sessions SET completed=? WHERE started=?", (time.time(), sessionStartTime))
+                    #Remove the hashes of inodes that are no longer in any backup
+                    liveSet = set([(fileStat.st_dev, fileStat.st_ino) for _, fileStat, _ in fileList])
+                    staleList = [row for row in connection.execute("SELECT dev, ino FROM inodes") if tuple(row) not in liveSet]
+                    connection.executemany("DELETE FROM inodes WHERE dev=? AND ino=?", staleList)
+                    connection.commit()
+
+        finally:
+            connection.close()
+
+        elapsedSeconds = max(time.time()-startTime, 0.001)
+        self._uo.info("Checked {} files, {:.1f} GB in {:.0f} seconds ({:.1f} MB/s). {} files checked for the first time.".format(result.fileCount, result.byteCount/(2**30), elapsedSeconds, result.byteCount/1E6/elapsedSeconds, result.newCount))
+        return result
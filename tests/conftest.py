@@ -0,0 +1,27 @@
+import  pytest
+
+from    pbackup.backup import UO
+
+class RecordingUO(UO):
+    """@brief A UO that records the messages reported rather than printing them."""
+
+    def __init__(self):
+        UO.__init__(self)
+        self.infoList   = []
+        self.warnList   = []
+        self.errorList  = []
+
+    def info(self, msg):
+        self.infoList.append(msg)
+
+    def warn(self, msg):
+        self.warnList.append(msg)
+
+    def error(self, msg):
+        self.errorList.append(msg)
+
+@pytest.fixture
+def uo():
+    recordingUO = RecordingUO()
+    yield recordingUO
+    recordingUO.closeLog()
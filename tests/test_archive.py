@@ -0,0 +1,164 @@
+import  os
+import  stat
+import  filecmp
+import  pytest
+
+from    pbackup.archive import SnapshotArchiver, ArchiveReader
+
+def _makeTree(path):
+    """@brief Create a folder holding a file, a large file, a symlink, a read only folder and a name that is not UTF-8."""
+    (path / "sub" / "deep").mkdir(parents=True)
+    (path / "afile").write_text("a file")
+    (path / "big").write_bytes(os.urandom(200000))
+    (path / "sub" / "deep" / "f").write_text("deep")
+    os.symlink("../big", str(path / "sub" / "lnk"))
+    open(os.path.join(os.fsencode(str(path)), b"bad\xff"), 'w').close()
+    os.chmod(str(path / "sub" / "deep"), 0o555)
+    os.utime(str(path / "sub"), ns=(10**18, 10**18))
+
+def _assertSame(pathA, pathB):
+    """@brief Check that two folders hold the same paths. The attributes of the sub folders must also match."""
+    comparison = filecmp.dircmp(str(pathA), str(pathB))
+    assert not comparison.left_only and not comparison.right_only and not comparison.diff_files
+    for subDir in comparison.common_dirs:
+        statA = os.stat(str(pathA / subDir))
+        statB = os.stat(str(pathB / subDir))
+        assert stat.S_IMODE(statA.st_mode) == stat.S_IMODE(statB.st_mode)
+        assert statA.st_mtime_ns == statB.st_mtime_ns
+        _assertSame(pathA / subDir, pathB / subDir)
+
+@pytest.mark.parametrize("compression", SnapshotArchiver.COMPRESSION_LIST)
+def test_pack_and_restore(uo, tmp_path, compression):
+    backupPath = tmp_path / "backup"
+    backupPath.mkdir()
+    _makeTree(backupPath)
+    archivePath = tmp_path / "backup.archived"
+
+    pathCount, chunkCount, archiveBytes = SnapshotArchiver(uo, threadCount=2, compression=compression).pack(str(backupPath), str(archivePath))
+    assert pathCount == 7 and chunkCount == 1 and archiveBytes > 0
+    assert not os.path.exists("{}{}".format(archivePath, SnapshotArchiver.TMP_SUFFIX))
+
+    restorePath = tmp_path / "restore"
+    assert ArchiveReader(uo, str(archivePath)).restore(str(restorePath)) == 7
+    _assertSame(backupPath, restorePath)
+    assert os.readlink(str(restorePath / "sub" / "lnk")) == "../big"
+
+    #Restore again over the read only folders left by the first restore
+    assert ArchiveReader(uo, str(archivePath)).restore(str(restorePath)) == 7
+    _assertSame(backupPath, restorePath)
+
+def test_restore_pattern_from_several_chunks(uo, tmp_path, monkeypatch):
+    monkeypatch.setattr(SnapshotArchiver, "CHUNK_PATHS", 2)
+    backupPath = tmp_path / "backup"
+    (backupPath / "keep" / "inner").mkdir(parents=True)
+    (backupPath / "skip").mkdir()
+    for index in range(0, 5):
+        (backupPath / "keep" / "inner" / "f{}".format(index)).write_text(str(index))
+        (backupPath / "skip" / "f{}".format(index)).write_text(str(index))
+    archivePath = tmp_path / "backup.archived"
+    _, chunkCount, _ = SnapshotArchiver(uo, threadCount=3).pack(str(backupPath), str(archivePath))
+    assert chunkCount > 3
+
+    restorePath = tmp_path / "restore"
+    ArchiveReader(uo, str(archivePath)).restore(str(restorePath), patternList=["keep/inner"])
+    assert sorted(os.listdir(str(restorePath / "keep" / "inner"))) == ["f{}".format(index) for index in range(0, 5)]
+    assert not os.path.exists(str(restorePath / "skip"))
+
+def test_hard_linked_files_are_stored_once_per_set(uo, tmp_path):
+    fullPath = tmp_path / "full"
+    fullPath.mkdir()
+    (fullPath / "shared").write_bytes(os.urandom(100000))
+    (fullPath / "old").write_text("old")
+    incrPath = tmp_path / "incr"
+    incrPath.mkdir()
+    os.link(str(fullPath / "shared"), str(incrPath / "shared"))
+    os.link(str(fullPath / "shared"), str(incrPath / "moved"))
+    (incrPath / "new").write_text("new")
+
+    archiver = SnapshotArchiver(uo)
+    fullArchivePath = tmp_path / "full.archived"
+    archiver.pack(str(fullPath), str(fullArchivePath))
+
+    #Only the new file must be stored
+    assert archiver.getStoreBytes(str(incrPath), [str(fullArchivePath)]) == 3
+    incrArchivePath = tmp_path / "incr.archived"
+    _, _, incrArchiveBytes = archiver.pack(str(incrPath), str(incrArchivePath), linkArchivePathList=[str(fullArchivePath)])
+    assert incrArchiveBytes < 10000
+
+    restorePath = tmp_path / "restore"
+    ArchiveReader(uo, str(incrArchivePath)).restore(str(restorePath))
+    assert sorted(os.listdir(str(restorePath))) == ["moved", "new", "shared"]
+    assert (restorePath / "shared").read_bytes() == (fullPath / "shared").read_bytes()
+    assert (restorePath / "moved").read_bytes() == (fullPath / "shared").read_bytes()
+
+def test_unsupported_compression(uo):
+    with pytest.raises(ValueError):
+        SnapshotArchiver(uo, compression="zst")
+
+def test_purge_archives_old_sets_outside_a_backup_run(uo, tmp_path):
+    from pbackup.backup import Backup, getOptionParser
+    from pbackup.catalog import SnapshotRecord
+
+    src = tmp_path / "src"
+    src.mkdir()
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    nameList = ["2026-Oct-01_10_00_00.FULL_1",
+                "2026-Oct-01_10_10_00.FULL_1_INCR_1",
+                "2026-Oct-01_10_20_00.FULL_2"]
+    for name in nameList:
+        (dest / name).mkdir()
+    (dest / nameList[0] / "shared").write_bytes(os.urandom(100000))
+    os.link(str(dest / nameList[0] / "shared"), str(dest / nameList[1] / "shared"))
+    os.link(str(dest / nameList[0] / "shared"), str(dest / nameList[2] / "shared"))
+
+    expectedList = ["{}.{}".format(nameList[0], SnapshotRecord.ARCHIVED_SUFFIX),
+                    "{}.{}".format(nameList[1], SnapshotRecord.ARCHIVED_SUFFIX),
+                    nameList[2]]
+    options, _ = getOptionParser().parse_args(["--src", str(src), "--dest", str(dest), "--archive_days", "1"])
+    bk = Backup(uo, options)
+    bk._purgeBackups()
+    assert [record.name for record in bk._catalog.getRecords()] == expectedList
+
+    #The archived incremental backup must not be thinned by the --keep_* options
+    options, _ = getOptionParser().parse_args(["--src", str(src), "--dest", str(dest), "--archive_days", "1", "--keep_hourly", "1"])
+    bk = Backup(uo, options)
+    bk._purgeBackups()
+    assert [record.name for record in bk._catalog.getRecords()] == expectedList
+    assert not uo.errorList
+
+    #Restore the archived incremental backup through the linked full backup archive
+    restoreOptions, _ = getOptionParser().parse_args(["--dest", str(dest), "--restore", expectedList[1], "--restore_to", str(tmp_path / "restore")])
+    Backup(uo, restoreOptions).restore()
+    assert (tmp_path / "restore" / "shared").read_bytes() == (dest / nameList[2] / "shared").read_bytes()
+
+def test_archives_are_not_incomplete_backups(uo, tmp_path):
+    from pbackup.backup import Backup, getOptionParser
+    from pbackup.catalog import SnapshotRecord
+
+    src = tmp_path / "src"
+    src.mkdir()
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    nameList = ["2026-Oct-01_10_00_00.FULL_1",
+                "2026-Oct-01_10_10_00.FULL_1_INCR_1",
+                "2026-Oct-01_10_20_00.FULL_2"]
+    for name in nameList:
+        (dest / name).mkdir()
+        (dest / name / "afile").write_text(name)
+    incompleteName = "2026-Oct-01_10_30_00.FULL_2_INCR_1.{}".format(SnapshotRecord.INCOMPLETE_SUFFIX)
+    (dest / incompleteName).mkdir()
+
+    options, _ = getOptionParser().parse_args(["--src", str(src), "--dest", str(dest), "--archive_days", "1"])
+    bk = Backup(uo, options)
+    bk._purgeBackups()
+    assert len([record for record in bk._catalog.getRecords() if record.isArchived()]) == 2
+
+    #A backup with the same IDs as an archive must not resume it
+    resumeRecord, staleRecordList = bk._getIncompleteBackups( str(dest / nameList[1]) )
+    assert resumeRecord is None
+    assert [record.name for record in staleRecordList] == [incompleteName]
+
+    resumeRecord, staleRecordList = bk._getIncompleteBackups( str(dest / incompleteName[:-len(SnapshotRecord.INCOMPLETE_SUFFIX)-1]) )
+    assert resumeRecord.name == incompleteName
+    assert not staleRecordList
@@ -0,0 +1,83 @@
+import  os
+
+from    pbackup.catalog import SnapshotRecord, SnapshotCatalog
+
+FULL_NAME       = "2026-Oct-01_10_00_00.FULL_1"
+INCR_NAME       = "2026-Oct-01_11_00_00.FULL_1_INCR_1"
+INCOMPLETE_NAME = "2026-Oct-01_12_00_00.FULL_1_INCR_2.incomplete"
+
+def _getCatalog(tmp_path):
+    return SnapshotCatalog(str(tmp_path / "dest"), str(tmp_path / "dest" / ".pbackup" / "catalog.json"))
+
+def _makeDest(tmp_path, nameList):
+    (tmp_path / "dest").mkdir()
+    for name in nameList:
+        (tmp_path / "dest" / name).mkdir()
+
+def test_parse():
+    record = SnapshotRecord.Parse(INCOMPLETE_NAME)
+    assert record.fullID == 1 and record.incrID == 2
+    assert not record.isFull() and not record.isComplete()
+    assert SnapshotRecord.Parse("{}.{}".format(FULL_NAME, SnapshotRecord.ARCHIVED_SUFFIX)).isArchived()
+    assert SnapshotRecord.Parse("not_a_backup") is None
+
+def test_records_are_sorted(tmp_path):
+    _makeDest(tmp_path, [INCOMPLETE_NAME, INCR_NAME, FULL_NAME, "other"])
+    catalog = _getCatalog(tmp_path)
+    assert [record.name for record in catalog.getRecords()] == [FULL_NAME, INCR_NAME, INCOMPLETE_NAME]
+    assert [record.name for record in catalog.getRecords(completeOnly=True)] == [FULL_NAME, INCR_NAME]
+    assert catalog.getLastFull().name == FULL_NAME
+    assert catalog.getIncremental(1, 1).name == INCR_NAME
+
+def test_external_changes_seen_by_a_loaded_catalog(tmp_path):
+    _makeDest(tmp_path, [FULL_NAME])
+    catalog = _getCatalog(tmp_path)
+    assert [record.name for record in catalog.getRecords()] == [FULL_NAME]
+
+    #Another process creates and removes backups
+    (tmp_path / "dest" / INCR_NAME).mkdir()
+    assert [record.name for record in catalog.getRecords()] == [FULL_NAME, INCR_NAME]
+    (tmp_path / "dest" / FULL_NAME).rmdir()
+    assert [record.name for record in catalog.getRecords()] == [INCR_NAME]
+
+def test_saved_mtime_is_the_reconciled_one(tmp_path):
+    _makeDest(tmp_path, [FULL_NAME])
+    catalog = _getCatalog(tmp_path)
+    catalog.getRecords()
+
+    #A backup created by another process before this one records its own change must still be found
+    archivedName = "{}.{}".format(FULL_NAME, SnapshotRecord.ARCHIVED_SUFFIX)
+    (tmp_path / "dest" / INCR_NAME).mkdir()
+    os.rename(str(tmp_path / "dest" / FULL_NAME), str(tmp_path / "dest" / archivedName))
+    catalog.rename(FULL_NAME, archivedName)
+
+    assert [record.name for record in catalog.getRecords()] == [archivedName, INCR_NAME]
+    assert [record.name for record in _getCatalog(tmp_path).getRecords()] == [archivedName, INCR_NAME]
+
+def test_index_file_reused(tmp_path, monkeypatch):
+    _makeDest(tmp_path, [FULL_NAME, INCR_NAME])
+    #The first catalog creates the index folder in the dest path so the second reads the dest path again
+    _getCatalog(tmp_path).getRecords()
+    _getCatalog(tmp_path).getRecords()
+
+    #The dest path has not changed so the index file is used without reading the dest path
+    def noScan(path):
+        raise AssertionError("The dest path was read")
+    monkeypatch.setattr(os, "scandir", noScan)
+    assert [record.name for record in _getCatalog(tmp_path).getRecords()] == [FULL_NAME, INCR_NAME]
+
+def test_add_remove_and_rename(tmp_path):
+    _makeDest(tmp_path, [FULL_NAME])
+    catalog = _getCatalog(tmp_path)
+    catalog.getRecords()
+
+    (tmp_path / "dest" / INCOMPLETE_NAME).mkdir()
+    catalog.add(INCOMPLETE_NAME)
+    completeName = INCOMPLETE_NAME[:-len(SnapshotRecord.INCOMPLETE_SUFFIX)-1]
+    os.rename(str(tmp_path / "dest" / INCOMPLETE_NAME), str(tmp_path / "dest" / completeName))
+    catalog.rename(INCOMPLETE_NAME, completeName)
+    (tmp_path / "dest" / FULL_NAME).rmdir()
+    catalog.remove(FULL_NAME)
+
+    assert [record.name for record in catalog.getRecords()] == [completeName]
+    assert [record.name for record in _getCatalog(tmp_path).getRecords()] == [completeName]
@@ -0,0 +1,53 @@
+import  os
+
+from    pbackup.exclude import ExclusionCompiler
+
+def _readExcludeFile(excludeFile):
+    with open(excludeFile) as fd:
+        return fd.read().splitlines()
+
+def test_src_path_pattern_stays_anchored():
+    for src in ("/home/auser", "/home/auser/"):
+        exclusionCompiler = ExclusionCompiler(src)
+        assert exclusionCompiler.add("/home/auser/.cache") == "/.cache"
+        assert exclusionCompiler.add("/home/auser/projects/build") == "/projects/build"
+
+def test_patterns_not_in_src_path_are_unchanged():
+    exclusionCompiler = ExclusionCompiler("/home/auser")
+    assert exclusionCompiler.add("*.tmp") == "*.tmp"
+    assert exclusionCompiler.add("/home/auserX/a") == "/home/auserX/a"
+    assert exclusionCompiler.add("./build//out") == "build/out"
+    assert exclusionCompiler.add("  ") == ""
+
+def test_duplicates_are_removed():
+    exclusionCompiler = ExclusionCompiler("/home/auser")
+    exclusionCompiler.add("/home/auser/.cache")
+    exclusionCompiler.add("/home/auser//.cache")
+    exclusionCompiler.addFolderName("__pycache__")
+    exclusionCompiler.addFolderName("/__pycache__/")
+    assert exclusionCompiler.getPatterns() == ["/.cache", "__pycache__/"]
+
+def test_missing_paths(tmp_path):
+    (tmp_path / "present").mkdir()
+    missingList = ExclusionCompiler.GetMissingPaths(str(tmp_path), ["/present", "/absent", "*.tmp"])
+    assert missingList == [os.path.join(str(tmp_path), "absent")]
+
+def test_cache_dirs_are_anchored(tmp_path):
+    cacheDir = tmp_path / "a" / "cache[1]"
+    cacheDir.mkdir(parents=True)
+    (cacheDir / ExclusionCompiler.CACHEDIR_TAG_FILE).write_bytes(ExclusionCompiler.CACHEDIR_TAG_SIGNATURE + b"\n")
+    notCacheDir = tmp_path / "b"
+    notCacheDir.mkdir()
+    (notCacheDir / ExclusionCompiler.CACHEDIR_TAG_FILE).write_bytes(b"not a cache")
+
+    exclusionCompiler = ExclusionCompiler(str(tmp_path))
+    assert exclusionCompiler.addCacheDirs(threadCount=2) == ["a/cache[1]"]
+    assert exclusionCompiler.getPatterns() == ["/a/cache\\[1]/"]
+
+def test_write(tmp_path):
+    exclusionCompiler = ExclusionCompiler("/home/auser")
+    exclusionCompiler.add("/home/auser/.cache")
+    exclusionCompiler.add("#notes")
+    excludeFile = str(tmp_path / "exclude")
+    exclusionCompiler.write(excludeFile)
+    assert _readExcludeFile(excludeFile) == ["- /.cache", "- #notes"]
@@ -0,0 +1,30 @@
+import  atexit
+import  gzip
+
+from    pbackup.backup import LogWriter
+
+def test_close_unregisters_exit_handler(tmp_path, monkeypatch):
+    handlerList = []
+    monkeypatch.setattr(atexit, "register", handlerList.append)
+    monkeypatch.setattr(atexit, "unregister", handlerList.remove)
+
+    logWriter = LogWriter(str(tmp_path / "log.txt"), background=True)
+    assert handlerList == [logWriter.close]
+    logWriter.write("a line")
+    logWriter.close()
+    logWriter.close()
+    assert handlerList == []
+    assert (tmp_path / "log.txt").read_text() == "a line\n"
+
+def test_rotate(tmp_path):
+    logFile = tmp_path / "log.txt"
+    logWriter = LogWriter(str(logFile), maxBytes=10, backupCount=2)
+    for index in range(0, 3):
+        logWriter.write("line {}".format(index))
+        logWriter.flush()
+    logWriter.close()
+    assert logFile.read_text() == "line 2\n"
+    with gzip.open(str(tmp_path / "log.txt.1.gz"), "rt") as fd:
+        assert fd.read() == "line 1\n"
+    with gzip.open(str(tmp_path / "log.txt.2.gz"), "rt") as fd:
+        assert fd.read() == "line 0\n"
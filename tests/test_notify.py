@@ -0,0 +1,127 @@
+import  socketserver
+import  threading
+import  pytest
+
+from    pbackup.notify import EmailNotifier
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    """@brief An SMTP server stand-in. STARTTLS is not offered. The first connection waits for
+              the server's holdEvent (if set) before greeting the client."""
+
+    def _reply(self, text):
+        self.wfile.write("{}\r\n".format(text).encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connectionCount = server.connectionCount + 1
+            connectionNumber = server.connectionCount
+        if connectionNumber == 1 and server.holdEvent:
+            server.holdEvent.wait()
+
+        self._reply("220 fake ESMTP")
+        while True:
+            line = self.rfile.readline().decode().rstrip("\r\n")
+            if not line:
+                return
+            command = line.split(" ")[0].upper()
+            if command == "EHLO":
+                self._reply("250-fake")
+                self._reply("250 AUTH PLAIN")
+            elif command == "AUTH":
+                server.loginList.append(line)
+                self._reply("235 ok")
+            elif command == "DATA":
+                self._reply("354 go ahead")
+                dataLines = []
+                while True:
+                    dataLine = self.rfile.readline().decode().rstrip("\r\n")
+                    if dataLine == ".":
+                        break
+                    dataLines.append(dataLine)
+                server.messageList.append("\n".join(dataLines))
+                self._reply("250 queued")
+            elif command == "QUIT":
+                self._reply("221 bye")
+                return
+            else:
+                self._reply("250 ok")
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self, holdEvent=None):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), FakeSmtpHandler)
+        self.lock               = threading.Lock()
+        self.connectionCount    = 0
+        self.messageList        = []
+        self.loginList          = []
+        self.holdEvent          = holdEvent
+
+    def getAddress(self):
+        return "127.0.0.1:{}".format(self.server_address[1])
+
+@pytest.fixture
+def smtpServer():
+    server = FakeSmtpServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _getSubjects(server):
+    return [line for message in server.messageList for line in message.splitlines() if line.startswith("Subject:")]
+
+def test_emails_share_one_connection(uo, smtpServer):
+    notifier = EmailNotifier(uo, smtpServer.getAddress(), None, None, timeout=5)
+    notifier.send(["a@b.c"], "first", "body 1")
+    notifier.send(["a@b.c"], "second", "body 2")
+    notifier.flush(timeout=10)
+
+    assert _getSubjects(smtpServer) == ["Subject: first", "Subject: second"]
+    assert smtpServer.connectionCount == 1
+    assert not uo.errorList
+
+def test_password_not_sent_without_starttls(uo, smtpServer):
+    notifier = EmailNotifier(uo, smtpServer.getAddress(), "auser", "apassword", timeout=5, retryCount=0)
+    notifier.send(["a@b.c"], "subject", "body")
+    notifier.flush(timeout=10)
+
+    assert not smtpServer.loginList
+    assert not smtpServer.messageList
+    assert len(uo.errorList) == 1 and "STARTTLS" in uo.errorList[0]
+
+def test_allow_plain_login(uo, smtpServer):
+    notifier = EmailNotifier(uo, smtpServer.getAddress(), "auser", "apassword", timeout=5, allowPlainLogin=True)
+    notifier.send(["a@b.c"], "subject", "body")
+    notifier.flush(timeout=10)
+
+    assert len(smtpServer.loginList) == 1
+    assert _getSubjects(smtpServer) == ["Subject: subject"]
+
+def test_send_after_flush_timeout_uses_a_new_worker(uo):
+    holdEvent = threading.Event()
+    server = FakeSmtpServer(holdEvent=holdEvent)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        notifier = EmailNotifier(uo, server.getAddress(), None, None, timeout=10, retryCount=0)
+        notifier.send(["a@b.c"], "held", "body")
+        firstWorker = notifier._worker
+        notifier.flush(timeout=0.2)
+        assert len(uo.errorList) == 1 and "Timeout" in uo.errorList[0]
+        assert firstWorker.is_alive()
+
+        notifier.send(["a@b.c"], "after timeout", "body")
+        assert notifier._worker is not firstWorker
+        notifier.flush(timeout=10)
+        assert "Subject: after timeout" in _getSubjects(server)
+
+        holdEvent.set()
+        firstWorker.join(10)
+        assert not firstWorker.is_alive()
+
+    finally:
+        holdEvent.set()
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,31 @@
+from    pbackup.backup import Backup, getOptionParser
+
+def test_replica_does_not_repeat_primary_only_work(uo, tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    dest = tmp_path / "dest"
+    (dest / "2026-Oct-01_10_00_00.FULL_1").mkdir(parents=True)
+    replicaDest = tmp_path / "replica"
+    #A journal left in the replica dest path by a --watch of another src path
+    (replicaDest / Backup.META_DIR / Backup.JOURNAL_DIR).mkdir(parents=True)
+
+    replicaList = []
+    monkeypatch.setattr(Backup, "execute", lambda self: replicaList.append(self))
+    options, _ = getOptionParser().parse_args(["--src", str(src), "--dest", "{},{}".format(dest, replicaDest),
+                                               "--dedup", "--space_forecast", "--parallel", "4", "--exclude_cachedir",
+                                               "--src_exclude", "/tmp", "--exclude_junk", "__pycache__"])
+    bk = Backup(uo, options)
+    bk._replicate()
+
+    assert len(replicaList) == 1
+    replicaOptions = replicaList[0]._options
+    assert replicaOptions.src.rstrip("/") == str(dest / "2026-Oct-01_10_00_00.FULL_1")
+    assert replicaOptions.dest == str(replicaDest)
+    assert not replicaOptions.dedup and not replicaOptions.space_forecast and not replicaOptions.exclude_cachedir
+    assert replicaOptions.parallel == 1
+    assert replicaOptions.src_exclude is None and replicaOptions.exclude_junk is None
+    assert replicaList[0]._getJournal() is None
+
+    #The primary backup keeps its options
+    assert options.dedup and options.space_forecast and options.parallel == 4
+    assert not uo.errorList
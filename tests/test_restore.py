@@ -0,0 +1,57 @@
+import  os
+import  stat
+
+from    pbackup.restore import SnapshotRestorer
+
+def _makeBackup(backupPath):
+    (backupPath / "ro" / "inner").mkdir(parents=True)
+    (backupPath / "ro" / "f").write_text("file")
+    (backupPath / "ro" / "inner" / "g").write_text("file")
+    os.link(str(backupPath / "ro" / "f"), str(backupPath / "linked"))
+    os.symlink("ro/f", str(backupPath / "lnk"))
+    os.chmod(str(backupPath / "ro" / "inner"), 0o555)
+    os.chmod(str(backupPath / "ro"), 0o500)
+
+def test_restore(uo, tmp_path):
+    backupPath = tmp_path / "backup"
+    _makeBackup(backupPath)
+    restorePath = tmp_path / "restore"
+
+    assert SnapshotRestorer(uo, str(backupPath), str(restorePath), progressInterval=0).restore()[0:2] == (2, 0)
+    assert (restorePath / "ro" / "inner" / "g").read_text() == "file"
+    assert os.path.samefile(str(restorePath / "ro" / "f"), str(restorePath / "linked"))
+    assert os.readlink(str(restorePath / "lnk")) == "ro/f"
+    assert stat.S_IMODE(os.stat(str(restorePath / "ro")).st_mode) == 0o500
+
+def test_restore_pattern(uo, tmp_path):
+    backupPath = tmp_path / "backup"
+    _makeBackup(backupPath)
+    restorePath = tmp_path / "restore"
+
+    SnapshotRestorer(uo, str(backupPath), str(restorePath), patternList=["ro/inner"], progressInterval=0).restore()
+    assert os.listdir(str(restorePath)) == ["ro"]
+    assert os.listdir(str(restorePath / "ro")) == ["inner"]
+
+def test_resume_into_read_only_folders(uo, tmp_path, monkeypatch):
+    backupPath = tmp_path / "backup"
+    _makeBackup(backupPath)
+    restorePath = tmp_path / "restore"
+    SnapshotRestorer(uo, str(backupPath), str(restorePath), progressInterval=0).restore()
+
+    #A restore that was stopped after the folder modes were set
+    os.chmod(str(restorePath / "ro" / "inner"), 0o700)
+    os.remove(str(restorePath / "ro" / "inner" / "g"))
+    os.chmod(str(restorePath / "ro" / "inner"), 0o555)
+
+    #The tests may run as root who can write to read only folders, so check the folder modes directly
+    restoreFile = SnapshotRestorer._restoreFile
+    def checkWritable(self, relPath, entryStat):
+        dirMode = os.stat(os.path.join(str(restorePath), os.path.dirname(relPath))).st_mode
+        assert dirMode & stat.S_IWUSR
+        return restoreFile(self, relPath, entryStat)
+    monkeypatch.setattr(SnapshotRestorer, "_restoreFile", checkWritable)
+
+    assert SnapshotRestorer(uo, str(backupPath), str(restorePath), progressInterval=0).restore()[0:2] == (1, 1)
+    assert (restorePath / "ro" / "inner" / "g").read_text() == "file"
+    assert stat.S_IMODE(os.stat(str(restorePath / "ro" / "inner")).st_mode) == 0o555
+    assert stat.S_IMODE(os.stat(str(restorePath / "ro")).st_mode) == 0o500
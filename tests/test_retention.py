@@ -0,0 +1,123 @@
+import  time
+import  json
+import  pytest
+
+from    pbackup.retention import GFSRetention
+from    pbackup.catalog import SnapshotRecord
+
+def _getRecords(timeStampList):
+    """@return A SnapshotRecord for each time (the first is a full backup), oldest first."""
+    recordList = []
+    for index, timeStamp in enumerate(timeStampList):
+        incrID = index if index else None
+        name = time.strftime(SnapshotRecord.TIMESTAMP_FORMAT, time.gmtime(timeStamp))
+        recordList.append( SnapshotRecord(name, timeStamp, 1, incrID, SnapshotRecord.STATE_COMPLETE) )
+    return recordList
+
+def _getLocalTime(year, month, day, hour=12):
+    return time.mktime( (year, month, day, hour, 0, 0, 0, 0, -1) )
+
+def test_disabled():
+    assert not GFSRetention().isEnabled()
+    assert GFSRetention(weekly=1).isEnabled()
+
+def test_latest_backup_is_always_kept():
+    recordList = _getRecords([_getLocalTime(2026, 10, 1), _getLocalTime(2026, 10, 2)])
+    assert list(GFSRetention(monthly=1).getKeepDict(recordList).keys()) == [recordList[-1].name]
+    assert GFSRetention().getKeepDict([]) == {}
+
+def test_daily_keeps_latest_backup_of_each_day():
+    #Four backups a day for five days
+    recordList = _getRecords([_getLocalTime(2026, 10, day, hour) for day in range(1, 6) for hour in (1, 7, 13, 19)])
+    keepDict = GFSRetention(daily=3).getKeepDict(recordList)
+    keptList = [record for record in recordList if record.name in keepDict]
+    assert [(time.localtime(record.timeStamp).tm_mday, time.localtime(record.timeStamp).tm_hour) for record in keptList] == [(3, 19), (4, 19), (5, 19)]
+
+def test_hourly_and_monthly_combined():
+    timeStampList = [_getLocalTime(2026, month, 10) for month in (6, 7, 8)]
+    timeStampList = timeStampList + [_getLocalTime(2026, 9, 1, hour) for hour in range(0, 6)]
+    recordList = _getRecords(timeStampList)
+    keepDict = GFSRetention(hourly=2, monthly=3).getKeepDict(recordList)
+    assert keepDict[recordList[-1].name] == [GFSRetention.BUCKET_HOURLY, GFSRetention.BUCKET_MONTHLY]
+    assert keepDict[recordList[-2].name] == [GFSRetention.BUCKET_HOURLY]
+    assert keepDict[recordList[2].name] == [GFSRetention.BUCKET_MONTHLY]
+    assert keepDict[recordList[1].name] == [GFSRetention.BUCKET_MONTHLY]
+    assert recordList[0].name not in keepDict
+    assert len(keepDict) == 4
+
+def test_weekly_buckets_use_iso_weeks():
+    #Sunday 11th and Monday 12th Oct 2026 are in different ISO weeks
+    recordList = _getRecords([_getLocalTime(2026, 10, 10), _getLocalTime(2026, 10, 11), _getLocalTime(2026, 10, 12)])
+    keepDict = GFSRetention(weekly=2).getKeepDict(recordList)
+    assert recordList[0].name not in keepDict
+    assert recordList[1].name in keepDict
+    assert recordList[2].name in keepDict
+
+def test_unknown_time_is_kept():
+    recordList = _getRecords([_getLocalTime(2026, 10, 1), _getLocalTime(2026, 10, 1, 13), _getLocalTime(2026, 10, 1, 14)])
+    recordList[0].timeStamp = None
+    keepDict = GFSRetention(daily=1).getKeepDict(recordList)
+    assert set(keepDict.keys()) == set([recordList[0].name, recordList[2].name])
+
+def _makeBackups(dest, nameList):
+    for name in nameList:
+        (dest / name).mkdir()
+        (dest / name / "afile").write_text(name)
+
+def test_purge_thins_incrementals_outside_a_backup_run(uo, tmp_path):
+    from pbackup.backup import Backup, getOptionParser
+
+    src = tmp_path / "src"
+    src.mkdir()
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    nameList = ["2026-Oct-01_10_00_00.FULL_1",
+                "2026-Oct-01_10_10_00.FULL_1_INCR_1",
+                "2026-Oct-01_10_20_00.FULL_1_INCR_2",
+                "2026-Oct-01_10_30_00.FULL_1_INCR_3"]
+    _makeBackups(dest, nameList)
+
+    options, _ = getOptionParser().parse_args(["--src", str(src), "--dest", str(dest), "--keep_hourly", "1"])
+    bk = Backup(uo, options)
+    try:
+        bk._purgeBackups()
+    finally:
+        uo.closeLog()
+
+    assert sorted([record.name for record in bk._catalog.getRecords()]) == [nameList[0], nameList[3]]
+
+    #The next incremental follows the last one kept although INCR_1 and INCR_2 were removed
+    lastBackupPath = bk._getLastBackupPath( str(dest / "2026-Oct-01_11_00_00.FULL_1_INCR_4") )
+    assert lastBackupPath == str(dest / nameList[3])
+
+def test_space_check_purges_the_sets_the_purge_removes(uo, tmp_path, monkeypatch):
+    from pbackup.backup import Backup, BackupError, getOptionParser
+    from pbackup.metrics import RunMetrics
+
+    src = tmp_path / "src"
+    src.mkdir()
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    _makeBackups(dest, ["2026-Oct-01_10_00_00.FULL_1",
+                        "2026-Oct-01_10_10_00.FULL_1_INCR_1",
+                        "2026-Oct-02_10_00_00.FULL_2.incomplete",
+                        "2026-Oct-03_10_00_00.FULL_3"])
+    #An earlier full backup used more space than any disk has so old backups are purged first
+    with open(str(dest / Backup.METRICS_HISTORY_FILE), 'w') as fd:
+        fd.write("{}\n".format(json.dumps({"success": True, "backup_type": "full", "backup_size_bytes": 2**60})))
+
+    purgedList = []
+    monkeypatch.setattr(Backup, "_removeFullBackupSet", lambda self, recordList, fullBackupID: purgedList.append(fullBackupID))
+    options, _ = getOptionParser().parse_args(["--src", str(src), "--dest", str(dest), "--max_full", "2"])
+    bk = Backup(uo, options)
+    bk._runMetrics = RunMetrics()
+    with pytest.raises(BackupError):
+        bk._checkSpace( str(dest / "2026-Oct-04_10_00_00.FULL_4") )
+    checkSpaceList = purgedList
+    bk._runMetrics = None
+
+    #The backup completes and is then purged as normal
+    purgedList = []
+    _makeBackups(dest, ["2026-Oct-04_10_00_00.FULL_4"])
+    bk._purgeBackups()
+    assert checkSpaceList == purgedList == [1, 2]
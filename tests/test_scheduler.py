@@ -0,0 +1,48 @@
+import  json
+import  pickle
+
+from    pbackup.backup import Backup, getOptionParser
+from    pbackup.metrics import RunMetrics
+from    pbackup.scheduler import BackupJob
+
+def _getJob(tmp_path, dest):
+    options, _ = getOptionParser().parse_args(["--src", str(tmp_path), "--dest", dest])
+    configFile = str(tmp_path / "job.cfg")
+    with open(configFile, "wb") as fd:
+        pickle.dump(options, fd)
+    return BackupJob("job", configFile, ["01:00"])
+
+def _appendHistory(historyFile, historyDict):
+    with open(historyFile, 'a') as fd:
+        fd.write("{}\n".format(json.dumps(historyDict)))
+
+def test_primary_dest_of_multi_dest_job(tmp_path):
+    dest = tmp_path / "dest"
+    job = _getJob(tmp_path, "{}, {}".format(dest, tmp_path / "dest2"))
+    assert job.dest == str(dest)
+
+def test_history_only_read_when_changed(tmp_path, monkeypatch):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    historyFile = str(dest / Backup.METRICS_HISTORY_FILE)
+    job = _getJob(tmp_path, str(dest))
+
+    loadList = []
+    loadHistory = RunMetrics.LoadHistory
+    def countLoads(historyFile):
+        loadList.append(historyFile)
+        return loadHistory(historyFile)
+    monkeypatch.setattr(RunMetrics, "LoadHistory", staticmethod(countLoads))
+
+    assert job.getExpectedDuration() == 0
+    _appendHistory(historyFile, {"success": True, "duration_seconds": 10, "start_time": 100})
+    _appendHistory(historyFile, {"success": False, "duration_seconds": 99, "start_time": 200})
+    assert job.getExpectedDuration() == 10
+    assert job.getExpectedDuration() == 10
+    assert job.getLastRunSuccess(150) is False
+    assert len(loadList) == 1
+
+    _appendHistory(historyFile, {"success": True, "duration_seconds": 20, "start_time": 300})
+    assert job.getExpectedDuration() == 15
+    assert job.getLastRunSuccess(250) is True
+    assert len(loadList) == 2
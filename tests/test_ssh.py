@@ -0,0 +1,137 @@
+import  os
+import  sys
+import  stat
+import  pytest
+
+import  pbackup.backup as backup
+from    pbackup.ssh import SshSession
+
+#An ssh stand-in. A ControlMaster=yes connection creates the control socket file. Other connections
+#log whether they reused it and then run the remote command locally with sh.
+FAKE_SSH = """#!{python}
+import sys, os, subprocess
+args = sys.argv[1:]
+opts = {{}}
+pos = []
+i = 0
+while i < len(args):
+    arg = args[i]
+    if arg in ("-o", "-p", "-O"):
+        if arg == "-o":
+            key, value = args[i+1].split("=", 1)
+            opts[key] = value
+        else:
+            opts[arg] = args[i+1]
+        i += 2
+        continue
+    if arg.startswith("-") and not pos:
+        i += 1
+        continue
+    pos.append(arg)
+    i += 1
+with open(os.environ["FAKE_SSH_LOG"], "a") as log:
+    log.write(" ".join(args) + "\\n")
+controlPath = opts.get("ControlPath")
+if opts.get("-O") == "exit":
+    os.remove(controlPath)
+    sys.exit(0)
+if opts.get("ControlMaster") == "yes":
+    if os.environ.get("FAKE_SSH_FAIL"):
+        sys.stderr.write("ssh: connect to host: Connection refused\\n")
+        sys.exit(255)
+    open(controlPath, "w").close()
+    sys.exit(0)
+if not controlPath or not os.path.exists(controlPath):
+    sys.stderr.write("no shared connection\\n")
+    sys.exit(255)
+sys.exit(subprocess.call(["sh", "-c", " ".join(pos[1:])]))
+"""
+
+FAKE_RSYNC = """#!/bin/sh
+echo "rsync  version 3.2.7  protocol version 31"
+"""
+
+def _writeScript(path, text):
+    with open(path, 'w') as fd:
+        fd.write(text)
+    os.chmod(path, stat.S_IRWXU)
+    return str(path)
+
+@pytest.fixture
+def fakeSsh(tmp_path, monkeypatch):
+    binDir = tmp_path / "bin"
+    binDir.mkdir()
+    sshCmd = _writeScript(binDir / "ssh", FAKE_SSH.format(python=sys.executable))
+    _writeScript(binDir / "rsync", FAKE_RSYNC)
+    logFile = tmp_path / "ssh.log"
+    monkeypatch.setenv("FAKE_SSH_LOG", str(logFile))
+    monkeypatch.setenv("PATH", "{}:{}".format(binDir, os.environ["PATH"]))
+    monkeypatch.setenv("HOME", str(tmp_path))
+    return (sshCmd, logFile)
+
+def _getLogLines(logFile):
+    with open(logFile) as fd:
+        return fd.read().splitlines()
+
+def test_commands_share_one_connection(fakeSsh):
+    sshCmd, logFile = fakeSsh
+    session = SshSession("auser", "ahost", sshCmd=sshCmd)
+    session.open()
+    try:
+        assert session.run("echo hello").strip() == "hello"
+        assert session.getRsyncVersion() == "3.2.7"
+    finally:
+        session.close()
+
+    lineList = _getLogLines(logFile)
+    assert len([line for line in lineList if "ControlMaster=yes" in line]) == 1
+    assert len([line for line in lineList if "ControlMaster=no" in line]) == 2
+
+def test_host_key_checked_unless_port_given(fakeSsh):
+    sshCmd, _ = fakeSsh
+    assert "StrictHostKeyChecking=no" not in SshSession("auser", "ahost", sshCmd=sshCmd).getSshArgs()
+    argList = SshSession("auser", "ahost", port=2222, sshCmd=sshCmd, checkHostKey=False).getSshArgs()
+    assert "StrictHostKeyChecking=no" in argList
+    assert argList[1:3] == ["-p", "2222"]
+
+def test_quote_path_keeps_tilde_expansion():
+    assert SshSession.QuotePath("~") == "~"
+    assert SshSession.QuotePath("~/My Documents") == "~/'My Documents'"
+    assert SshSession.QuotePath("~auser/docs") == "~auser/docs"
+    assert SshSession.QuotePath("/home/a user") == "'/home/a user'"
+    assert SshSession.QuotePath("~$(rm)/x").startswith("'")
+
+def test_free_space_of_home_path(fakeSsh):
+    sshCmd, _ = fakeSsh
+    session = SshSession("auser", "ahost", sshCmd=sshCmd)
+    session.open()
+    try:
+        totalBytes, freeBytes = session.getFreeSpace("~/")
+    finally:
+        session.close()
+    assert totalBytes > 0 and freeBytes > 0
+
+def _getBackup(uo, tmp_path, sshCmd, monkeypatch, src):
+    monkeypatch.setattr(backup.Backup, "SSH_CMD", sshCmd)
+    monkeypatch.setattr(backup.Backup, "RSYNC_CMD", str(tmp_path / "bin" / "rsync"))
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    options, _ = backup.getOptionParser().parse_args(["--src", src, "--dest", str(dest), "--ssh", "auser@ahost", "--ssh_file_count"])
+    return backup.Backup(uo, options)
+
+def test_remote_info_failures_are_warnings(uo, fakeSsh, tmp_path, monkeypatch):
+    sshCmd, _ = fakeSsh
+    bk = _getBackup(uo, tmp_path, sshCmd, monkeypatch, "/not/a/remote/path")
+    try:
+        bk._runChecks()
+        assert bk._sshSession is not None
+    finally:
+        bk._closeSsh()
+    assert len(uo.warnList) == 2
+
+def test_connect_failure_is_fatal(uo, fakeSsh, tmp_path, monkeypatch):
+    sshCmd, _ = fakeSsh
+    monkeypatch.setenv("FAKE_SSH_FAIL", "1")
+    bk = _getBackup(uo, tmp_path, sshCmd, monkeypatch, "/home/auser")
+    with pytest.raises(Exception, match="Connection refused"):
+        bk._runChecks()